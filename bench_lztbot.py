@@ -0,0 +1,333 @@
+"""Offline benchmark for lztbot: fake LZT API + fake Telegram session.
+
+    python bench_lztbot.py                       # all scenarios, save as current git rev
+    python bench_lztbot.py --only storm,balance --latency-ms 80 --rate429 0.05
+    python bench_lztbot.py --compare <label>     # print deltas against a stored run
+    python bench_lztbot.py --only storm_taps --notif-kb 64 --offload process  # handler latency during a storm
+"""
+import os, sys, json, time, random, asyncio, argparse, logging, tempfile, threading, subprocess, resource
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+os.environ.update({"TG_BOT_TOKEN": "123456:BENCH", "LZT_FORUM_TOKEN": "bench", "LZT_MARKET_TOKEN": "bench",
+                   "ADMIN_USER_ID": "1000", "METRICS_PORT": "0"})
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import lztbot as L
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.types import Message, Chat, User, CallbackQuery, Update
+
+logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results.json")
+
+NOTIF_SAMPLES = [
+    '<a href="https://lolz.live/members/{uid}/" class="username">user{uid}</a> упомянул(а) вас в теме '
+    '<a href="https://lolz.live/threads/{tid}/">Тема {tid}</a>',
+    '<a href="https://lolz.live/members/{uid}/" class="username">user{uid}</a> прокомментировал(а) ваше сообщение '
+    'в теме <a href="https://lolz.live/threads/{tid}/#post-{pid}">Тема {tid}</a>'
+    '<div class="contentRow-snippet">Комментарий номер {pid}</div>',
+    '<a href="https://lolz.live/members/{uid}/">user{uid}</a> нравится ваше сообщение в теме '
+    '<a href="https://lolz.live/threads/{tid}/">Тема {tid}</a>',
+    '<a href="https://lolz.live/members/{uid}/">user{uid}</a> отправил(а) вам 1 250 ₽. Холд закончится 21.10.2026 12:00',
+    'Деньги в размере 500 ₽ зачислены на ваш баланс',
+]
+
+
+class FakeLZT:
+    """Stand-in for prod-api.lolz.live / prod-api.lzt.market served from a local thread."""
+
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, rate429: float = 0, seed: int = 1, notif_kb: float = 0):
+        self.latency = latency_ms / 1000.0; self.error_rate = error_rate; self.rate429 = rate429
+        self.pad = ('<div class="message-body"><blockquote>«цитата»</blockquote>' + "текст &amp; <b>разметка</b> " * int(notif_kb * 1024 / 28) + "</div>") if notif_kb else ""
+        self.rnd = random.Random(seed); self.lock = threading.Lock()
+        self.next_notif = 1; self.hits: list = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+    def notifications(self, n: int = 10) -> list:
+        with self.lock:
+            first = self.next_notif; self.next_notif += n
+        out = []
+        for nid in range(first, first + n):
+            html = NOTIF_SAMPLES[nid % len(NOTIF_SAMPLES)].format(uid=100 + nid % 37, tid=5000 + nid % 11, pid=90000 + nid) + self.pad
+            out.append({"notification_id": nid, "notification_create_date": 1_700_000_000 + nid, "notification_html": html})
+        return out
+
+    def route(self, method: str, path: str, query: dict) -> tuple:
+        parts = [p for p in path.split("/") if p]
+        if parts == ["notifications"]:
+            return 200, {"notifications": self.notifications(int(query.get("limit", ["10"])[0]))}
+        if len(parts) == 3 and parts[0] == "notifications" and parts[2] == "content":
+            return 200, {}
+        if len(parts) == 3 and parts[0] == "threads" and parts[2] == "bump":
+            return 200, {"status": "ok"}
+        if len(parts) == 2 and parts[0] == "threads":
+            return 200, {"thread": {"thread_id": int(parts[1]), "thread_view_count": 100, "thread_post_count": 3}}
+        if parts == ["market", "me"]:
+            return 200, {"user": {"balance": "1234.50", "hold": "100.00", "currency": "rub"}}
+        if parts == ["user", "payments"]:
+            pays = {str(i): {"operation_date": 1_700_000_000 + i, "incoming_sum": "10.00" if i % 2 else "0.00",
+                             "outgoing_sum": "0.00" if i % 2 else "5.00", "label": {"title": "Перевод"},
+                             "data": {"username": f"user{i}"}} for i in range(int(query.get("limit", ["20"])[0]))}
+            return 200, {"payments": pays}
+        if parts == ["balance", "transfer", "fee"]:
+            return 200, {"commission_percentage": 3}
+        return 404, {"errors": ["not found"]}
+
+    def _handler(self):
+        fake = self
+
+        class H(BaseHTTPRequestHandler):
+            def log_message(self, *a):
+                pass
+
+            def _serve(self):
+                u = urlparse(self.path)
+                n = int(self.headers.get("Content-Length") or 0)
+                if n: self.rfile.read(n)
+                with fake.lock:
+                    fake.hits.append((time.perf_counter(), self.command, u.path))
+                    roll = fake.rnd.random()
+                if fake.latency: time.sleep(fake.latency)
+                if roll < fake.rate429:
+                    code, body = 429, {"errors": ["Too many requests"]}
+                elif roll < fake.rate429 + fake.error_rate:
+                    code, body = 500, {"errors": ["Internal error"]}
+                else:
+                    code, body = fake.route(self.command, u.path, parse_qs(u.query))
+                raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(raw)))
+                self.end_headers(); self.wfile.write(raw)
+
+            do_GET = do_POST = _serve
+
+        return H
+
+
+class FakeTelegramSession(BaseSession):
+    """aiogram session that answers every Bot API method locally."""
+
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, seed: int = 2):
+        super().__init__()
+        self.latency = latency_ms / 1000.0; self.error_rate = error_rate
+        self.rnd = random.Random(seed); self.sent: list = []
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.latency: await asyncio.sleep(self.latency)
+        if self.rnd.random() < self.error_rate:
+            raise TelegramNetworkError(method=method, message="fake network error")
+        self.sent.append((time.perf_counter(), type(method).__name__))
+        if method.__returning__ is bool:
+            return True
+        chat_id = getattr(method, "chat_id", None) or int(os.environ["ADMIN_USER_ID"])
+        return Message(message_id=len(self.sent), date=datetime.now(), chat=Chat(id=int(chat_id), type="private"),
+                       text=getattr(method, "text", None)).as_(bot)
+
+    async def stream_content(self, *a, **kw):
+        raise NotImplementedError
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def _pct(samples: list, q: float) -> float:
+    if not samples: return 0.0
+    xs = sorted(samples); return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _summary(name: str, ops: int, wall: float, lat: list) -> dict:
+    return {"scenario": name, "ops": ops, "wall_s": round(wall, 4), "throughput_ops_s": round(ops / wall, 2) if wall else 0.0,
+            "p50_ms": round(_pct(lat, 0.5) * 1000, 2), "p99_ms": round(_pct(lat, 0.99) * 1000, 2), "rss_mb": round(_rss_mb(), 1)}
+
+
+async def scenario_storm(fake: FakeLZT, tg: FakeTelegramSession, cycles: int) -> dict:
+    """Notification storm: every poll returns 10 unseen notifications. Latency = one poll cycle (fetch, parse,
+    render, enqueue); ``outbox_drain_s`` is how long the sender then needs to deliver everything at Telegram pacing."""
+    L._save(L.SETTINGS_FILE, {"last_notif_key": "id:0"})
+    lat = []; sent0 = len(tg.sent); t0 = time.perf_counter()
+    for _ in range(cycles):
+        c0 = time.perf_counter()
+        await L.notif_poll_once()
+        lat.append(time.perf_counter() - c0)
+    wall = time.perf_counter() - t0
+    d0 = time.perf_counter()
+    left = await L.SENDER.drain(600)
+    res = _summary("storm", cycles * 10, wall, lat)
+    res["outbox_drain_s"] = round(time.perf_counter() - d0, 2)
+    res["cards_sent"] = len(tg.sent) - sent0
+    res["cards_dropped"] = left
+    return res
+
+
+async def scenario_autobump(fake: FakeLZT, tg: FakeTelegramSession, threads: int) -> dict:
+    """`threads` threads all due on the same tick (phases pre-planned so none get rescheduled);
+    latency = dispatch delay of each bump, capped by BUMP_BUDGET_PER_MIN."""
+    L._save(L.BUMPS_FILE, {"threads": [{"thread_id": 7_000_000 + i, "interval_min": 10, "last_bump_ts": 0, "next_bump_ts": 1,
+                                        "phase_sec": int(i * 600 / threads)} for i in range(threads)]})
+    h0 = len(fake.hits); t0 = time.perf_counter()
+    await L.autobump_once()
+    wall = time.perf_counter() - t0
+    lat = [ts - t0 for ts, m, p in fake.hits[h0:] if p.endswith("/bump")]
+    return _summary("autobump", threads, wall, lat)
+
+
+async def scenario_balance(fake: FakeLZT, tg: FakeTelegramSession, taps: int) -> dict:
+    """Burst of `taps` concurrent act:balance callback updates fed through the dispatcher."""
+    admin = int(os.environ["ADMIN_USER_ID"])
+    user = User(id=admin, is_bot=False, first_name="bench")
+    msg = Message(message_id=1, date=datetime.now(), chat=Chat(id=admin, type="private"), text="menu")
+    lat = []; t0 = time.perf_counter()
+
+    async def tap(i: int):
+        upd = Update(update_id=i, callback_query=CallbackQuery(id=str(i), from_user=user, chat_instance="bench", data="act:balance", message=msg))
+        await L.dp.feed_update(L.bot, upd)
+        lat.append(time.perf_counter() - t0)
+
+    await asyncio.gather(*(tap(i) for i in range(taps)))
+    return _summary("balance", taps, time.perf_counter() - t0, lat)
+
+
+async def scenario_storm_taps(fake: FakeLZT, tg: FakeTelegramSession, cycles: int, hz: float = 50.0) -> dict:
+    """Handler latency during a storm: /start updates fed at a fixed rate while notif_poll_once runs;
+    latency = completion time minus the scheduled time, so loop stalls from parsing show up directly."""
+    L._save(L.SETTINGS_FILE, {"last_notif_key": "id:0"})
+    admin = int(os.environ["ADMIN_USER_ID"])
+    user = User(id=admin, is_bot=False, first_name="bench")
+    lat = []; done = asyncio.Event()
+
+    async def storm():
+        for _ in range(cycles):
+            await L.notif_poll_once()
+        done.set()
+
+    async def taps():
+        loop = asyncio.get_running_loop(); t_next = loop.time(); i = 0
+        while not done.is_set():
+            t_next += 1.0 / hz; i += 1
+            await asyncio.sleep(max(0.0, t_next - loop.time()))
+            upd = Update(update_id=10_000 + i, message=Message(message_id=i, date=datetime.now(), chat=Chat(id=admin, type="private"),
+                                                                  from_user=user, text="/start"))
+            await L.dp.feed_update(L.bot, upd)
+            lat.append(loop.time() - t_next)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(storm(), taps())
+    await L.SENDER.drain(600)
+    res = _summary("storm_taps", len(lat), time.perf_counter() - t0, lat)
+    res["offload"] = L.OFFLOAD.mode
+    # which executor actually ran the batches: a mode that silently fell back would otherwise pass for the one asked for
+    res["offload_batches"] = {dict(k).get("mode"): int(v) for k, v in L.METRICS.snapshot("counters", "offload_batches_total").items()}
+    return res
+
+
+def _label() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return "local"
+
+def _compare(base: dict, cur: dict):
+    print(f"\n{'scenario':<10} {'metric':<18} {'base':>10} {'current':>10} {'delta':>8}")
+    for name, r in cur.items():
+        b = base.get(name) or {}
+        for k in ("throughput_ops_s", "p50_ms", "p99_ms", "rss_mb"):
+            if k in b and b[k]:
+                print(f"{name:<10} {k:<18} {b[k]:>10} {r[k]:>10} {(r[k] - b[k]) / b[k] * 100:>+7.1f}%")
+
+
+async def run(args) -> dict:
+    fake = FakeLZT(args.latency_ms, args.error_rate, args.rate429, notif_kb=args.notif_kb)
+    if args.offload:
+        L.OFFLOAD.shutdown(); L.OFFLOAD.mode = args.offload
+    tg = FakeTelegramSession(args.tg_latency_ms, args.tg_error_rate)
+    L.FORUM_BASE = L.MARKET_BASE = fake.base
+    L.setup_bot()
+    L.bot.session = tg
+    if args.rl_interval is not None:
+        L.RL_MIN_INTERVAL_SEC = args.rl_interval
+    out = {}
+    try:
+        for name in args.only.split(","):
+            name = name.strip()
+            if name == "storm":
+                out[name] = await scenario_storm(fake, tg, args.cycles)
+            elif name == "autobump":
+                out[name] = await scenario_autobump(fake, tg, args.threads)
+            elif name == "balance":
+                out[name] = await scenario_balance(fake, tg, args.taps)
+            elif name == "storm_taps":
+                await L.OFFLOAD.warm()
+                out[name] = await scenario_storm_taps(fake, tg, args.cycles)
+            else:
+                raise SystemExit(f"unknown scenario: {name}")
+            print(json.dumps(out[name], ensure_ascii=False))
+    finally:
+        fake.close()
+        L.OFFLOAD.shutdown()
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--only", default="storm,autobump,balance")
+    ap.add_argument("--cycles", type=int, default=20, help="storm: poll cycles (10 notifications each)")
+    ap.add_argument("--threads", type=int, default=200, help="autobump: threads due on one tick")
+    ap.add_argument("--taps", type=int, default=30, help="balance: concurrent taps")
+    ap.add_argument("--latency-ms", type=float, default=20.0, help="fake API latency")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fake API 500 ratio")
+    ap.add_argument("--rate429", type=float, default=0.0, help="fake API 429 ratio")
+    ap.add_argument("--notif-kb", type=float, default=0.0, help="pad every fake notification with this many KB of markup")
+    ap.add_argument("--offload", choices=("process", "thread", "inline"), default=None, help="override OFFLOAD_MODE")
+    ap.add_argument("--tg-latency-ms", type=float, default=5.0)
+    ap.add_argument("--tg-error-rate", type=float, default=0.0)
+    ap.add_argument("--rl-interval", type=float, default=None, help=f"override RL_MIN_INTERVAL_SEC (default {L.RL_MIN_INTERVAL_SEC})")
+    ap.add_argument("--label", default=None, help="name to store results under (default: git short rev)")
+    ap.add_argument("--no-save", action="store_true")
+    ap.add_argument("--compare", default=None, help="stored label to compare against")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="lztbench-"); cwd = os.getcwd(); os.chdir(workdir)
+    try:
+        res = asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+
+    stored = {}
+    if os.path.exists(RESULTS_FILE):
+        with open(RESULTS_FILE, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+    if args.compare:
+        if args.compare not in stored:
+            print(f"no stored results for {args.compare!r}")
+        else:
+            _compare(stored[args.compare]["scenarios"], res)
+    if not args.no_save:
+        label = args.label or _label()
+        stored[label] = {"ts": int(time.time()), "params": {k: v for k, v in vars(args).items() if k not in {"label", "compare", "no_save"}},
+                         "scenarios": {**(stored.get(label) or {}).get("scenarios", {}), **res}}
+        with open(RESULTS_FILE, "w", encoding="utf-8") as f:
+            json.dump(stored, f, ensure_ascii=False, indent=2)
+        print(f"saved as {label!r} -> {RESULTS_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Corpus + fuzz gate for parse_notif / _clean_text.
+
+    python bench_parser.py                         # correctness, worst-case budget, throughput
+    python bench_parser.py --budget-ms 50 --sizes 4096,65536
+    python bench_parser.py --update-corpus         # re-freeze expectations after an intended change
+
+Exits non-zero if any corpus sample differs from its expectation or any
+generated input takes longer than the per-call budget. Each generated input
+is parsed, cleaned and matched against BENCH_RULES, like notif_poll_once does.
+"""
+import os, sys, json, time, random, argparse, multiprocessing as mp
+
+os.environ.update({"TG_BOT_TOKEN": "123456:BENCH", "LZT_FORUM_TOKEN": "bench", "LZT_MARKET_TOKEN": "bench",
+                   "ADMIN_USER_ID": "1000", "METRICS_PORT": "0"})
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import lztbot as L
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser_corpus.json")
+
+def _rand_html(n: int, seed: int = 7) -> str:
+    rnd = random.Random(seed)
+    atoms = ['<a href="', '">', '</a>', '<div class="contentRow-snippet">', '</div>', '<blockquote>', '«', '»',
+             '<br>', ' ', '\t', '\n', '&amp;', 'упомянул(а) вас', '/threads/1/#post-2', '/members/3/', '₽', '1 000']
+    out, size = [], 0
+    while size < n:
+        a = rnd.choice(atoms); out.append(a); size += len(a)
+    return "".join(out)
+
+PATHOLOGICAL = {
+    "unclosed_anchor":  lambda n: '<a href="https://lolz.live/members/1/">' * (n // 39),
+    "unterminated_href": lambda n: '<a href="' + "x" * n,
+    "unclosed_snippet": lambda n: '<div class="contentRow-snippet">' * (n // 32),
+    "unclosed_message": lambda n: '<div class="message-body">' * (n // 26),
+    "unclosed_quote":   lambda n: '<blockquote>' * (n // 12),
+    "open_class_attr":  lambda n: '<div class="' + "a" * n,
+    "lt_flood":         lambda n: "<" * n,
+    "space_run":        lambda n: " " * n + "x",
+    "guillemet_flood":  lambda n: "«" * n,
+    "digits_no_rub":    lambda n: "1 " * (n // 2),
+    # verb-prefixed floods reach the amount extractor; the last one stays "other" and hits the rules' amount check
+    "transfer_digits":  lambda n: "отправил(а) вам " + "1 " * (n // 2),
+    "payment_digits":   lambda n: "зачислены на ваш баланс " + "1 " * (n // 2),
+    "hold_digits":      lambda n: "холд закончился " + "1 ." * (n // 3),
+    "other_digits":     lambda n: "x " + "1 2,3." * (n // 6),
+    "random_tags":      _rand_html,
+}
+
+# a keyword rule plus an amount rule: with rules loaded every notification, "other" included, is matched
+BENCH_RULES = L.RuleSet([L.AlertRule.compile(1, "tag", "x", "text:арбитраж"),
+                         L.AlertRule.compile(2, "alert", "", "amount>5000 unknown")])
+
+def _fields(p) -> dict:
+    return p.to_dict()
+
+def check_corpus(corpus: dict) -> list:
+    fails = []
+    for s in corpus["notifications"]:
+        got = _fields(L.parse_notif(s["html"], s.get("content")))
+        diff = {k: (v, got.get(k)) for k, v in s["expect"].items() if got.get(k) != v}
+        if diff:
+            fails.append((s["name"], diff))
+    for i, s in enumerate(corpus["clean_text"]):
+        got = L._clean_text(s["input"])
+        if got != s["expect"]:
+            fails.append((f"clean_text[{i}]", {"text": (s["expect"], got)}))
+    return fails
+
+def _timed_case(name: str, size: int, q):
+    html = PATHOLOGICAL[name](size)
+    t0 = time.perf_counter()
+    p = L.parse_notif(html)
+    L._clean_text(html)
+    BENCH_RULES.match(p)
+    q.put(time.perf_counter() - t0)
+
+def check_budget(sizes: list, budget: float, kill_after: float) -> list:
+    ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+    rows = []
+    for name in PATHOLOGICAL:
+        for size in sizes:
+            q = ctx.Queue(); proc = ctx.Process(target=_timed_case, args=(name, size, q), daemon=True)
+            proc.start(); proc.join(kill_after)
+            if proc.is_alive():
+                proc.kill(); proc.join(); dt = None
+            else:
+                dt = q.get() if not q.empty() else None
+            rows.append((name, size, dt, dt is not None and dt <= budget))
+    return rows
+
+def throughput(corpus: dict, seconds: float) -> float:
+    items = [(s["html"], s.get("content")) for s in corpus["notifications"]]
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        for html, content in items:
+            L.parse_notif(html, content)
+        n += len(items)
+    return n / (time.perf_counter() - t0)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--budget-ms", type=float, default=50.0, help="worst-case time per parse_notif+_clean_text+rules call")
+    ap.add_argument("--sizes", default="4096,16384,65536", help="generated input sizes (chars)")
+    ap.add_argument("--kill-after", type=float, default=5.0, help="hard timeout per generated case, seconds")
+    ap.add_argument("--seconds", type=float, default=1.0, help="throughput measurement window")
+    ap.add_argument("--update-corpus", action="store_true")
+    args = ap.parse_args()
+
+    with open(CORPUS_FILE, "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    if args.update_corpus:
+        for s in corpus["notifications"]:
+            s["expect"] = _fields(L.parse_notif(s["html"], s.get("content")))
+        for s in corpus["clean_text"]:
+            s["expect"] = L._clean_text(s["input"])
+        with open(CORPUS_FILE, "w", encoding="utf-8") as f:
+            json.dump(corpus, f, ensure_ascii=False, indent=1)
+        print(f"corpus re-frozen: {CORPUS_FILE}")
+
+    ok = True
+    fails = check_corpus(corpus)
+    total = len(corpus["notifications"]) + len(corpus["clean_text"])
+    print(f"correctness: {total - len(fails)}/{total} samples match")
+    for name, diff in fails:
+        ok = False
+        print(f"  FAIL {name}: " + json.dumps({k: {"expect": e, "got": g} for k, (e, g) in diff.items()}, ensure_ascii=False))
+
+    budget = args.budget_ms / 1000.0
+    sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+    print(f"worst case (budget {args.budget_ms:g} ms/call):")
+    for name, size, dt, passed in check_budget(sizes, budget, max(args.kill_after, budget)):
+        ok = ok and passed
+        shown = f"{dt * 1000:9.2f} ms" if dt is not None else f"  >{args.kill_after:g} s (killed)"
+        print(f"  {'ok  ' if passed else 'FAIL'} {name:<18} {size:>7} chars {shown}")
+
+    print(f"throughput: {throughput(corpus, args.seconds):,.0f} notifications/s")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
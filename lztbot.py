@@ -1,20 +1,50 @@
-import os, re, time, json, math, asyncio, requests, logging, hashlib, html as _html, random
+import time
+_BOOT_T0 = time.perf_counter()
+import os, re, sys, json, math, asyncio, logging, hashlib, html as _html, random, threading, traceback, heapq, signal, socket, sqlite3, zlib
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, Any, Optional, List, Tuple
+from typing import Dict, Any, Optional, List, Tuple, Callable
+from urllib.parse import parse_qsl
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InputFile
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from notif_parse import ParsedNotif, parse_notif, _clean_text, _hash_notif, _a, _ts, _money, _render_chunk, _pool_ready
 
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
+def _process_age() -> float:
+    """Seconds since the OS started this process (Linux /proc); 0 where unavailable."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+# seconds since process launch at each startup milestone; see mark_startup()
+STARTUP: Dict[str, float] = {}
+_LAUNCH_OFFSET = _process_age() - (time.perf_counter() - _BOOT_T0)
+STARTUP["interpreter"] = max(0.0, _LAUNCH_OFFSET)
+STARTUP["imports"] = _LAUNCH_OFFSET + time.perf_counter() - _BOOT_T0
+
+def mark_startup(phase: str):
+    if phase not in STARTUP:
+        STARTUP[phase] = _LAUNCH_OFFSET + time.perf_counter() - _BOOT_T0
+        logging.info("startup: %s at %.3fs", phase, STARTUP[phase])
+
 TG_BOT_TOKEN     = os.getenv("TG_BOT_TOKEN", "")
 LZT_FORUM_TOKEN  = os.getenv("LZT_FORUM_TOKEN", "")
 LZT_MARKET_TOKEN = os.getenv("LZT_MARKET_TOKEN", "")
@@ -44,6 +74,13 @@ def is_admin(tg_id: Optional[int]) -> bool:
 SETTINGS_FILE = "settings.json"
 NOTES_FILE = "notes.json"
 BUMPS_FILE = "bumps.json"
+TEMPLATES_FILE = "templates.json"
+BUMP_STATS_FILE = "bump_stats.json"
+REMINDERS_FILE = "reminders.json"
+SUBSCRIBERS_FILE = "subscribers.json"
+RULES_FILE = "rules.json"
+MARKET_SEARCHES_FILE = "market_searches.json"
+LIFECYCLE_FILE = "lifecycle.json"
 
 def _load(path, default):
     try:
@@ -53,43 +90,454 @@ def _load(path, default):
         return default
 
 def _save(path, data):
-    with open(path, "w", encoding="utf-8") as f:
+    # write-then-rename: a kill mid-write leaves the previous file intact
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+STATE_DB = os.getenv("STATE_DB", "state.db")
+PROC_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+class SharedStore:
+    """SQLite file shared by every bot process: leader leases plus one cross-process write lock
+    that serialises read-modify-write of the JSON state files."""
+
+    def __init__(self, path: str = STATE_DB, busy_timeout: float = 10.0):
+        self.path = path; self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            c.execute("CREATE TABLE IF NOT EXISTS signals (name TEXT PRIMARY KEY, ts REAL NOT NULL)")
+            self._local.conn = c; self._local.depth = 0
+        return c
+
+    @contextmanager
+    def mutex(self, name: str):
+        # one database-wide lock; `name` only labels the wait metric. Re-entrant within a thread.
+        c = self._conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        t0 = time.perf_counter()
+        c.execute("BEGIN IMMEDIATE")
+        METRICS.observe("state_lock_wait_seconds", time.perf_counter() - t0, buckets=LAG_BUCKETS, lock=name)
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            # a failed critical section leaves no partial rows behind; JSON files it already replaced stay as written
+            self._local.depth = 0
+            c.execute("ROLLBACK")
+            raise
+        self._local.depth = 0
+        c.execute("COMMIT")
+
+    def lease(self, name: str, ttl: float) -> bool:
+        """Take or renew leadership of ``name`` for ``ttl`` seconds; False while another live process holds it."""
+        now = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO leases(name, owner, expires_at) VALUES(?, ?, ?) ON CONFLICT(name) DO UPDATE "
+            "SET owner=excluded.owner, expires_at=excluded.expires_at WHERE leases.owner=excluded.owner OR leases.expires_at<?",
+            (name, PROC_OWNER, now + ttl, now))
+        held = cur.rowcount > 0
+        METRICS.set("worker_leader", 1 if held else 0, worker=name)
+        return held
+
+    def release(self, name: str):
+        self._conn().execute("DELETE FROM leases WHERE name=? AND owner=?", (name, PROC_OWNER))
+        METRICS.set("worker_leader", 0, worker=name)
+
+    def signal(self, name: str):
+        """Wake whichever process runs the ``name`` worker; it polls ``signaled_at`` between ticks."""
+        self._conn().execute("INSERT OR REPLACE INTO signals VALUES(?, ?)", (name, time.time()))
+
+    def signaled_at(self, name: str) -> float:
+        row = self._conn().execute("SELECT ts FROM signals WHERE name=?", (name,)).fetchone()
+        return row[0] if row else 0.0
+
+    def leaders(self) -> Dict[str, Tuple[str, float]]:
+        rows = self._conn().execute("SELECT name, owner, expires_at FROM leases WHERE expires_at>=?", (time.time(),))
+        return {n: (o, e) for n, o, e in rows}
+
+STORE = SharedStore()
+
+SETTINGS_DEFAULTS = {
+    "push_cards_enabled": True, "last_notif_key": "", "notify_comments": True, "notify_mentions": True,
+    "notify_likes": True, "notify_payment_in": True, "notify_hold_released": True,
+    "notify_profile_post": True, "notify_profile_comment": True, "notify_balance": True,
+    "last_balance": None, "last_payment_op": 0,
+}
+_SETTINGS_CACHE: Tuple[Any, Dict[str, Any]] = (None, {})
+
+def _file_sig(path: str) -> Any:
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
 
 def get_settings() -> Dict[str,Any]:
+    # re-read only when the file changed; defaults are written back once, not on every call
+    global _SETTINGS_CACHE
+    sig = _file_sig(SETTINGS_FILE)
+    if sig is not None and sig == _SETTINGS_CACHE[0]:
+        return dict(_SETTINGS_CACHE[1])
     s = _load(SETTINGS_FILE, {})
-    s.setdefault("push_cards_enabled", True)
-    s.setdefault("last_notif_key", "")
-    s.setdefault("notify_comments", True)
-    s.setdefault("notify_mentions", True)
-    s.setdefault("notify_likes", True)
-    s.setdefault("notify_payment_in", True)
-    s.setdefault("notify_hold_released", True)
-    s.setdefault("notify_profile_post", True)
-    s.setdefault("notify_profile_comment", True)
-    _save(SETTINGS_FILE, s)
+    if any(k not in s for k in SETTINGS_DEFAULTS):
+        for k, v in SETTINGS_DEFAULTS.items():
+            s.setdefault(k, v)
+        _save(SETTINGS_FILE, s)
+        sig = _file_sig(SETTINGS_FILE)
+    _SETTINGS_CACHE = (sig, dict(s))
     return s
 
 def set_setting(key: str, val: Any):
-    s = get_settings(); s[key] = val; _save(SETTINGS_FILE, s)
-
-
+    with STORE.mutex("settings"):
+        s = get_settings(); s[key] = val; _save(SETTINGS_FILE, s)
+
+class BumpEntry:
+    __slots__ = ("thread_id", "interval_min", "last_bump_ts", "next_bump_ts", "fail_count", "last_error", "parked",
+                 "phase_sec", "window", "tuned_min")
+
+    def __init__(self, thread_id: int, interval_min: int = 10, last_bump_ts: int = 0, next_bump_ts: int = 0,
+                 fail_count: int = 0, last_error: str = "", parked: str = "", phase_sec: int = -1, window: str = "",
+                 tuned_min: int = 0):
+        self.thread_id = int(thread_id)
+        self.interval_min = max(5, int(interval_min))
+        self.last_bump_ts = int(last_bump_ts)
+        self.next_bump_ts = int(next_bump_ts)
+        self.fail_count = int(fail_count)
+        self.last_error = str(last_error or "")
+        self.parked = str(parked or "")
+        self.phase_sec = int(phase_sec)
+        self.window = str(window or "")
+        self.tuned_min = int(tuned_min)
+
+    @property
+    def effective_min(self) -> int:
+        return max(self.interval_min, self.tuned_min)
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> Optional["BumpEntry"]:
+        try:
+            return cls(d["thread_id"], d.get("interval_min") or 10, d.get("last_bump_ts") or 0, d.get("next_bump_ts") or 0,
+                       d.get("fail_count") or 0, d.get("last_error") or "", d.get("parked") or "",
+                       d.get("phase_sec", -1), d.get("window") or "", d.get("tuned_min") or 0)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def copy(self) -> "BumpEntry":
+        b = BumpEntry.__new__(BumpEntry)
+        for k in self.__slots__:
+            setattr(b, k, getattr(self, k))
+        return b
+
+# (file signature, validated entries, rows from_dict rejected — kept verbatim so a save never drops them)
+_BUMPS_CACHE: Tuple[Any, List[BumpEntry], List[Any]] = (None, [], [])
+
+def load_bumps() -> List[BumpEntry]:
+    """Validated once per file change. The entries are shared with the cache: read them, and change
+    them only through ``mutate_bumps``."""
+    global _BUMPS_CACHE
+    sig = _file_sig(BUMPS_FILE)
+    if sig is None or sig != _BUMPS_CACHE[0]:
+        cfg = _load(BUMPS_FILE, {"threads": []})
+        arr = cfg.get("threads") if isinstance(cfg, dict) else None
+        entries, rejected = [], []
+        for d in arr if isinstance(arr, list) else []:
+            b = BumpEntry.from_dict(d) if isinstance(d, dict) else None
+            if b is None:
+                rejected.append(d)
+            else:
+                entries.append(b)
+        if rejected:
+            logging.warning("%s: %d invalid thread rows kept as is: %s", BUMPS_FILE, len(rejected),
+                            json.dumps(rejected, ensure_ascii=False)[:500])
+        _BUMPS_CACHE = (sig, entries, rejected)
+    return list(_BUMPS_CACHE[1])
+
+def save_bumps(entries: List[BumpEntry]):
+    global _BUMPS_CACHE
+    rejected = _BUMPS_CACHE[2]
+    _save(BUMPS_FILE, {"threads": [b.to_dict() for b in entries] + rejected})
+    _BUMPS_CACHE = (_file_sig(BUMPS_FILE), list(entries), rejected)
+
+def mutate_bumps(fn: Callable[[List[BumpEntry]], Any]) -> Any:
+    """Run ``fn`` on a fresh copy of the thread list under the shared lock and save it if it changed,
+    so the handler and bump processes never overwrite each other's edits. Keep API calls out of ``fn``."""
+    with STORE.mutex("bumps"):
+        arr = [b.copy() for b in load_bumps()]
+        before = [b.to_dict() for b in arr]
+        res = fn(arr)
+        if [b.to_dict() for b in arr] != before:
+            save_bumps(arr)
+        return res
+
+
+class NoteEntry:
+    __slots__ = ("type", "created_at", "amount", "note", "comment", "to", "invoice_id", "merchant_id", "payment_id")
+
+    def __init__(self, type: str, created_at: int, amount: Any, note: str, comment: str = "", to: Any = None,
+                 invoice_id: Optional[str] = None, merchant_id: Optional[int] = None, payment_id: Optional[str] = None):
+        self.type = type; self.created_at = int(created_at); self.amount = amount
+        self.note = note; self.comment = comment or ""; self.to = to
+        self.invoice_id = invoice_id; self.merchant_id = merchant_id; self.payment_id = payment_id
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> Optional["NoteEntry"]:
+        try:
+            return cls(d.get("type") or "transfer", d.get("created_at") or 0, d.get("amount"), str(d.get("note") or ""),
+                       d.get("comment") or "", d.get("to"), d.get("invoice_id"), d.get("merchant_id"), d.get("payment_id"))
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: v for k in self.__slots__ if (v := getattr(self, k)) is not None}
+
+def load_notes() -> List[NoteEntry]:
+    data = _load(NOTES_FILE, {"items": []})
+    arr = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(arr, list):
+        return []
+    return [n for n in map(NoteEntry.from_dict, arr) if n is not None]
+
+def append_note(entry: NoteEntry):
+    NOTES_INDEX.sync()
+    with STORE.mutex("notes"):
+        data = _load(NOTES_FILE, {"items": []})
+        if not isinstance(data, dict) or not isinstance(data.get("items"), list):
+            data = {"items": []}
+        data["items"].append(entry.to_dict())
+        _save(NOTES_FILE, data)
+        NOTES_INDEX.add(len(data["items"]) - 1, entry)
+
+NOTES_PAGE = 10
+NOTE_TOKEN_RE = re.compile(r"[^\W_]+")
+
+class NotesIndex:
+    """FTS5 index over notes.json kept in state.db. rowid = position in the file + 1; each append adds one row,
+    and the file signature stored next to it tells when the file was changed behind our back (then catch up)."""
+
+    def __init__(self, store: SharedStore):
+        self.store = store; self._ready = False
+
+    def _db(self) -> sqlite3.Connection:
+        c = self.store._conn()
+        if not self._ready:
+            c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(note, comment, counterparty, refs, doc UNINDEXED, "
+                      "tokenize='unicode61 remove_diacritics 2')")
+            c.execute("CREATE TABLE IF NOT EXISTS notes_meta (k TEXT PRIMARY KEY, v TEXT)")
+            self._ready = True
+        return c
+
+    @staticmethod
+    def _row(pos: int, n: NoteEntry) -> tuple:
+        refs = " ".join(str(x) for x in (n.invoice_id, n.payment_id, n.merchant_id, n.amount, n.type) if x not in (None, ""))
+        return pos + 1, n.note, n.comment, str(n.to or ""), refs, json.dumps(n.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+    def _mark(self, c: sqlite3.Connection):
+        c.execute("INSERT OR REPLACE INTO notes_meta VALUES('sig', ?)", (json.dumps(_file_sig(NOTES_FILE)),))
+
+    def add(self, pos: int, entry: NoteEntry):
+        c = self._db()
+        c.execute("INSERT OR REPLACE INTO notes_fts(rowid, note, comment, counterparty, refs, doc) VALUES(?, ?, ?, ?, ?, ?)", self._row(pos, entry))
+        self._mark(c)
+
+    def sync(self):
+        c = self._db()
+        row = c.execute("SELECT v FROM notes_meta WHERE k='sig'").fetchone()
+        if row and json.loads(row[0]) == (list(_file_sig(NOTES_FILE) or []) or None):
+            return
+        with self.store.mutex("notes"):
+            items = load_notes()
+            have = c.execute("SELECT coalesce(max(rowid), 0) FROM notes_fts").fetchone()[0]
+            if have > len(items):   # file cleared or replaced: start over
+                c.execute("DELETE FROM notes_fts"); have = 0
+            c.executemany("INSERT INTO notes_fts(rowid, note, comment, counterparty, refs, doc) VALUES(?, ?, ?, ?, ?, ?)",
+                          [self._row(i, n) for i, n in enumerate(items[have:], have)])
+            self._mark(c)
+            METRICS.inc("notes_index_synced_total", len(items) - have)
+
+    def clear(self):
+        c = self._db(); c.execute("DELETE FROM notes_fts"); self._mark(c)
+
+    def search(self, query: str, page: int = 0, per_page: int = NOTES_PAGE) -> Tuple[int, List[NoteEntry]]:
+        """Newest-first notes matching every word of ``query`` as a prefix; empty query lists all."""
+        self.sync()
+        c = self._db()
+        terms = NOTE_TOKEN_RE.findall(query.lower())
+        if terms:
+            match = " ".join(f'"{t}"*' for t in terms)
+            total = c.execute("SELECT count(*) FROM notes_fts WHERE notes_fts MATCH ?", (match,)).fetchone()[0]
+            rows = c.execute("SELECT doc FROM notes_fts WHERE notes_fts MATCH ? ORDER BY rowid DESC LIMIT ? OFFSET ?",
+                             (match, per_page, page * per_page)).fetchall()
+        else:
+            total = c.execute("SELECT count(*) FROM notes_fts").fetchone()[0]
+            rows = c.execute("SELECT doc FROM notes_fts ORDER BY rowid DESC LIMIT ? OFFSET ?", (per_page, page * per_page)).fetchall()
+        return total, [n for n in (NoteEntry.from_dict(json.loads(r[0])) for r in rows) if n is not None]
+
+NOTES_INDEX = NotesIndex(STORE)
+
+METRICS_HOST = (os.getenv("METRICS_HOST", "127.0.0.1") or "127.0.0.1").strip()
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108") or 0)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0)
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LATENESS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 3600)
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters: Dict[str, Dict[Tuple, float]] = {}
+        self.gauges: Dict[str, Dict[Tuple, float]] = {}
+        self.hists: Dict[str, Dict[Tuple, Dict[str, Any]]] = {}
+        # written from to_thread workers (api_req, _rl, exports) while the loop renders
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels: Dict[str, Any]) -> Tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        k = self._key(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[k] = series.get(k, 0.0) + value
+
+    def set(self, name: str, value: float, **labels):
+        k = self._key(labels)
+        with self._lock:
+            self.gauges.setdefault(name, {})[k] = float(value)
+
+    def observe(self, name: str, value: float, buckets: Tuple = LATENCY_BUCKETS, **labels):
+        k = self._key(labels)
+        with self._lock:
+            series = self.hists.setdefault(name, {})
+            h = series.get(k)
+            if h is None:
+                h = series[k] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0, "max": 0.0}
+            for i, b in enumerate(h["buckets"]):
+                if value <= b:
+                    h["counts"][i] += 1
+                    break
+            h["sum"] += value; h["count"] += 1
+            if value > h["max"]: h["max"] = value
+
+    def total(self, name: str, **match) -> float:
+        want = set(self._key(match))
+        with self._lock:
+            return sum(v for k, v in self.counters.get(name, {}).items() if want <= set(k))
+
+    def snapshot(self, kind: str, name: Optional[str] = None) -> Dict:
+        """Consistent copy of ``counters``/``gauges``/``hists`` (one metric if ``name``), safe to iterate."""
+        def cp(series: Dict[Tuple, Any]) -> Dict[Tuple, Any]:
+            return {k: ({**v, "counts": list(v["counts"])} if isinstance(v, dict) else v) for k, v in series.items()}
+        with self._lock:
+            src = getattr(self, kind)
+            if name is not None:
+                return cp(src.get(name, {}))
+            return {n: cp(series) for n, series in src.items()}
+
+    @staticmethod
+    def quantile(h: Dict[str, Any], q: float) -> float:
+        if not h or not h["count"]: return 0.0
+        rank = q * h["count"]; acc = 0
+        for b, c in zip(h["buckets"], h["counts"]):
+            acc += c
+            if acc >= rank:
+                return min(float(b), h["max"])
+        return h["max"]
+
+    def render(self) -> str:
+        def esc(v: str) -> str:
+            return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        def lbl(k: Tuple, extra: str = "") -> str:
+            parts = [f'{n}="{esc(v)}"' for n, v in k] + ([extra] if extra else [])
+            return "{" + ",".join(parts) + "}" if parts else ""
+        out: List[str] = []
+        for name, series in sorted(self.snapshot("counters").items()):
+            out.append(f"# TYPE {name} counter")
+            out += [f"{name}{lbl(k)} {v:g}" for k, v in series.items()]
+        self.set("process_uptime_seconds", time.time() - self.started_at)
+        for name, series in sorted(self.snapshot("gauges").items()):
+            out.append(f"# TYPE {name} gauge")
+            out += [f"{name}{lbl(k)} {v:g}" for k, v in series.items()]
+        for name, series in sorted(self.snapshot("hists").items()):
+            out.append(f"# TYPE {name} histogram")
+            for k, h in series.items():
+                acc = 0
+                for b, c in zip(h["buckets"], h["counts"]):
+                    acc += c
+                    le = 'le="%g"' % b
+                    out.append(f"{name}_bucket{lbl(k, le)} {acc}")
+                inf = 'le="+Inf"'
+                out.append(f"{name}_bucket{lbl(k, inf)} {h['count']}")
+                out.append(f"{name}_sum{lbl(k)} {h['sum']:g}")
+                out.append(f"{name}_count{lbl(k)} {h['count']}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+
+def _endpoint(url: str) -> str:
+    path = re.sub(r"^https?://[^/]+", "", url).split("?", 1)[0]
+    return re.sub(r"/\d+", "/{id}", path) or "/"
+
+
+RL_MIN_INTERVAL_SEC = 0.25
+RL_BACKGROUND_INTERVAL_SEC = 1.0   # background callers get at most one slot per second, and only an idle one
 _LAST_CALL = 0.0
-def _rl():
-    global _LAST_CALL
-    now = time.time(); dt = now - _LAST_CALL
-    if dt < 0.25:
-        time.sleep(0.25 - dt)
-    _LAST_CALL = time.time()
-
-def api_req(method: str, url: str, token: str, *, params: Optional[Dict[str, Any]] = None, json_: Optional[Dict[str, Any]] = None, timeout: int = 25) -> Dict[str, Any]:
-    _rl()
+_BG_NEXT = 0.0
+_RL_LOCK = threading.Lock()
+def _rl(background: bool = False):
+    # slots are reserved under the lock so concurrent to_thread callers stay spaced out;
+    # a background call never reserves ahead, so it can't push an interactive call back
+    global _LAST_CALL, _BG_NEXT
+    while True:
+        with _RL_LOCK:
+            now = time.time(); wait = _LAST_CALL + RL_MIN_INTERVAL_SEC - now
+            if not background:
+                _LAST_CALL = now + max(0.0, wait)
+                break
+            wait = max(wait, _BG_NEXT - now)
+            if wait <= 0:
+                _LAST_CALL = now; _BG_NEXT = now + RL_BACKGROUND_INTERVAL_SEC
+                return
+        METRICS.inc("lzt_ratelimit_background_wait_seconds_total", wait)
+        time.sleep(wait)
+    if wait > 0:
+        METRICS.inc("lzt_ratelimit_throttled_total")
+        METRICS.inc("lzt_ratelimit_wait_seconds_total", wait)
+        time.sleep(wait)
+
+def api_req(method: str, url: str, token: str, *, params: Any = None, json_: Optional[Dict[str, Any]] = None, timeout: int = 25,
+            background: bool = False) -> Dict[str, Any]:
+    _rl(background)
+    t0 = time.perf_counter()
+    resp = _api_call(method, url, token, params=params, json_=json_, timeout=timeout)
+    METRICS.observe("lzt_api_request_seconds", time.perf_counter() - t0, method=method, endpoint=_endpoint(url), status=resp.get("status", 0))
+    return resp
+
+def _api_call(method: str, url: str, token: str, *, params: Any = None, json_: Optional[Dict[str, Any]] = None, timeout: int = 25) -> Dict[str, Any]:
     headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
     try:
         for k, v in headers.items():
             k.encode("latin-1"); v.encode("latin-1")
     except UnicodeEncodeError as e:
         return {"ok": False, "status": 0, "error": {"message": f"Некорректный символ в заголовке HTTP: {e}. Проверь токен."}}
+    import requests  # deferred: ~50 ms of import time nobody needs before the first API call
     try:
         r = requests.request(method, url, headers=headers, params=params, json=json_, timeout=timeout)
         ct = (r.headers.get("content-type") or "")
@@ -98,7 +546,10 @@ def api_req(method: str, url: str, token: str, *, params: Optional[Dict[str, Any
         except Exception:
             body = {"raw": r.text, "status_code": r.status_code}
         if r.status_code >= 400:
-            return {"ok": False, "status": r.status_code, "error": body}
+            out = {"ok": False, "status": r.status_code, "error": body}
+            if r.headers.get("Retry-After"):
+                out["retry_after"] = r.headers["Retry-After"]
+            return out
         return {"ok": True, "status": r.status_code, "data": body}
     except requests.RequestException as e:
         return {"ok": False, "status": 0, "error": {"message": str(e)}}
@@ -106,14 +557,96 @@ def api_req(method: str, url: str, token: str, *, params: Optional[Dict[str, Any
 def market_me():
     return api_req("GET", f"{FORUM_BASE}/market/me", LZT_FORUM_TOKEN)
 
-def market_history(limit: Optional[int] = 20):
+def market_history(limit: Optional[int] = 20, operation_id_lt: Optional[int] = None):
     params = {}
     if limit: params["limit"] = limit
+    if operation_id_lt: params["operation_id_lt"] = operation_id_lt
     return api_req("GET", f"{MARKET_BASE}/user/payments", LZT_MARKET_TOKEN, params=params)
 
 def market_fee(amount: int):
     return api_req("GET", f"{MARKET_BASE}/balance/transfer/fee", LZT_MARKET_TOKEN, params={"amount": amount})
 
+FEE_CACHE_TTL = 600
+_FEE_CACHE: Dict[int, Tuple[float, int]] = {}
+
+def fee_pct(amount: int) -> int:
+    amount = int(amount)
+    hit = _FEE_CACHE.get(amount)
+    if hit and time.time() - hit[0] < FEE_CACHE_TTL:
+        return hit[1]
+    fee = market_fee(amount)
+    if not fee["ok"]:
+        return 0
+    pct = int((fee["data"] or {}).get("commission_percentage", 0) or 0)
+    _FEE_CACHE[amount] = (time.time(), pct)
+    return pct
+
+def fee_pct_cached(amount: int) -> Optional[int]:
+    hit = _FEE_CACHE.get(int(amount))
+    if hit and time.time() - hit[0] < FEE_CACHE_TTL:
+        return hit[1]
+    return None
+
+async def prefetch_fees(amounts: List[int]):
+    for a in set(int(x) for x in amounts):
+        if fee_pct_cached(a) is not None:
+            continue
+        try:
+            await asyncio.to_thread(fee_pct, a)
+        except Exception:
+            pass
+
+# responses fetched by warm_up(); the first consumer within max_age uses them instead of a round-trip
+_WARM: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+ME_WARM_TTL = 30
+PAYOUT_SERVICES_TTL = 600
+
+def take_warm(key: str, max_age: float, keep: bool = False) -> Optional[Dict[str, Any]]:
+    hit = _WARM.get(key) if keep else _WARM.pop(key, None)
+    if hit and time.time() - hit[0] < max_age:
+        return hit[1]
+    return None
+
+PAYOUT_CATALOG_KEEP = 5  # versions kept, so a form opened before a refresh still resolves its picks
+
+def _catalog_db() -> sqlite3.Connection:
+    c = STORE._conn()
+    c.execute("CREATE TABLE IF NOT EXISTS payout_catalog (digest TEXT PRIMARY KEY, fetched_at REAL NOT NULL, body BLOB NOT NULL)")
+    return c
+
+def payout_services_cached() -> Dict[str, Any]:
+    """Blocking. ``{"ok", "digest", "systems"}`` for the current payout catalog, or the API error. The catalog
+    lives in state.db keyed by digest: every role process shares it and it survives restarts."""
+    c = _catalog_db()
+    row = c.execute("SELECT digest, fetched_at, body FROM payout_catalog ORDER BY fetched_at DESC LIMIT 1").fetchone()
+    if row and time.time() - row[1] < PAYOUT_SERVICES_TTL:
+        return {"ok": True, "digest": row[0], "systems": _unpack(row[2]).get("systems", [])}
+    resp = market_payout_services()
+    if not resp.get("ok"):
+        return resp
+    systems = _payout_systems(resp)
+    digest = _catalog_digest(systems)
+    with STORE.mutex("payout_catalog"):
+        c.execute("INSERT OR REPLACE INTO payout_catalog VALUES(?, ?, ?)", (digest, time.time(), _pack({"systems": systems})))
+        c.execute("DELETE FROM payout_catalog WHERE digest NOT IN "
+                  "(SELECT digest FROM payout_catalog ORDER BY fetched_at DESC LIMIT ?)", (PAYOUT_CATALOG_KEEP,))
+    return {"ok": True, "digest": digest, "systems": systems}
+
+def payout_catalog_version(digest: str) -> Optional[List[Dict[str, Any]]]:
+    """Blocking. The catalog version a form showed, by digest; None once it has been pruned."""
+    row = _catalog_db().execute("SELECT body FROM payout_catalog WHERE digest=?", (digest,)).fetchone()
+    return _unpack(row[0]).get("systems", []) if row else None
+
+async def warm_up():
+    """Fetch what the first taps need (balance, payout catalog) in parallel, off the event loop."""
+    t0 = time.perf_counter()
+    jobs = {"market_me": market_me, "payout_services": payout_services_cached}
+    res = await asyncio.gather(*(asyncio.to_thread(fn) for fn in jobs.values()), return_exceptions=True)
+    if isinstance(res[0], dict) and res[0].get("ok"):
+        _WARM["market_me"] = (time.time(), res[0])
+    METRICS.observe("startup_warmup_seconds", time.perf_counter() - t0, buckets=LATENCY_BUCKETS)
+    mark_startup("warmup")
+
 def market_transfer(*, user_id: Optional[int]=None, username: Optional[str]=None, amount: int, comment: str = "", hold_value: Optional[int]=None, hold_option: Optional[str]=None):
     payload: Dict[str, Any] = {"amount": int(amount), "currency": "rub"}
     if user_id is not None:
@@ -149,11 +682,18 @@ def forum_notifications(limit: Optional[int] = 20):
 def thread_bump(thread_id: int):
     return api_req("POST", f"{FORUM_BASE}/threads/{thread_id}/bump", LZT_FORUM_TOKEN)
 
-def _ts(sec: int) -> str:
-    try:
-        return datetime.fromtimestamp(sec).strftime("%d.%m %H:%M")
-    except Exception:
-        return str(sec)
+def thread_get(thread_id: int):
+    return api_req("GET", f"{FORUM_BASE}/threads/{thread_id}", LZT_FORUM_TOKEN)
+
+def market_search(category: str, params: List[Tuple[str, str]]):
+    # background lane: polling saved searches must never delay a transfer
+    return api_req("GET", f"{MARKET_BASE}/{category}".rstrip("/") + "/", LZT_MARKET_TOKEN, params=params, background=True)
+
+def forum_user_get(user_id: int):
+    return api_req("GET", f"{FORUM_BASE}/users/{user_id}", LZT_FORUM_TOKEN)
+
+def forum_user_find(username: str):
+    return api_req("GET", f"{FORUM_BASE}/users/find", LZT_FORUM_TOKEN, params={"username": username})
 
 def _plural(n: int, one: str, few: str, many: str) -> str:
     n = abs(int(n)); n10 = n % 10; n100 = n % 100
@@ -166,254 +706,232 @@ def human_hold(value: Optional[int], unit: Optional[str]) -> str:
     u = {"hour": ("час", "часа", "часов"), "day": ("день", "дня", "дней"), "week": ("неделя", "недели", "недель"), "month": ("месяц", "месяца", "месяцев")}.get(unit, ("секунда","секунды","секунд"))
     return f"{value} {_plural(value, *u)}"
 
-def normalize_url(u: str) -> str:
-    u = (u or "").strip()
-    return u.replace("prod-api.lolz.live", "lolz.live")
-
-ANCHOR_RE = re.compile(r'<a[^>]+href=(?P<q>[\'"])(?P<href>.*?)(?P=q)[^>]*>(?P<text>.*?)</a>', re.IGNORECASE | re.DOTALL)
-
-def _clean_text(s: str) -> str:
-    s = re.sub(r"</?(br|p|li|ul|ol|div)[^>]*>", "\n", s, flags=re.IGNORECASE)
-    s = re.sub(r"<[^>]+>", "", s)
-    s = _html.unescape(s)
-    s = s.replace("prod-api.lolz.live", "lolz.live")
-    s = re.sub(r"[ \t]+\n", "\n", s)
-    s = re.sub(r"\n{3,}", "\n\n", s)
-    s = re.sub(r"[ \t]{2,}", " ", s).strip()
-    return s
-
-def _hash_notif(item: dict) -> str:
-    nid = str(item.get("notification_id") or "")
-    if nid: return "id:" + nid
-    raw = f"{item.get('notification_create_date','')}-{item.get('notification_html','')}"
-    return "h:" + hashlib.md5(raw.encode("utf-8", errors="ignore")).hexdigest()
-
-def _extract_amount(text: str) -> Optional[str]:
-    m = re.search(r'(\d[\d\s.,]*)\s*₽', text.replace('\xa0',' '))
-    if not m: return None
-    amt = m.group(1).replace(' ', '')
-    return amt
-
-def _grab_hold_deadline(text: str) -> Optional[str]:
-    txt = _clean_text(text)
-    m = re.search(r'(Холд\s+(?:закончится|до)\s+[^\n]+)', txt, re.IGNORECASE)
-    return m.group(1) if m else None
-
-def parse_notif(html: str, content: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    out = {
-        "actor_name": "", "actor_url": "", "action": "", "type": "other",
-        "thread_title": "", "thread_url": "", "thread_id": None,
-        "post_id": None, "post_url": "", "snippet": ""
-    }
-
-    c = content or {}
-    actor_obj = (c.get("actor") or c.get("user") or c.get("from_user")
-                 or c.get("author") or c.get("sender") or {})
-    if isinstance(actor_obj, dict):
-        out["actor_name"] = actor_obj.get("username") or actor_obj.get("name") or out["actor_name"]
-        uid = actor_obj.get("user_id") or actor_obj.get("id")
-        if uid:
-            out["actor_url"] = f"{SITE_FORUM}/members/{uid}"
-
-    thread = c.get("thread") or {}
-    post   = c.get("post") or c.get("comment") or {}
-    if isinstance(thread, dict):
-        out["thread_title"] = thread.get("title") or out["thread_title"]
-        tid = thread.get("thread_id") or thread.get("id")
-        if tid:
-            out["thread_id"] = int(tid)
-            out["thread_url"] = f"{SITE_FORUM}/threads/{tid}/"
-    if isinstance(post, dict):
-        pid = post.get("post_id") or post.get("comment_id") or post.get("id")
-        if pid:
-            out["post_id"] = int(pid)
-            out["post_url"] = post.get("permalink") or f"{SITE_FORUM}/posts/{pid}/"
-        body = post.get("body") or post.get("message") or post.get("text") or ""
-        body = _clean_text(body)
-        if body:
-            out["snippet"] = (body[:300]).strip()
-
-    raw_html = html or ""
-    if raw_html:
-        norm = raw_html.replace("\u2009", " ").replace("\xa0", " ")
-        anchors = list(ANCHOR_RE.finditer(norm))
-
-        if not out["actor_url"] or not out["actor_name"]:
-            member_links = []
-            for m in anchors:
-                href = normalize_url(m.group("href") or "")
-                if re.search(r"/members/\d+", href):
-                    member_links.append((m.start(), href, _clean_text(m.group("text") or "")))
-            raw_lower = _clean_text(norm).lower()
-            verb_pat = re.compile(
-                r"(упомянул\(а\)|упомянул|прокомментировал\(а\)|прокомментировал|"
-                r"нравится ваше сообщение|нравится ваш комментарий|написал\(а\) сообщение в вашем профиле)"
-            )
-            mv = verb_pat.search(raw_lower)
-            verb_idx = mv.start() if mv else None
-
-            chosen = None
-            if member_links:
-                if verb_idx is not None:
-                    before = [x for x in member_links if x[0] < verb_idx]
-                    if before:
-                        chosen = before[-1]          
-                if not chosen:
-                    chosen = member_links[0]        
-
-            if chosen:
-                _, href, text = chosen
-                out["actor_url"] = href
-                out["actor_name"] = text or out["actor_name"]
-
-            if (not out["actor_url"] or not out["actor_name"]) and anchors:
-                out["actor_url"] = normalize_url(anchors[0].group("href") or "")
-                out["actor_name"] = _clean_text(anchors[0].group("text") or "") or out["actor_name"] or "Пользователь"
-
-        if not out["thread_url"] and anchors:
-            for m in anchors:
-                href = normalize_url(m.group("href"))
-                if re.search(r"/threads/(\d+)", href):
-                    out["thread_url"] = href
-                    title_text = _clean_text((m.group("text") or "")).strip()
-                    if title_text:
-                        out["thread_title"] = out["thread_title"] or title_text
-                    mm = re.search(r"/threads/(\d+)", href)
-                    if mm:
-                        out["thread_id"] = int(mm.group(1))
-                    break
-
-        if not out["post_url"] and anchors:
-            for m in anchors:
-                href = normalize_url(m.group("href"))
-                if (re.search(r"/posts/(comments/)?\d+/?$", href) or
-                    re.search(r"#post-\d+$", href) or
-                    re.search(r"/profile-posts(/comments)?/\d+/?$", href)):
-                    out["post_url"] = href
-                    break
-
-        mm = re.search(r"/threads/(\d+)/#post-(\d+)", norm)
-        if mm and not out["post_url"]:
-            out["thread_id"] = out["thread_id"] or int(mm.group(1))
-            out["post_id"] = int(mm.group(2))
-            out["thread_url"] = out["thread_url"] or f"{SITE_FORUM}/threads/{out['thread_id']}/"
-            out["post_url"]   = f"{SITE_FORUM}/posts/{out['post_id']}/"
-
-        raw = _clean_text(norm).lower()
-        def has(parts: List[str]) -> bool:
-            return any(p in raw for p in parts)
-
-        if not out["action"] or out["type"] in {"other", ""}:
-            if has(["холд на платеж", "холд закончился", "холд по платежу снят", "холд завершился"]):
-                out["type"], out["action"] = "hold_released", "холд закончился"
-            elif "нравится ваше сообщение" in raw or "нравится ваш комментарий" in raw:
-                out["type"], out["action"] = "like", "поставил(а) ❤️ либо 👍 вашему сообщению"
-            elif has(["упомянул(а) вас", "упомянул вас", "упомянул(а) в сообщении"]):
-                out["type"], out["action"] = "mention", "упомянул(а) вас"
-            elif has(["прокомментировал(а) ваше сообщение", "прокомментировал ваше сообщение"]):
-                out["type"], out["action"] = "comment", "прокомментировал(а) ваше сообщение"
-            elif has(["прокомментировал(а) запись в вашем профиле", "прокомментировал вашу запись на стене", "вашей записи на стене", "запись в вашем профиле"]):
-                out["type"], out["action"] = "profile_comment", "прокомментировал(а) запись в вашем профиле"
-            elif has(["написал(а) на вашей стене", "оставил(а) сообщение в вашем профиле", "сообщение на вашей стене"]):
-                out["type"], out["action"] = "profile_post", "написал(а) сообщение в вашем профиле"
-            elif has(["зачислены на ваш баланс", "пополнение баланса", "получен платеж"]):
-                out["type"], out["action"] = "payment_in", "зачисление на баланс"
-            elif has(["отправил(а) вам", "перевёл вам", "перевел вам"]):
-                if "холд закончится" in raw or "установлен холд" in raw or "холд до" in raw:
-                    out["type"], out["action"] = "transfer_in_hold", "перевёл(а) вам"
-                else:
-                    out["type"], out["action"] = "transfer_in", "перевёл(а) вам"
-            else:
-                out["type"], out["action"] = "other", _clean_text(norm)
-
-        if not out["snippet"]:
-            m_snip = re.search(r'<div[^>]+class="[^"]*\bcontentRow-snippet\b[^"]*"[^>]*>(.*?)</div>', norm, re.IGNORECASE | re.DOTALL)
-            if m_snip:
-                out["snippet"] = _clean_text(m_snip.group(1))[:300].strip()
-        if not out["snippet"]:
-            m_msg = re.search(r'<(div|article)[^>]+class="[^"]*(message-body|message-content|message-cell|bbWrapper|bbCodeBlock-content)[^"]*"[^>]*>(.*?)</\1>', norm, re.IGNORECASE | re.DOTALL)
-            if m_msg:
-                out["snippet"] = _clean_text(m_msg.group(3))[:300].strip()
-        if not out["snippet"]:
-            m_bq = re.search(r'<blockquote[^>]*>(.*?)</blockquote>', norm, re.IGNORECASE | re.DOTALL)
-            if m_bq:
-                out["snippet"] = _clean_text(m_bq.group(1))[:300].strip()
-        if not out["snippet"]:
-            all_quotes = re.findall(r'«([^»]{1,300})»', _clean_text(norm))
-            if all_quotes:
-                q_candidates = [q.strip() for q in all_quotes
-                                if q.strip() and q.strip() != (out.get("thread_title") or "").strip()]
-                if q_candidates:
-                    out["snippet"] = max(q_candidates, key=len)
-
-        if out["type"] in {"transfer_in", "transfer_in_hold", "hold_released", "payment_in"}:
-            amt = _extract_amount(_clean_text(html or ""))
-            if amt:
-                if out["type"] in {"transfer_in", "transfer_in_hold"}:
-                    out["action"] = f"перевёл(а) вам +{amt} ₽" + (" (холд)" if out["type"] == "transfer_in_hold" else "")
-                elif out["type"] == "hold_released":
-                    out["snippet"] = out["snippet"] or f"Сумма: {amt} ₽"
-                elif out["type"] == "payment_in":
-                    out["snippet"] = out["snippet"] or f"Сумма: +{amt} ₽"
-            if out["type"] == "transfer_in_hold":
-                hold_line = _grab_hold_deadline(html)
-                if hold_line:
-                    out["snippet"] = hold_line
-
-        if out["snippet"] and out["snippet"].strip() == (out.get("thread_title") or "").strip():
-            out["snippet"] = ""
-
-    out["actor_name"] = out["actor_name"] or "Пользователь"
-    return out
-
-
-
-def _a(name: str, url: str) -> str:
-    if url and name:
-        return f'<a href="{url}">{_html.escape(name)}</a>'
-    return _html.escape(name or "Пользователь")
-
-def _action_prefix(t: str) -> str:
-    return {
-        "like": "❤️",
-        "comment": "💬",
-        "mention": "🏷️",
-        "payment_in": "✅",
-        "transfer_in": "💵",
-        "transfer_in_hold": "💵",
-        "hold_released": "🟢",
-        "profile_post": "🧱",
-        "profile_comment": "🧩"
-    }.get(t, "🔔")
-
-def render_notif_line(item: dict, content: Optional[Dict[str, Any]] = None) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
-    dt = _ts(int(item.get("notification_create_date", 0)))
-    m = parse_notif(item.get("notification_html", "") or "", content)
-    actor = _a(m.get("actor_name") or "", m.get("actor_url") or "")
-    icon  = _action_prefix(m.get("type") or "other")
-    lines: List[str] = [f"🕒 {dt}", f"{icon} {actor} {m.get('action') or ''}".strip()]
-    if (m.get("thread_title") or "").strip():
-        lines.append(f"🧵 <a href=\"{m['thread_url']}\">{_html.escape(m['thread_title'])}</a>")
-    if m.get("snippet"):
-        lines.append(f"«{_html.escape(m['snippet'])}»")
-
-    kb = None
+def _notif_kb(buttons: List[Tuple[str, str]]) -> Optional[InlineKeyboardMarkup]:
+    if not buttons:
+        return None
     kbldr = InlineKeyboardBuilder()
-    if m.get("post_url"):
-        kbldr.button(text="К записи" if (m.get("type") in {"profile_post","profile_comment"}) else "К сообщению", url=m["post_url"])
-    if m.get("thread_url"):
-        kbldr.button(text="К теме", url=m["thread_url"])
-    if kbldr.buttons:
-        kbldr.adjust(2)
-        kb = kbldr.as_markup()
-    return "\n".join([s for s in lines if s.strip()]), kb
+    for text, url in buttons:
+        kbldr.button(text=text, url=url)
+    kbldr.adjust(2)
+    return kbldr.as_markup()
+
+# thread by default: spawn/forkserver re-import the entry script as __mp_main__, so a process pool costs one more
+# full load of the bot (aiogram, .env, STORE) in the forkserver — worth it only for really large batches
+OFFLOAD_MODE = (os.getenv("OFFLOAD_MODE", "thread") or "thread").lower()   # thread | process | inline
+OFFLOAD_MIN_ITEMS = int(os.getenv("OFFLOAD_MIN_ITEMS", "4") or 4)
+OFFLOAD_MIN_BYTES = int(os.getenv("OFFLOAD_MIN_BYTES", "16384") or 16384)
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", "0") or 0) or min(4, os.cpu_count() or 1)
+
+class Offloader:
+    """Runs batches of CPU-bound jobs inline when small, otherwise split across a thread (or process) pool
+    so parsing never holds the event loop. Jobs live in notif_parse, which imports nothing from the bot.
+    The pool is created on first use and dropped if it breaks."""
+
+    def __init__(self, mode: str = OFFLOAD_MODE, min_items: int = OFFLOAD_MIN_ITEMS, min_bytes: int = OFFLOAD_MIN_BYTES,
+                 workers: int = OFFLOAD_WORKERS):
+        self.mode = mode if mode in ("process", "thread", "inline") else "thread"
+        self.min_items = min_items; self.min_bytes = min_bytes; self.workers = max(1, workers)
+        self._pool = None
+
+    def pool(self):
+        if self._pool is None:
+            from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+            if self.mode == "process":
+                try:
+                    import multiprocessing as mp
+                    # forkserver/spawn: never fork the bot itself, it has live threads and sockets
+                    ctx = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+                except (OSError, ImportError, NotImplementedError, ValueError) as e:
+                    logging.warning("process pool unavailable (%s), offloading to threads", e)
+                    self.mode = "thread"
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="offload")
+        return self._pool
+
+    def inline(self, n_items: int, n_bytes: int) -> bool:
+        return self.mode == "inline" or (n_items < self.min_items and n_bytes < self.min_bytes)
+
+    async def map_chunks(self, fn: Callable[[list], list], jobs: list, n_bytes: int) -> list:
+        if not jobs:
+            return []
+        if self.inline(len(jobs), n_bytes):
+            METRICS.inc("offload_batches_total", mode="inline")
+            return fn(jobs)
+        loop = asyncio.get_running_loop()
+        n = min(self.workers, len(jobs))
+        chunks = [jobs[i::n] for i in range(n)]
+        t0 = time.perf_counter()
+        try:
+            parts = await asyncio.gather(*(loop.run_in_executor(self.pool(), fn, c) for c in chunks))
+        except Exception as e:  # BrokenProcessPool, pickling errors: fall back for this batch, rebuild next time
+            logging.warning("offload failed (%s: %s), running inline", type(e).__name__, e)
+            METRICS.inc("offload_failures_total", mode=self.mode)
+            self.shutdown()
+            return fn(jobs)
+        METRICS.inc("offload_batches_total", mode=self.mode)
+        METRICS.observe("offload_batch_seconds", time.perf_counter() - t0, mode=self.mode)
+        out: list = [None] * len(jobs)
+        for i, part in enumerate(parts):
+            out[i::n] = part
+        return out
+
+    async def warm(self):
+        if self.mode != "inline":
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self.pool(), _pool_ready) for _ in range(self.workers)),
+                                 return_exceptions=True)
+
+    def shutdown(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+OFFLOAD = Offloader()
+
+async def render_notifs(items: List[dict], contents: List[Optional[Dict[str, Any]]], allowed: Optional[set] = None) -> list:
+    """[(ParsedNotif, text, kb)] for each item; text is None for types outside ``allowed``.
+    Workers return plain (text, url) buttons, the keyboard is built here: they never import aiogram."""
+    n_bytes = sum(len(it.get("notification_html") or "") for it in items)
+    done = await OFFLOAD.map_chunks(_render_chunk, [(it, c, allowed) for it, c in zip(items, contents)], n_bytes)
+    return [(parsed, text, _notif_kb(buttons)) for parsed, text, buttons in done]
+
+NOTIF_ARCHIVE_DAYS = int(os.getenv("NOTIF_ARCHIVE_DAYS", "90") or 0)
+NOTIF_ARCHIVE_MAX_ROWS = int(os.getenv("NOTIF_ARCHIVE_MAX_ROWS", "200000") or 0)
+FIND_PAGE = 10
+FIND_SCAN_LIMIT = 20000
+# preset dictionary for the per-record zlib stream: records are ~300 bytes, too small to compress on their own.
+# Changing it breaks old rows — add a new version byte instead.
+_ARCHIVE_ZDICT = ('{"actor_name":"","actor_url":"https://lolz.live/members/","action":"","type":"other","thread_title":"",'
+                  '"thread_url":"https://lolz.live/threads/","thread_id":null,"post_id":null,"post_url":"https://lolz.live/posts/",'
+                  '"snippet":"","notification_id":"mention","comment","like","payment_in","transfer_in","hold_released",'
+                  '"profile_post","упомянул(а) вас","нравится ваше сообщение","прокомментировал(а)","ответил(а) в теме",'
+                  '"отправил(а) вам","₽"}').encode("utf-8")
+
+def _pack(d: Dict[str, Any]) -> bytes:
+    z = zlib.compressobj(9, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY, _ARCHIVE_ZDICT)
+    return b"\x01" + z.compress(json.dumps(d, ensure_ascii=False, separators=(",", ":")).encode("utf-8")) + z.flush()
+
+def _unpack(blob: bytes) -> Dict[str, Any]:
+    if blob[:1] != b"\x01":
+        return {}
+    z = zlib.decompressobj(15, _ARCHIVE_ZDICT)
+    return json.loads(z.decompress(blob[1:]) + z.flush())
+
+class NotifArchive:
+    """Every parsed notification, compressed, in state.db. Indexed columns cover the /find filters
+    (type, actor, thread, date); retention by age and row count is enforced every PRUNE_EVERY inserts."""
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, store: SharedStore):
+        self.store = store; self._ready = False; self._since_prune = self.PRUNE_EVERY
+
+    def _db(self) -> sqlite3.Connection:
+        c = self.store._conn()
+        if not self._ready:
+            c.execute("CREATE TABLE IF NOT EXISTS notif_archive (nkey TEXT PRIMARY KEY, ts INTEGER NOT NULL, type TEXT NOT NULL, "
+                      "actor TEXT NOT NULL, thread_id INTEGER, delivered INTEGER NOT NULL, body BLOB NOT NULL)")
+            for col in ("ts", "type, ts", "actor, ts", "thread_id, ts"):
+                c.execute(f"CREATE INDEX IF NOT EXISTS notif_archive_{col.split(',')[0]} ON notif_archive({col})")
+            self._ready = True
+        return c
+
+    def append(self, rows: List[Tuple[dict, ParsedNotif, bool]]):
+        if not rows:
+            return
+        c = self._db()
+        with self.store.mutex("archive"):
+            c.executemany("INSERT OR IGNORE INTO notif_archive VALUES(?, ?, ?, ?, ?, ?, ?)", [
+                (_hash_notif(it), int(it.get("notification_create_date") or time.time()), p.type or "other",
+                 (p.actor_name or "").lower(), p.thread_id, int(sent),
+                 _pack({**p.to_dict(), "notification_id": it.get("notification_id")})) for it, p, sent in rows])
+            self._since_prune += len(rows)
+            if self._since_prune >= self.PRUNE_EVERY:
+                self._since_prune = 0
+                self.prune(c)
+        METRICS.inc("notif_archived_total", len(rows))
+
+    def prune(self, c: sqlite3.Connection):
+        n = 0
+        if NOTIF_ARCHIVE_DAYS:
+            n += c.execute("DELETE FROM notif_archive WHERE ts<?", (int(time.time()) - NOTIF_ARCHIVE_DAYS * 86400,)).rowcount
+        if NOTIF_ARCHIVE_MAX_ROWS:
+            n += c.execute("DELETE FROM notif_archive WHERE ts<(SELECT ts FROM notif_archive ORDER BY ts DESC LIMIT 1 OFFSET ?)",
+                           (NOTIF_ARCHIVE_MAX_ROWS - 1,)).rowcount
+        if n:
+            METRICS.inc("notif_archive_pruned_total", n)
+
+    def find(self, q: Dict[str, Any], page: int = 0, per_page: int = FIND_PAGE) -> Tuple[int, List[Tuple[int, bool, Dict[str, Any]]]]:
+        """(matches seen, [(ts, delivered, record)]) newest first. Indexed filters narrow the rows;
+        free-text words are then checked against the decompressed record, scanning at most FIND_SCAN_LIMIT rows."""
+        where, args = [], []
+        for col, key in (("type", "type"), ("actor", "actor"), ("thread_id", "thread_id")):
+            if q.get(key) is not None:
+                where.append(f"{col}=?"); args.append(q[key])
+        if q.get("since"):
+            where.append("ts>=?"); args.append(q["since"])
+        sql = "FROM notif_archive" + (" WHERE " + " AND ".join(where) if where else "")
+        c = self._db()
+        words = q.get("words") or []
+        if not words:
+            total = c.execute(f"SELECT count(*) {sql}", args).fetchone()[0]
+            rows = c.execute(f"SELECT ts, delivered, body {sql} ORDER BY ts DESC LIMIT ? OFFSET ?", (*args, per_page, page * per_page))
+            return total, [(ts, bool(d), _unpack(b)) for ts, d, b in rows]
+        out, total = [], 0
+        for ts, d, b in c.execute(f"SELECT ts, delivered, body {sql} ORDER BY ts DESC LIMIT ?", (*args, FIND_SCAN_LIMIT)):
+            rec = _unpack(b)
+            hay = " ".join(str(rec.get(k) or "") for k in ("actor_name", "action", "thread_title", "snippet")).lower()
+            if all(w in hay for w in words):
+                if page * per_page <= total < (page + 1) * per_page:
+                    out.append((ts, bool(d), rec))
+                total += 1
+        return total, out
+
+NOTIF_ARCHIVE = NotifArchive(STORE)
+
+FIND_SINCE_RE = re.compile(r"(\d+)([dhw])")
+
+def parse_find_query(text: str, now: Optional[int] = None) -> Dict[str, Any]:
+    """``type:mention @actor thread:123 since:7d|2026-10-01|01.10 free words`` → filter dict."""
+    now = now or int(time.time())
+    q: Dict[str, Any] = {"words": []}
+    for tok in text.split():
+        key, _, val = tok.partition(":")
+        key = key.lower()
+        if tok.startswith("@") and len(tok) > 1:
+            q["actor"] = tok[1:].lower()
+        elif val and key in ("type", "тип"):
+            q["type"] = val.lower()
+        elif val and key in ("actor", "от"):
+            q["actor"] = val.lstrip("@").lower()
+        elif val and key in ("thread", "тема"):
+            q["thread_id"] = parse_thread_id(val)
+        elif val and key in ("since", "с"):
+            m = FIND_SINCE_RE.fullmatch(val.lower())
+            if m:
+                q["since"] = now - int(m.group(1)) * {"h": 3600, "d": 86400, "w": 604800}[m.group(2)]
+            else:
+                for fmt in ("%Y-%m-%d", "%d.%m.%Y", "%d.%m"):
+                    try:
+                        dt = datetime.strptime(val, fmt)
+                        if fmt == "%d.%m":
+                            dt = dt.replace(year=datetime.fromtimestamp(now).year)
+                        q["since"] = int(dt.timestamp()); break
+                    except ValueError:
+                        continue
+        else:
+            q["words"].append(tok.lower())
+    return q
 
 
 def _onoff(flag: bool) -> str:
     return "Вкл" if flag else "Выкл"
 
-def kb_main() -> InlineKeyboardMarkup:
+def kb_main(save_tpl: bool = False) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
+    if save_tpl:
+        kb.button(text="💾 Сохранить как шаблон", callback_data="tpl:save")
     kb.button(text="💸 Перевод", callback_data="act:transfer")
     kb.button(text="➕ Инвойс (RUB)", callback_data="act:invoice")
     kb.button(text="🏦 Вывод", callback_data="act:payout")
@@ -421,8 +939,13 @@ def kb_main() -> InlineKeyboardMarkup:
     kb.button(text="🔔 Уведомления", callback_data="act:notifs_menu")
     kb.button(text="📌 Автоподнятие", callback_data="act:autobump")
     kb.button(text="🗒 Заметки", callback_data="act:notes")
+    kb.button(text="⭐ Шаблоны", callback_data="act:templates")
+    kb.button(text="📊 Панель", callback_data="act:dash")
     kb.button(text="❌ Закрыть", callback_data="act:cancel")
-    kb.adjust(2,2,2,2,1)
+    if save_tpl:
+        kb.adjust(1,2,2,2,2,2)
+    else:
+        kb.adjust(2,2,2,2,2)
     return kb.as_markup()
 
 def kb_form(cancel=True, back=True) -> InlineKeyboardMarkup:
@@ -441,9 +964,10 @@ def kb_notifs_menu() -> InlineKeyboardMarkup:
     kb.button(text=f"🟢 Снятие холда: {_onoff(s['notify_hold_released']).upper()}.", callback_data="notifs:t:hold_released")
     kb.button(text=f"🧱 Сообщения на стене: {_onoff(s['notify_profile_post']).upper()}.", callback_data="notifs:t:profile_post")
     kb.button(text=f"🧩 Коммент. к стене: {_onoff(s['notify_profile_comment']).upper()}.", callback_data="notifs:t:profile_comment")
+    kb.button(text=f"💰 Изменения баланса: {_onoff(s['notify_balance']).upper()}.", callback_data="notifs:t:balance")
     kb.button(text=f"{'🔔 ВКЛ. автопуш' if s.get('push_cards_enabled', True) else '🔕 ВЫКЛ. автопуш'}", callback_data="notifs:t:autopush")
     kb.button(text="🏠 Меню", callback_data="go:menu")
-    kb.adjust(1,1,1,1,1,1,1,1,1)
+    kb.adjust(1,1,1,1,1,1,1,1,1,1)
     return kb.as_markup()
 
 
@@ -456,8 +980,300 @@ class PayoutState(StatesGroup):
 class BumpState(StatesGroup):
     menu = State(); add = State(); del_ = State()
 
-bot = Bot(TG_BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher(); rt = Router(); dp.include_router(rt)
+STALL_THRESHOLD_SEC = float(os.getenv("STALL_THRESHOLD_SEC", "0.5") or 0.5)
+SLOW_HANDLER_SEC = float(os.getenv("SLOW_HANDLER_SEC", "1.0") or 1.0)
+
+def _frame_site(frame) -> str:
+    return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = STALL_THRESHOLD_SEC, interval: float = 0.1):
+        self.threshold = threshold; self.interval = interval
+        self.stalls: deque = deque(maxlen=20)
+        self._beat = time.monotonic()
+        self._loop_tid: Optional[int] = None
+        self._current: Optional[Dict[str, Any]] = None
+
+    async def heartbeat(self):
+        self._loop_tid = threading.get_ident()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            gap = time.monotonic() - self._beat - self.interval
+            if gap >= self.threshold:
+                METRICS.inc("event_loop_stalls_total")
+                METRICS.observe("event_loop_stall_seconds", gap, buckets=LAG_BUCKETS)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            blocked = time.monotonic() - self._beat
+            if blocked < self.threshold:
+                self._current = None
+                continue
+            if self._current is not None:
+                self._current["duration"] = blocked
+                continue
+            frame = sys._current_frames().get(self._loop_tid)
+            if frame is None:
+                continue
+            own, f = None, frame
+            while f is not None and own is None:
+                if f.f_code.co_filename == __file__:
+                    own = f
+                f = f.f_back
+            self._current = {
+                "ts": time.time(), "duration": blocked,
+                "where": _frame_site(frame), "own": _frame_site(own) if own else "",
+                "stack": "".join(traceback.format_stack(frame)),
+            }
+            self.stalls.append(self._current)
+            logging.warning("event loop stalled >%.2fs at %s", blocked, self._current["own"] or self._current["where"])
+
+    def stall_between(self, t0: float, t1: float) -> Optional[Dict[str, Any]]:
+        for st in reversed(self.stalls):
+            if t0 <= st["ts"] <= t1:
+                return st
+        return None
+
+WATCHDOG = LoopWatchdog()
+
+class HandlerTimer(BaseMiddleware):
+    def __init__(self, top_n: int = 10):
+        self.top_n = top_n
+        self.slowest: List[Tuple[float, int, Dict[str, Any]]] = []
+        self._seq = 0
+
+    async def __call__(self, handler, event, data):
+        if "first_update" not in STARTUP:
+            mark_startup("first_update")
+        t0 = time.perf_counter(); w0 = time.time()
+        try:
+            return await handler(event, data)
+        finally:
+            dur = time.perf_counter() - t0
+            h = data.get("handler")
+            cb = getattr(h, "callback", None)
+            if cb is not None and hasattr(cb, "__code__"):
+                name = cb.__name__
+                site = f"{os.path.basename(cb.__code__.co_filename)}:{cb.__code__.co_firstlineno}"
+            else:
+                name = "update:" + (getattr(event, "event_type", None) or type(event).__name__)
+                site = ""
+            METRICS.observe("tg_handler_seconds", dur, handler=name)
+            if dur >= SLOW_HANDLER_SEC:
+                METRICS.inc("tg_slow_handlers_total", handler=name)
+                st = WATCHDOG.stall_between(w0, time.time())
+                rec = {"ts": w0, "duration": dur, "handler": name, "site": site, "stall": (st or {}).get("own") or (st or {}).get("where") or ""}
+                self._seq += 1
+                item = (dur, self._seq, rec)
+                if len(self.slowest) < self.top_n:
+                    heapq.heappush(self.slowest, item)
+                else:
+                    heapq.heappushpop(self.slowest, item)
+
+    def report(self) -> List[Dict[str, Any]]:
+        return [x[2] for x in sorted(self.slowest, reverse=True)]
+
+HANDLER_TIMER = HandlerTimer()
+
+SHUTDOWN_DRAIN_SEC = float(os.getenv("SHUTDOWN_DRAIN_SEC", "10") or 10)
+
+class Lifecycle:
+    """Owns the background tasks: workers finish their current cycle on SIGTERM/SIGINT
+    (up to SHUTDOWN_DRAIN_SEC), everything else is cancelled, then the clean-shutdown marker is written."""
+
+    def __init__(self, drain_sec: float = SHUTDOWN_DRAIN_SEC):
+        self.drain_sec = drain_sec
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.background: set = set()
+        self.children: Dict[str, Any] = {}
+        self.hooks: List[Callable[[], Any]] = []
+        self.drains: List[Callable[[float], Any]] = []  # async, given the drain time left; run before the cancel
+        self.clean_start = False
+        self.last_stop: Dict[str, Any] = {}
+        self.marker = LIFECYCLE_FILE
+        self._stop: Optional[asyncio.Event] = None
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop is not None and self._stop.is_set()
+
+    def _event(self) -> asyncio.Event:
+        if self._stop is None:
+            self._stop = asyncio.Event()
+        return self._stop
+
+    def worker(self, name: str, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro, name=name)
+        self.workers[name] = task
+        return task
+
+    def track(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        return task
+
+    async def sleep(self, sec: float) -> bool:
+        """Sleep up to ``sec``; True means shutdown was requested and the worker should return."""
+        try:
+            await asyncio.wait_for(self._event().wait(), timeout=sec)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping
+
+    def request_stop(self, reason: str = ""):
+        if not self.stopping:
+            logging.info("shutdown requested (%s), draining workers", reason or "?")
+            self._event().set()
+
+    def spawn(self, name: str, argv: List[str], env: Dict[str, str]):
+        """Keep a child process running (restarted 5 s after an unexpected exit) until shutdown."""
+        async def supervise():
+            while not self.stopping:
+                proc = await asyncio.create_subprocess_exec(*argv, env={**os.environ, **env})
+                self.children[name] = proc
+                try:
+                    code = await proc.wait()
+                except asyncio.CancelledError:
+                    proc.kill()
+                    raise
+                if not self.stopping:
+                    METRICS.inc("child_restarts_total", role=name)
+                    logging.warning("child %s exited with %s, restarting", name, code)
+                    await self.sleep(5)
+        self.worker(f"child:{name}", supervise())
+
+    def mark_running(self, marker: str = LIFECYCLE_FILE):
+        self.marker = marker
+        prev = _load(marker, {})
+        self.last_stop = prev if isinstance(prev, dict) else {}
+        self.clean_start = bool(self.last_stop.get("clean"))
+        if not self.clean_start and self.last_stop:
+            METRICS.inc("lzt_unclean_starts_total")
+            logging.warning("previous run did not shut down cleanly (started %s)", _ts(self.last_stop.get("started_at") or 0))
+        _save(marker, {"clean": False, "pid": os.getpid(), "started_at": int(time.time())})
+
+    async def run(self, dp: Optional[Dispatcher], bot: Bot):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop, sig.name)
+            except (NotImplementedError, RuntimeError):
+                signal.signal(sig, lambda *_a, _n=sig.name: loop.call_soon_threadsafe(self.request_stop, _n))
+        if dp is None:  # worker-only process: nothing to poll
+            await self._event().wait()
+            return await self.shutdown(None, bot)
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+        stop = asyncio.create_task(self._event().wait())
+        await asyncio.wait({polling, stop}, return_when=asyncio.FIRST_COMPLETED)
+        self.request_stop("polling exited" if polling.done() else "")
+        await self.shutdown(dp, bot, polling)
+
+    async def shutdown(self, dp: Optional[Dispatcher], bot: Bot, polling: Optional[asyncio.Task] = None):
+        t0 = time.monotonic()
+        for proc in self.children.values():
+            if proc.returncode is None:
+                proc.terminate()
+        if polling is not None and not polling.done():
+            try:
+                await dp.stop_polling()
+            except RuntimeError:
+                pass
+            await asyncio.wait({polling}, timeout=self.drain_sec)
+        pending = [t for t in self.workers.values() if not t.done()]
+        left = max(0.0, self.drain_sec - (time.monotonic() - t0))
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=left)
+        cut = sorted(t.get_name() for t in pending)
+        for drain in self.drains:
+            left = max(0.0, self.drain_sec - (time.monotonic() - t0))
+            if await drain(left):
+                cut.append(getattr(drain, "__qualname__", "drain"))
+        for t in [*pending, *self.background]:
+            t.cancel()
+        await asyncio.gather(*pending, *self.background, return_exceptions=True)
+        for hook in self.hooks:
+            try:
+                hook()
+            except Exception:
+                logging.exception("shutdown hook failed")
+        _save(self.marker, {"clean": not cut, "pid": os.getpid(), "stopped_at": int(time.time()),
+                               "drain_sec": round(time.monotonic() - t0, 3), "cut": cut})
+        await bot.session.close()
+        logging.info("shutdown done in %.2fs%s", time.monotonic() - t0, f", cut: {', '.join(cut)}" if cut else "")
+
+LIFECYCLE = Lifecycle()
+
+FSM_STORAGE = (os.getenv("FSM_STORAGE", "sqlite") or "sqlite").lower()   # sqlite | memory
+FSM_TTL_SEC = int(os.getenv("FSM_TTL_SEC", str(24 * 3600)) or 0)
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage in the shared state.db: half-filled forms survive restarts and are visible to every
+    handler process; forms untouched for FSM_TTL_SEC are dropped. Data is stored as compact JSON."""
+
+    PURGE_EVERY_SEC = 600
+
+    def __init__(self, store: SharedStore, ttl: int = FSM_TTL_SEC):
+        self.store = store; self.ttl = ttl
+        self._ready = False; self._last_purge = 0.0
+
+    def _db(self) -> sqlite3.Connection:
+        c = self.store._conn()
+        if not self._ready:
+            c.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}', updated_at REAL NOT NULL)")
+            self._ready = True
+        return c
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(x) for x in (key.bot_id, key.chat_id, key.user_id, key.thread_id or "", key.business_connection_id or "", key.destiny))
+
+    def _expired_before(self) -> float:
+        return time.time() - self.ttl if self.ttl else 0.0
+
+    def _row(self, key: StorageKey) -> Optional[Tuple[Optional[str], str]]:
+        return self._db().execute("SELECT state, data FROM fsm WHERE key=? AND updated_at>=?",
+                                  (self._key(key), self._expired_before())).fetchone()
+
+    def _write(self, key: StorageKey, col: str, value: Optional[str]):
+        c = self._db(); k = self._key(key); now = time.time()
+        with self.store.mutex("fsm"):
+            c.execute("DELETE FROM fsm WHERE key=? AND updated_at<?", (k, self._expired_before()))
+            c.execute(f"INSERT INTO fsm(key, {col}, updated_at) VALUES(?, ?, ?) "
+                      f"ON CONFLICT(key) DO UPDATE SET {col}=excluded.{col}, updated_at=excluded.updated_at", (k, value, now))
+            c.execute("DELETE FROM fsm WHERE key=? AND state IS NULL AND data='{}'", (k,))
+            if self.ttl and now - self._last_purge > self.PURGE_EVERY_SEC:
+                self._last_purge = now
+                n = c.execute("DELETE FROM fsm WHERE updated_at<?", (now - self.ttl,)).rowcount
+                if n:
+                    METRICS.inc("fsm_expired_total", n)
+
+    async def set_state(self, key: StorageKey, state: Any = None) -> None:
+        self._write(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = self._row(key)
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._write(key, "data", json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = self._row(key)
+        return json.loads(row[1]) if row and row[1] else {}
+
+    async def close(self) -> None:
+        pass
+
+# built by setup_bot() at startup, not at import: worker-only processes never need a Dispatcher or FSM storage
+bot: Optional[Bot] = None
+dp: Optional[Dispatcher] = None
+rt = Router()
+# inner only: it sees the resolved handler, and one registration means one sample per update
+rt.message.middleware(HANDLER_TIMER); rt.callback_query.middleware(HANDLER_TIMER)
 
 async def guard(obj) -> bool:
     uid = obj.from_user.id
@@ -479,6 +1295,100 @@ async def on_menu(m: Message, state: FSMContext):
     if not await guard(m): return await state.clear()
     await m.answer("Главное меню.", reply_markup=kb_main())
 
+def _dur(sec: float) -> str:
+    sec = int(sec); h, rem = divmod(sec, 3600)
+    return f"{h}ч {rem // 60}м" if h else f"{rem // 60}м {rem % 60}с"
+
+STARTUP_LABELS = {"interpreter": "python", "imports": "импорты", "init": "init", "main": "main",
+                  "polling": "polling", "first_update": "1-й апдейт", "warmup": "прогрев"}
+
+def render_stats() -> str:
+    M = METRICS
+    lines = [f"📊 <b>Статистика</b> (аптайм {_dur(time.time() - M.started_at)})", "", "🌐 <b>API</b>"]
+    by_ep: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for k, h in M.snapshot("hists", "lzt_api_request_seconds").items():
+        d = dict(k); key = (d.get("method", ""), d.get("endpoint", ""))
+        agg = by_ep.setdefault(key, {"count": 0, "errors": 0, "hist": None})
+        agg["count"] += h["count"]
+        if not str(d.get("status", "")).startswith("2"):
+            agg["errors"] += h["count"]
+        if agg["hist"] is None:
+            agg["hist"] = {"buckets": h["buckets"], "counts": list(h["counts"]), "sum": h["sum"], "count": h["count"], "max": h["max"]}
+        else:
+            g = agg["hist"]
+            g["counts"] = [a + b for a, b in zip(g["counts"], h["counts"])]
+            g["sum"] += h["sum"]; g["count"] += h["count"]; g["max"] = max(g["max"], h["max"])
+    for (method, ep), agg in sorted(by_ep.items(), key=lambda x: -x[1]["count"]):
+        g = agg["hist"]
+        lines.append(f"• {method} {_html.escape(ep)} — {agg['count']} выз., p50 {M.quantile(g, 0.5):.2f}s, p99 {M.quantile(g, 0.99):.2f}s, ошибок {agg['errors']}")
+    if not by_ep:
+        lines.append("• вызовов пока не было")
+    lines.append(f"⏱ Троттлинг _rl: {M.total('lzt_ratelimit_throttled_total'):.0f} раз, {M.total('lzt_ratelimit_wait_seconds_total'):.1f}s")
+    lines += ["", "🔔 <b>Уведомления</b>"]
+    per_type: Dict[str, Dict[str, float]] = {}
+    for k, v in M.snapshot("counters", "lzt_notifications_total").items():
+        d = dict(k); per_type.setdefault(d.get("type", "other"), {})[d.get("result", "")] = v
+    for t, res in sorted(per_type.items()):
+        lines.append(f"• {t}: " + ", ".join(f"{r} {v:.0f}" for r, v in sorted(res.items())))
+    if not per_type:
+        lines.append("• пока нет")
+    late = next(iter(M.snapshot("hists", "lzt_bump_lateness_seconds").values()), None)
+    lines += ["", "⏫ <b>Автоподнятие</b>",
+              f"• ok {M.total('lzt_bumps_total', result='ok'):.0f} • err {M.total('lzt_bumps_total', result='err'):.0f}"
+              + (f" • опоздание p50 {M.quantile(late, 0.5):.0f}s, макс {late['max']:.0f}s" if late else "")]
+    lag = next(iter(M.snapshot("hists", "event_loop_lag_seconds").values()), None)
+    try:
+        leaders = STORE.leaders()
+    except sqlite3.Error:
+        leaders = {}
+    if leaders:
+        lines += ["", "👑 Лидеры: " + ", ".join(f"{n} → {o}" + (" (этот процесс)" if o == PROC_OWNER else "")
+                                               for n, (o, _e) in sorted(leaders.items()))]
+    lines += ["", "🚀 Старт: " + " → ".join(f"{STARTUP_LABELS.get(k, k)} {v:.2f}s" for k, v in sorted(STARTUP.items(), key=lambda x: x[1])),
+              f"📮 Ошибки отправки TG: {M.total('tg_send_failures_total'):.0f}",
+              f"🧵 Ошибки воркеров: {M.total('worker_errors_total'):.0f}"]
+    if lag:
+        lines.append(f"🔁 Лаг event loop: p50 {M.quantile(lag, 0.5) * 1000:.0f}ms, p99 {M.quantile(lag, 0.99) * 1000:.0f}ms, макс {lag['max'] * 1000:.0f}ms")
+    return "\n".join(lines)
+
+@rt.message(Command("stats"))
+async def on_stats(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    await m.answer(render_stats())
+
+def render_perf() -> str:
+    lines = [f"🩺 <b>Профиль</b>", f"Порог зависания: {WATCHDOG.threshold:.2f}s • медленный хендлер: ≥{SLOW_HANDLER_SEC:.2f}s",
+             f"Зависаний event loop: {METRICS.total('event_loop_stalls_total'):.0f}", "", "🧊 <b>Последние зависания</b>"]
+    for st in list(WATCHDOG.stalls)[-10:][::-1]:
+        where = st["own"] or st["where"]
+        lines.append(f"• {datetime.fromtimestamp(st['ts']).strftime('%d.%m %H:%M:%S')} — {st['duration']:.2f}s в <code>{_html.escape(where)}</code>")
+    if not WATCHDOG.stalls:
+        lines.append("• не было")
+    lines += ["", "🐢 <b>Самые медленные хендлеры</b>"]
+    for r in HANDLER_TIMER.report():
+        site = f" ({r['site']})" if r["site"] else ""
+        stall = f" • блок: <code>{_html.escape(r['stall'])}</code>" if r["stall"] else ""
+        lines.append(f"• {_html.escape(r['handler'])}{site} — {r['duration']:.2f}s{stall}")
+    if not HANDLER_TIMER.slowest:
+        lines.append("• не было")
+    lines.append("\n<i>/perf stack — стек последнего зависания, /perf reset — сбросить</i>")
+    return "\n".join(lines)
+
+@rt.message(Command("perf"))
+async def on_perf(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    arg = (m.text or "").split(maxsplit=1)[1:]
+    arg = arg[0].strip().lower() if arg else ""
+    if arg == "reset":
+        WATCHDOG.stalls.clear(); HANDLER_TIMER.slowest.clear()
+        await m.answer("🧹 Профиль сброшен."); return
+    if arg == "stack":
+        if not WATCHDOG.stalls:
+            await m.answer("Зависаний не было."); return
+        st = WATCHDOG.stalls[-1]
+        await m.answer(f"🧊 {st['duration']:.2f}s в <code>{_html.escape(st['own'] or st['where'])}</code>\n<pre>{_html.escape(st['stack'][-3500:])}</pre>"); return
+    await m.answer(render_perf())
+
 @rt.callback_query(F.data == "go:menu")
 async def go_menu(cb: CallbackQuery, state: FSMContext):
     if not await guard(cb): return await state.clear()
@@ -500,12 +1410,14 @@ async def on_cancel_root(cb: CallbackQuery, state: FSMContext):
 @rt.callback_query(F.data == "act:balance")
 async def act_balance(cb: CallbackQuery):
     if not await guard(cb): return
-    me = market_me()
+    me = take_warm("market_me", ME_WARM_TTL) or market_me()
     if me["ok"]:
         u = (me["data"] or {}).get("user", {})
         bal = u.get("balance", 0); hold = u.get("hold", 0)
         cur = (u.get("currency") or "rub").upper()
         header = f"💼 <b>Баланс</b>\nВалюта: <b>{cur}</b> • Доступно: <b>{bal}</b> • Холд: <b>{hold}</b>"
+        if HOLDS.pending("in"):
+            header += "\n🔓 Разморозится: " + " • ".join(f"{label} +{v:g}" for label, v in HOLDS.forecast())
     else:
         header = "💼 <b>Баланс</b>\n(не удалось получить /market/me)"
     hist = market_history(limit=10)
@@ -524,6 +1436,7 @@ def _notifs_header() -> str:
         f"🟢 Снятие холда: <b>{_onoff(s['notify_hold_released'])}</b>\n"
         f"🧱 Сообщения на стене: <b>{_onoff(s['notify_profile_post'])}</b>\n"
         f"🧩 Коммент. к стене: <b>{_onoff(s['notify_profile_comment'])}</b>\n"
+        f"💰 Изменения баланса: <b>{_onoff(s['notify_balance'])}</b>\n"
         f"Автопуш новых: <b>{'включён' if s.get('push_cards_enabled', True) else 'выключен'}</b>    <i>{t}</i>"
     )
 
@@ -553,6 +1466,7 @@ async def toggle_notif(cb: CallbackQuery):
             "hold_released": "notify_hold_released",
             "profile_post": "notify_profile_post",
             "profile_comment": "notify_profile_comment",
+            "balance": "notify_balance",
         }
         skey = map_keys.get(key)
         if skey:
@@ -564,24 +1478,52 @@ async def toggle_notif(cb: CallbackQuery):
     await cb.answer()
 
 
+class PaymentOp:
+    __slots__ = ("operation_id", "operation_date", "operation_type", "incoming_sum", "outgoing_sum", "username", "label")
+
+    def __init__(self, operation_id: Optional[int], operation_date: int, operation_type: str,
+                 incoming_sum: str, outgoing_sum: str, username: str, label: str):
+        self.operation_id = operation_id; self.operation_date = operation_date; self.operation_type = operation_type
+        self.incoming_sum = incoming_sum; self.outgoing_sum = outgoing_sum; self.username = username; self.label = label
+
+    @classmethod
+    def from_api(cls, d: Dict[str, Any]) -> Optional["PaymentOp"]:
+        if not isinstance(d, dict):
+            return None
+        try:
+            date = int(d.get("operation_date", 0) or 0)
+        except (TypeError, ValueError):
+            date = 0
+        oid = d.get("operation_id")
+        return cls(int(oid) if str(oid or "").isdigit() else None, date, str(d.get("operation_type") or ""),
+                   str(d.get("incoming_sum", "0") or "0"), str(d.get("outgoing_sum", "0") or "0"),
+                   str((d.get("data") or {}).get("username") or ""),
+                   str((d.get("label") or {}).get("title") or d.get("operation_type") or ""))
+
+    @property
+    def incoming(self) -> bool:
+        return bool(self.incoming_sum) and self.incoming_sum not in {"0", "0.00"}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+def parse_payments(data: Any) -> List[PaymentOp]:
+    payments = (data or {}).get("payments", {}) if isinstance(data, dict) else {}
+    if isinstance(payments, dict):
+        payments = payments.values()
+    return [p for p in map(PaymentOp.from_api, payments or []) if p is not None]
+
+def _payment_line(it: PaymentOp) -> str:
+    dt = _ts(it.operation_date)
+    user = it.username; lbl = it.label
+    add_user = user and (user not in lbl) and ("от " not in lbl) and ("кому " not in lbl)
+    if it.incoming:
+        return f"🟢 {dt} +{it.incoming_sum} — {lbl}{(' от '+user) if add_user else ''}".strip()
+    return f"🔴 {dt} -{it.outgoing_sum} — {lbl}{(' кому '+user) if add_user else ''}".strip()
+
 def render_payments_short(data: Any, n: int = 10) -> str:
-    items: List[Dict[str, Any]] = []
-    payments = (data or {}).get("payments", {})
-    for v in payments.values():
-        items.append(v)
-    items.sort(key=lambda x: x.get("operation_date", 0), reverse=True); items = items[:n]
-    lines = []
-    for it in items:
-        dt = _ts(int(it.get("operation_date", 0)))
-        incoming = it.get("incoming_sum", "0"); outgoing = it.get("outgoing_sum", "0")
-        user = (it.get("data") or {}).get("username") or ""
-        lbl = (it.get("label") or {}).get("title") or (it.get("operation_type") or "")
-        add_user = user and (user not in lbl) and ("от " not in lbl) and ("кому " not in lbl)
-        if incoming and str(incoming) != "0.00":
-            lines.append(f"🟢 {dt} +{incoming} — {lbl}{(' от '+user) if add_user else ''}".strip())
-        else:
-            lines.append(f"🔴 {dt} -{outgoing} — {lbl}{(' кому '+user) if add_user else ''}".strip())
-    return "\n".join(lines) if lines else "Пока нет операций."
+    items = heapq.nlargest(n, parse_payments(data), key=lambda x: x.operation_date)
+    return "\n".join(map(_payment_line, items)) if items else "Пока нет операций."
 
 class TransferState(StatesGroup):
     ident = State(); amount = State(); comment = State(); hold = State(); note = State()
@@ -596,20 +1538,18 @@ class BumpState(StatesGroup):
 async def act_payout(cb: CallbackQuery, state: FSMContext):
     if not await guard(cb): return await state.clear()
     await state.set_state(PayoutState.service_pick)
-    services = market_payout_services()
+    services = await asyncio.to_thread(payout_services_cached)
     if services["ok"]:
-        systems = services["data"].get("systems", services["data"])
-        lines, mapping = [], {}
-        if isinstance(systems, dict):
-            systems = list(systems.values())
+        systems = services["systems"]
+        lines = []
         for i, s in enumerate(systems, 1):
             title = s.get("title") or s.get("system") or s.get("payment_system") or "сервис"
-            code = next((s.get(k) for k in ("payment_system","system","code","slug","system_code") if s.get(k)), None) or (s.get("id") and str(s["id"])) or f"svc{i}"
+            code = _payout_code(s, i)
             minv = s.get("min") or s.get("min_sum") or "?"
             maxv = s.get("max") or s.get("max_sum") or "?"
             lines.append(f"{i}. {title} — code: <code>{code}</code> • мин: {minv} • макс: {maxv}")
-            mapping[str(i)] = s; mapping[str(str(code).lower())] = s; mapping[str(title).lower()] = s
-        await state.update_data(_payout_map=mapping)
+        # the catalog stays in state.db; the form only remembers which version it showed
+        await state.update_data(_payout_catalog=services["digest"])
         txt = "🏦 <b>Сервисы вывода</b>\nПришли номер, code или название из списка.\n\n" + "\n".join(lines[:120])
         try:
             await cb.message.edit_text(txt, reply_markup=kb_form())
@@ -619,17 +1559,43 @@ async def act_payout(cb: CallbackQuery, state: FSMContext):
         await cb.message.answer(fmt_err("Сервисы вывода", services), reply_markup=kb_form())
     await cb.answer()
 
+def _payout_systems(services: Dict[str, Any]) -> List[Dict[str, Any]]:
+    systems = services["data"].get("systems", services["data"])
+    if isinstance(systems, dict):
+        systems = list(systems.values())
+    return [s for s in systems if isinstance(s, dict)] if isinstance(systems, list) else []
+
+def _payout_code(s: Dict[str, Any], i: int) -> str:
+    return next((s.get(k) for k in ("payment_system","system","code","slug","system_code") if s.get(k)), None) or (s.get("id") and str(s["id"])) or f"svc{i}"
+
+def _catalog_digest(systems: List[Dict[str, Any]]) -> str:
+    return hashlib.md5("|".join(str(_payout_code(s, i)) for i, s in enumerate(systems, 1)).encode("utf-8")).hexdigest()[:12]
+
+def _payout_lookup(systems: List[Dict[str, Any]], key: str) -> Optional[Dict[str, Any]]:
+    """Number from the list, code or exact title (case-insensitive) — same keys the list shows."""
+    if key.isdigit() and 1 <= int(key) <= len(systems):
+        return systems[int(key) - 1]
+    for i, s in enumerate(systems, 1):
+        title = s.get("title") or s.get("system") or s.get("payment_system") or "сервис"
+        if key in (str(_payout_code(s, i)).lower(), str(title).lower()):
+            return s
+    return None
+
 @rt.message(PayoutState.service_pick)
 async def payout_pick(m: Message, state: FSMContext):
     if not await guard(m): return
     s = (m.text or "").strip().lower()
-    svc = (await state.get_data()).get("_payout_map", {}).get(s)
+    digest = (await state.get_data()).get("_payout_catalog") or ""
+    systems = await asyncio.to_thread(payout_catalog_version, digest)
+    if systems is None:
+        await m.reply("⚠️ Список сервисов обновился — открой «🏦 Вывод» заново.", reply_markup=kb_main()); await state.clear(); return
+    svc = _payout_lookup(systems, s)
     if not svc:
         await m.reply("⚠️ Не нашёл сервис. Введи номер из списка, code или точное название.", reply_markup=kb_form()); return
     code = next((svc.get(k) for k in ("payment_system","system","code","slug","system_code") if svc.get(k)), None)
-    await state.update_data(_svc=svc, _ps_code=code, _svc_id=svc.get("id"))
-    await state.set_state(PayoutState.amount)
     title = svc.get('title') or svc.get('system') or svc.get('payment_system') or 'сервис'
+    await state.update_data(_svc_title=title, _ps_code=code, _svc_id=svc.get("id"))
+    await state.set_state(PayoutState.amount)
     await m.answer(f"✅ Выбран: <b>{title}</b> (code: <code>{code}</code>)\n\n💵 Введи сумму для вывода:", reply_markup=kb_form())
 
 @rt.message(PayoutState.amount)
@@ -680,7 +1646,13 @@ async def payout_extra(m: Message, state: FSMContext):
         resp = market_create_payout(int(data["_svc_id"]), float(data["_amount"]), reqs)
     await state.clear()
     if resp["ok"]:
-        await m.answer("✅ Вывод создан.", reply_markup=kb_main())
+        _last_ops[m.from_user.id] = {
+            "kind": "payout", "ps_code": data.get("_ps_code"), "svc_id": data.get("_svc_id"),
+            "svc_title": data.get("_svc_title") or data.get("_ps_code") or "сервис",
+            "wallet": data["_wallet"], "amount": float(data["_amount"]),
+            "include_fee": bool(data.get("_include_fee", False)), "extra": extra,
+        }
+        await m.answer("✅ Вывод создан.", reply_markup=kb_main(save_tpl=True))
     else:
         await m.answer(fmt_err("Вывод", resp), reply_markup=kb_main())
 
@@ -694,6 +1666,113 @@ def parse_recipient(text: str) -> Tuple[Optional[int], Optional[str]]:
     if re.fullmatch(r"@?[A-Za-z0-9_.-]{3,32}", s): return None, s.lstrip("@")
     return None, None
 
+RECIPIENT_TTL_SEC = int(os.getenv("RECIPIENT_TTL_SEC", str(7 * 86400)) or 0)
+RECENT_RECIPIENTS = 6
+
+def _user_profile(u: Dict[str, Any]) -> Dict[str, Any]:
+    return {"user_id": int(u["user_id"]), "username": u.get("username") or str(u["user_id"]),
+            "messages": u.get("user_message_count"), "likes": u.get("user_like_count"),
+            "registered": u.get("user_register_date"), "title": _clean_text(u.get("custom_title") or u.get("user_title") or ""),
+            "banned": bool(u.get("user_is_banned"))}
+
+class RecipientDirectory:
+    """Transfer recipients resolved through the forum API and cached in state.db for RECIPIENT_TTL_SEC,
+    so a typo is caught before market_transfer and a repeat payment costs no lookup. Paid recipients are
+    remembered for the quick-pick buttons on the transfer form."""
+
+    def __init__(self, store: SharedStore):
+        self.store = store; self._ready = False
+
+    def _db(self) -> sqlite3.Connection:
+        c = self.store._conn()
+        if not self._ready:
+            c.execute("CREATE TABLE IF NOT EXISTS recipients (user_id INTEGER PRIMARY KEY, uname TEXT NOT NULL, profile TEXT NOT NULL, "
+                      "resolved_at INTEGER NOT NULL, paid_at INTEGER NOT NULL DEFAULT 0, paid_n INTEGER NOT NULL DEFAULT 0)")
+            c.execute("CREATE INDEX IF NOT EXISTS recipients_uname ON recipients(uname)")
+            c.execute("CREATE INDEX IF NOT EXISTS recipients_paid ON recipients(paid_at)")
+            self._ready = True
+        return c
+
+    def _put(self, profiles: List[Dict[str, Any]]):
+        now = int(time.time())
+        self._db().executemany(
+            "INSERT INTO recipients(user_id, uname, profile, resolved_at) VALUES(?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET "
+            "uname=excluded.uname, profile=excluded.profile, resolved_at=excluded.resolved_at",
+            [(p["user_id"], p["username"].lower(), json.dumps(p, ensure_ascii=False), now) for p in profiles])
+
+    def cached(self, uid: Optional[int] = None, uname: Optional[str] = None, max_age: Optional[int] = RECIPIENT_TTL_SEC) -> Optional[Dict[str, Any]]:
+        where, arg = ("user_id=?", uid) if uid else ("uname=?", (uname or "").lower())
+        row = self._db().execute(f"SELECT profile, resolved_at FROM recipients WHERE {where}", (arg,)).fetchone()
+        if not row or (max_age is not None and time.time() - row[1] > max_age):
+            return None
+        return json.loads(row[0])
+
+    def resolve(self, uid: Optional[int], uname: Optional[str]) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """(profile, similar names, API error). No profile and no error means the user does not exist."""
+        hit = self.cached(uid, uname)
+        if hit:
+            METRICS.inc("recipient_lookups_total", result="cached")
+            return hit, [], None
+        if uid:
+            resp = forum_user_get(uid)
+            if resp["ok"]:
+                user = (resp.get("data") or {}).get("user")
+                if user:
+                    prof = _user_profile(user); self._put([prof])
+                    METRICS.inc("recipient_lookups_total", result="resolved")
+                    return prof, [], None
+            elif resp.get("status") != 404:
+                METRICS.inc("recipient_lookups_total", result="error")
+                return None, [], resp
+            METRICS.inc("recipient_lookups_total", result="missing")
+            return None, [], None
+        resp = forum_user_find(uname or "")
+        if not resp["ok"]:
+            METRICS.inc("recipient_lookups_total", result="error")
+            return None, [], resp
+        found = [_user_profile(u) for u in (resp.get("data") or {}).get("users") or [] if u.get("user_id")]
+        self._put(found)
+        exact = next((p for p in found if p["username"].lower() == (uname or "").lower()), None)
+        METRICS.inc("recipient_lookups_total", result="resolved" if exact else "missing")
+        return exact, ([] if exact else found[:RECENT_RECIPIENTS]), None
+
+    def known(self, name: str) -> bool:
+        return self._db().execute("SELECT 1 FROM recipients WHERE uname=? AND paid_at>0 LIMIT 1", (name.lower(),)).fetchone() is not None
+
+    def remember_paid(self, uid: int):
+        self._db().execute("UPDATE recipients SET paid_at=?, paid_n=paid_n+1 WHERE user_id=?", (int(time.time()), uid))
+
+    def recent(self, n: int = RECENT_RECIPIENTS) -> List[Dict[str, Any]]:
+        rows = self._db().execute("SELECT profile FROM recipients WHERE paid_at>0 ORDER BY paid_at DESC LIMIT ?", (n,))
+        return [json.loads(r[0]) for r in rows]
+
+RECIPIENTS = RecipientDirectory(STORE)
+
+def render_recipient(p: Dict[str, Any]) -> str:
+    bits = [f'👤 <a href="{SITE_FORUM}/members/{p["user_id"]}">{_html.escape(p["username"])}</a> • ID <code>{p["user_id"]}</code>']
+    if p.get("title"):
+        bits.append(f"🏷 {_html.escape(p['title'])}")
+    stats = []
+    if p.get("messages") is not None: stats.append(f"сообщений: {p['messages']}")
+    if p.get("likes") is not None: stats.append(f"симпатий: {p['likes']}")
+    if p.get("registered"): stats.append(f"с {datetime.fromtimestamp(int(p['registered'])).strftime('%d.%m.%Y')}")
+    if stats:
+        bits.append("📊 " + " • ".join(stats))
+    if p.get("banned"):
+        bits.append("⛔️ <b>Пользователь заблокирован</b>")
+    return "\n".join(bits)
+
+def kb_recipients(profiles: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    for p in profiles:
+        kb.button(text=f"👤 {p['username']}", callback_data=f"tr:r:{p['user_id']}")
+    kb.button(text="⬅️ Назад", callback_data="go:menu")
+    kb.button(text="❌ Отмена", callback_data="act:cancel")
+    kb.adjust(*([2] * (len(profiles) // 2)), *([1] if len(profiles) % 2 else []), 2)
+    return kb.as_markup()
+
+TRANSFER_PROMPT = "💸 <b>Перевод средств</b>\n\n👤 Введи @username / ID / ссылку на профиль получателя:"
+
 def parse_hold_option(s: str) -> Tuple[Optional[int], Optional[str], int, bool]:
     s = (s or "0").strip().lower()
     if s == "0": return None, None, 0, True
@@ -716,10 +1795,30 @@ def parse_hold_option(s: str) -> Tuple[Optional[int], Optional[str], int, bool]:
 async def act_transfer(cb: CallbackQuery, state: FSMContext):
     if not await guard(cb): return await state.clear()
     await state.set_state(TransferState.ident)
+    recent = RECIPIENTS.recent()
+    text = TRANSFER_PROMPT + ("\nили выбери из недавних:" if recent else "")
     try:
-        await cb.message.edit_text("💸 <b>Перевод средств</b>\n\n👤 Введи @username / ID / ссылку на профиль получателя:", reply_markup=kb_form())
+        await cb.message.edit_text(text, reply_markup=kb_recipients(recent))
     except TelegramBadRequest:
-        await cb.message.answer("💸 <b>Перевод средств</b>\n\n👤 Введи @username / ID / ссылку на профиль получателя:", reply_markup=kb_form())
+        await cb.message.answer(text, reply_markup=kb_recipients(recent))
+    await cb.answer()
+
+async def _tr_recipient_chosen(m: Message, state: FSMContext, prof: Dict[str, Any]):
+    await state.update_data(recipient_id=prof["user_id"], recipient_username=None, recipient_name=prof["username"])
+    await state.set_state(TransferState.amount)
+    await m.answer(render_recipient(prof) + "\n\n💵 Введи <b>сумму</b> (целое, например 125):",
+                   reply_markup=kb_form(), disable_web_page_preview=True)
+
+@rt.callback_query(TransferState.ident, F.data.startswith("tr:r:"))
+async def tr_pick_recipient(cb: CallbackQuery, state: FSMContext):
+    if not await guard(cb): return
+    uid = int(cb.data.split(":")[2])
+    prof = RECIPIENTS.cached(uid, max_age=None)
+    if prof is None:
+        prof, _, err = await asyncio.to_thread(RECIPIENTS.resolve, uid, None)
+        if prof is None:
+            await cb.answer("Не удалось загрузить профиль — введи получателя вручную.", show_alert=True); return
+    await _tr_recipient_chosen(cb.message, state, prof)
     await cb.answer()
 
 @rt.message(TransferState.ident)
@@ -728,9 +1827,18 @@ async def tr_ident(m: Message, state: FSMContext):
     uid, uname = parse_recipient(m.text)
     if not (uid or uname):
         await m.reply("⚠️ Пришли ID, @username или ссылку на профиль.", reply_markup=kb_form()); return
+    prof, similar, err = await asyncio.to_thread(RECIPIENTS.resolve, uid, uname)
+    if prof:
+        await _tr_recipient_chosen(m, state, prof); return
+    if err is None:
+        who = f"ID {uid}" if uid else f"@{uname}"
+        text = f"⚠️ Пользователь <b>{_html.escape(who)}</b> не найден." + (" Может, кто-то из этих?" if similar else " Проверь написание.")
+        await m.reply(text, reply_markup=kb_recipients(similar)); return
+    # lookup itself failed (network, rate limit): keep the old behaviour and let the transfer call validate
     await state.update_data(recipient_id=uid, recipient_username=uname)
     await state.set_state(TransferState.amount)
-    await m.answer("💵 Введи <b>сумму</b> (целое, например 125):", reply_markup=kb_form())
+    await m.answer("⚠️ Не удалось проверить получателя, он будет проверен при переводе.\n"
+                   "💵 Введи <b>сумму</b> (целое, например 125):", reply_markup=kb_form())
 
 @rt.message(TransferState.amount)
 async def tr_amount(m: Message, state: FSMContext):
@@ -740,9 +1848,7 @@ async def tr_amount(m: Message, state: FSMContext):
     except Exception:
         await m.reply("⚠️ Введи целое число ≥ 1.", reply_markup=kb_form()); return
     await state.update_data(amount=amount)
-    pct = 0; fee = market_fee(amount)
-    if fee["ok"]:
-        pct = int((fee["data"] or {}).get("commission_percentage", 0) or 0)
+    pct = fee_pct(amount)
     total = amount * (100+pct) / 100
     await state.set_state(TransferState.comment)
     await m.answer("✍️ Комментарий к переводу (или «-» чтобы пропустить)\n" + f"Сумма: <b>{amount}</b> RUB • Комиссия: <b>{pct}%</b> • К списанию: <b>{total:.0f}</b> RUB", reply_markup=kb_form())
@@ -763,7 +1869,7 @@ async def tr_hold(m: Message, state: FSMContext):
     await state.update_data(hold_value=hv, hold_option=ho, hold_seconds=secs, hold_human=human_hold(hv, ho))
     data = await state.get_data()
     uid = data.get("recipient_id"); uname = data.get("recipient_username")
-    who_line = f'<a href="{SITE_FORUM}/members/{uid}">{uid}</a>' if uid else ("@"+uname)
+    who_line = f'<a href="{SITE_FORUM}/members/{uid}">{_html.escape(data.get("recipient_name") or str(uid))}</a>' if uid else ("@"+uname)
     hold_line = data.get("hold_human", "без удержания")
     if hv and int(data["amount"]) <= 10:
         hold_line += " ⚠️ (минимум > 10 ₽)"
@@ -781,29 +1887,68 @@ async def tr_note(m: Message, state: FSMContext):
     data = await state.get_data()
     resp = market_transfer(user_id=data.get("recipient_id"), username=data.get("recipient_username"), amount=data["amount"], comment=data.get("comment",""), hold_value=data.get("hold_value"), hold_option=data.get("hold_option"))
     if resp["ok"]:
+        BALANCE.nudge()
+        if data.get("recipient_id"):
+            RECIPIENTS.remember_paid(int(data["recipient_id"]))
         if note:
-            notes = _load(NOTES_FILE, {"items":[]})
-            notes["items"].append({"type":"transfer","created_at": int(time.time()),"amount": data["amount"], "to": data.get("recipient_id") or data.get("recipient_username"), "comment": data.get("comment",""),"note": note})
-            _save(NOTES_FILE, notes)
-        await m.answer("✅ Перевод отправлен.", reply_markup=kb_main())
-        secs = data.get("hold_seconds", 0)
-        if secs > 0:
-            if secs > 3600:
-                asyncio.create_task(remind_after(secs - 3600, f"⏳ Напоминание: через <b>1 час</b> холд по переводу {data['amount']} RUB снимется.", m.chat.id))
-            else:
-                mins = max(1, secs//60)
-                asyncio.create_task(remind_after(0, f"⏳ Напоминание: холд снимется через ~<b>{mins} мин</b>.", m.chat.id))
-            asyncio.create_task(remind_after(secs, f"✅ Холд по переводу {data['amount']} RUB <b>снят</b>.", m.chat.id))
+            append_note(NoteEntry("transfer", int(time.time()), data["amount"], note, data.get("comment", ""),
+                                  to=data.get("recipient_id") or data.get("recipient_username")))
+        _last_ops[m.from_user.id] = {
+            "kind": "transfer", "user_id": data.get("recipient_id"), "username": data.get("recipient_username"),
+            "name": data.get("recipient_name"),
+            "amount": int(data["amount"]), "comment": data.get("comment", ""),
+            "hold_value": data.get("hold_value"), "hold_option": data.get("hold_option"),
+            "hold_seconds": int(data.get("hold_seconds", 0) or 0),
+        }
+        await m.answer("✅ Перевод отправлен.", reply_markup=kb_main(save_tpl=True))
+        schedule_hold_reminders(data["amount"], data.get("hold_seconds", 0), m.chat.id)
+        record_out_hold(resp, data["amount"], data.get("hold_seconds", 0), data.get("recipient_name") or data.get("recipient_id") or data.get("recipient_username"))
     else:
         await m.answer(fmt_err("Перевод", resp), reply_markup=kb_main())
     await state.clear()
 
-async def remind_after(delay_sec: int, text: str, chat_id: int):
+def record_out_hold(resp: Dict[str, Any], amount: int, secs: int, to: Any):
+    if secs > 0:
+        src = f"out:{int(time.time())}:{hashlib.md5(json.dumps(resp.get('data'), sort_keys=True, default=str).encode()).hexdigest()[:10]}"
+        HOLDS.add(src, "out", float(amount), int(time.time()) + int(secs), str(to or ""))
+
+def schedule_hold_reminders(amount: int, secs: int, chat_id: int):
+    if secs <= 0:
+        return
+    now = int(time.time())
+    if secs > 3600:
+        schedule_reminder(now + secs - 3600, f"⏳ Напоминание: через <b>1 час</b> холд по переводу {amount} RUB снимется.", chat_id)
+    else:
+        mins = max(1, secs//60)
+        schedule_reminder(now, f"⏳ Напоминание: холд снимется через ~<b>{mins} мин</b>.", chat_id)
+    schedule_reminder(now + secs, f"✅ Холд по переводу {amount} RUB <b>снят</b>.", chat_id, kind="hold_release", amount=amount)
+
+def schedule_reminder(due_ts: int, text: str, chat_id: int, **extra: Any):
+    """Persist the reminder first so a restart before ``due_ts`` re-arms it (see restore_reminders).
+    ``extra`` is stored alongside (e.g. kind/amount for the dashboard)."""
+    rid = f"{due_ts}:{chat_id}:{hashlib.md5(text.encode('utf-8')).hexdigest()[:8]}"
+    arr = _load(REMINDERS_FILE, [])
+    arr.append({"id": rid, "due_ts": int(due_ts), "text": text, "chat_id": int(chat_id), **extra})
+    _save(REMINDERS_FILE, arr)
+    LIFECYCLE.track(remind_after(due_ts - int(time.time()), text, chat_id, rid))
+
+def restore_reminders() -> int:
+    arr = _load(REMINDERS_FILE, [])
+    now = int(time.time())
+    for r in arr:
+        LIFECYCLE.track(remind_after(r["due_ts"] - now, r["text"], r["chat_id"], r["id"]))
+    return len(arr)
+
+async def remind_after(delay_sec: int, text: str, chat_id: int, rid: Optional[str] = None):
     try:
         await asyncio.sleep(max(0, delay_sec))
         await bot.send_message(chat_id, text)
+    except asyncio.CancelledError:
+        raise
     except Exception:
-        pass
+        METRICS.inc("tg_send_failures_total", where="reminder")
+    if rid:
+        _save(REMINDERS_FILE, [r for r in _load(REMINDERS_FILE, []) if r.get("id") != rid])
 
 def market_create_invoice(amount: float, merchant_id: int, payment_id: str,
                           comment: str, url_success: str, url_callback: str,
@@ -987,55 +2132,312 @@ async def inv_note(m: Message, state: FSMContext):
     data = await state.get_data()
     inv_id = data.get("_last_invoice_id")
     if note and inv_id:
-        notes = _load(NOTES_FILE, {"items": []})
-        notes["items"].append({
-            "type": "invoice",
-            "created_at": int(time.time()),
-            "invoice_id": inv_id,
-            "amount": data.get("amount"),
-            "merchant_id": data.get("merchant_id"),
-            "payment_id": data.get("payment_id"),
-            "comment": data.get("_comment", ""),
-            "note": note
-        })
-        _save(NOTES_FILE, notes)
+        append_note(NoteEntry("invoice", int(time.time()), data.get("amount"), note, data.get("_comment", ""),
+                              invoice_id=inv_id, merchant_id=data.get("merchant_id"), payment_id=data.get("payment_id")))
         await m.answer("🗒 Заметка сохранена.", reply_markup=kb_main())
     else:
         await m.answer("Ок, без заметки.", reply_markup=kb_main())
     await state.clear()
 
 
-def kb_notes() -> InlineKeyboardMarkup:
+def kb_notes(qkey: str = "", page: int = 0, pages: int = 1) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
+    nav = 0
+    if page > 0:
+        kb.button(text="⬅️", callback_data=f"notes:p:{qkey}:{page - 1}"); nav += 1
+    if page + 1 < pages:
+        kb.button(text="➡️", callback_data=f"notes:p:{qkey}:{page + 1}"); nav += 1
     kb.button(text="🗑 Очистить заметки", callback_data="notes:clear")
     kb.button(text="🏠 Меню", callback_data="go:menu")
-    kb.adjust(1,1)
+    kb.adjust(*([nav] if nav else []), 1, 1)
     return kb.as_markup()
 
+# query text by short key for the pagination buttons (callback_data is capped at 64 bytes)
+_notes_queries: Dict[str, str] = {}
+
+def _note_line(it: NoteEntry) -> str:
+    dt = _ts(it.created_at)
+    if it.type == "invoice":
+        return f"🧾 [{dt}] Инвойс #{_html.escape(str(it.invoice_id))} • {it.amount} RUB — {_html.escape(it.note)}"
+    return f"💸 [{dt}] Перевод → {_html.escape(str(it.to))} • {it.amount} RUB — {_html.escape(it.note)}"
+
+def render_notes_page(query: str, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    qkey = hashlib.md5(query.encode("utf-8")).hexdigest()[:10]
+    _notes_queries[qkey] = query
+    while len(_notes_queries) > 256:
+        _notes_queries.pop(next(iter(_notes_queries)))
+    t0 = time.perf_counter()
+    total, items = NOTES_INDEX.search(query, page)
+    METRICS.observe("notes_search_seconds", time.perf_counter() - t0, buckets=LAG_BUCKETS)
+    pages = max(1, -(-total // NOTES_PAGE))
+    if not total:
+        text = f"🔎 По запросу «{_html.escape(query)}» ничего нет." if query else "🗒 Пока нет секретных заметок."
+        return text, kb_notes()
+    head = f"🔎 <b>Заметки: «{_html.escape(query)}»</b>" if query else "🗒 <b>Секретные заметки</b>"
+    text = f"{head} — {total} шт., стр. {page + 1}/{pages}\n" + "\n".join(_note_line(it) for it in items)
+    if not query:
+        text += "\n\nПоиск: <code>/notes текст, ID инвойса или получатель</code>"
+    return text, kb_notes(qkey, page, pages)
+
 @rt.callback_query(F.data == "act:notes")
 async def act_notes(cb: CallbackQuery):
     if not await guard(cb): return
-    items = _load(NOTES_FILE, {"items":[]}).get("items", [])
-    if not items:
-        await cb.message.answer("🗒 Пока нет секретных заметок.", reply_markup=kb_notes()); await cb.answer(); return
-    items = sorted(items, key=lambda x: x.get("created_at", 0), reverse=True)[:30]
-    lines = []
-    for it in items:
-        dt = _ts(int(it.get("created_at", 0)))
-        if it.get("type") == "invoice":
-            lines.append(f"🧾 [{dt}] Инвойс #{it.get('invoice_id')} • {it.get('amount')} RUB — {it.get('note')}")
-        else:
-            lines.append(f"💸 [{dt}] Перевод → {it.get('to')} • {it.get('amount')} RUB — {it.get('note')}")
-    await cb.message.answer("🗒 <b>Секретные заметки</b>\n" + "\n".join(lines), reply_markup=kb_notes())
+    text, kb = render_notes_page("", 0)
+    await cb.message.answer(text, reply_markup=kb)
+    await cb.answer()
+
+@rt.message(Command("notes"))
+async def on_notes(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    query = ((m.text or "").split(maxsplit=1)[1:] or [""])[0].strip()
+    text, kb = render_notes_page(query, 0)
+    await m.answer(text, reply_markup=kb)
+
+@rt.callback_query(F.data.startswith("notes:p:"))
+async def notes_page(cb: CallbackQuery):
+    if not await guard(cb): return
+    _, _, qkey, page = cb.data.split(":", 3)
+    query = _notes_queries.get(qkey)
+    if query is None:
+        await cb.answer("Поиск устарел — повтори /notes", show_alert=True); return
+    text, kb = render_notes_page(query, max(0, int(page)))
+    try:
+        await cb.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        await cb.message.answer(text, reply_markup=kb)
     await cb.answer()
 
 @rt.callback_query(F.data == "notes:clear")
 async def notes_clear(cb: CallbackQuery):
     if not await guard(cb): return
-    _save(NOTES_FILE, {"items":[]})
+    with STORE.mutex("notes"):
+        _save(NOTES_FILE, {"items":[]})
+        NOTES_INDEX.clear()
     await cb.message.answer("🧹 Готово! Все заметки удалены.", reply_markup=kb_main())
     await cb.answer()
 
+_find_queries: Dict[str, str] = {}
+
+def kb_find(qkey: str = "", page: int = 0, pages: int = 1) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    nav = 0
+    if page > 0:
+        kb.button(text="⬅️", callback_data=f"find:p:{qkey}:{page - 1}"); nav += 1
+    if page + 1 < pages:
+        kb.button(text="➡️", callback_data=f"find:p:{qkey}:{page + 1}"); nav += 1
+    kb.button(text="🏠 Меню", callback_data="go:menu")
+    kb.adjust(*([nav] if nav else []), 1)
+    return kb.as_markup()
+
+def _find_line(ts: int, delivered: bool, rec: Dict[str, Any]) -> str:
+    what = rec.get("thread_title") or rec.get("snippet") or ""
+    link = rec.get("post_url") or rec.get("thread_url")
+    what = f'<a href="{_html.escape(link)}">{_html.escape(what[:60])}</a>' if link and what else _html.escape(what[:60])
+    return (f"{'📨' if delivered else '🔇'} [{_ts(ts)}] <code>{_html.escape(rec.get('type') or 'other')}</code> "
+            f"{_html.escape(rec.get('actor_name') or '—')}: {_html.escape(rec.get('action') or '')} {what}").rstrip()
+
+def render_find_page(query: str, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    qkey = hashlib.md5(query.encode("utf-8")).hexdigest()[:10]
+    _find_queries[qkey] = query
+    while len(_find_queries) > 256:
+        _find_queries.pop(next(iter(_find_queries)))
+    t0 = time.perf_counter()
+    total, rows = NOTIF_ARCHIVE.find(parse_find_query(query), page)
+    METRICS.observe("notif_find_seconds", time.perf_counter() - t0, buckets=LAG_BUCKETS)
+    if not total:
+        return f"🔎 В архиве уведомлений по «{_html.escape(query)}» ничего нет.", kb_find()
+    pages = max(1, -(-total // FIND_PAGE))
+    text = (f"🔎 <b>Архив уведомлений: «{_html.escape(query)}»</b> — {total} шт., стр. {page + 1}/{pages}\n"
+            + "\n".join(_find_line(*r) for r in rows))
+    return text, kb_find(qkey, page, pages)
+
+FIND_HELP = ("🔎 Поиск по архиву уведомлений:\n"
+             "<code>/find type:mention @ник thread:123 since:7d текст</code>\n"
+             "since: — <code>12h</code>, <code>7d</code>, <code>2w</code>, <code>01.10</code> или <code>2026-10-01</code>.\n"
+             f"Хранится {NOTIF_ARCHIVE_DAYS or '∞'} дн. / до {NOTIF_ARCHIVE_MAX_ROWS or '∞'} записей.")
+
+@rt.message(Command("find"))
+async def on_find(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    query = ((m.text or "").split(maxsplit=1)[1:] or [""])[0].strip()
+    if not query:
+        await m.answer(FIND_HELP, reply_markup=kb_find()); return
+    text, kb = await asyncio.to_thread(render_find_page, query, 0)
+    await m.answer(text, reply_markup=kb, disable_web_page_preview=True)
+
+@rt.callback_query(F.data.startswith("find:p:"))
+async def find_page(cb: CallbackQuery):
+    if not await guard(cb): return
+    _, _, qkey, page = cb.data.split(":", 3)
+    query = _find_queries.get(qkey)
+    if query is None:
+        await cb.answer("Поиск устарел — повтори /find", show_alert=True); return
+    text, kb = await asyncio.to_thread(render_find_page, query, max(0, int(page)))
+    try:
+        await cb.message.edit_text(text, reply_markup=kb, disable_web_page_preview=True)
+    except TelegramBadRequest:
+        await cb.message.answer(text, reply_markup=kb, disable_web_page_preview=True)
+    await cb.answer()
+
+_last_ops: Dict[int, Dict[str, Any]] = {}
+_TPL_INFLIGHT: set = set()
+
+def _tpl_title(op: Dict[str, Any]) -> str:
+    if op.get("kind") == "payout":
+        return f"🏦 {op.get('svc_title')} • {op.get('wallet')} • {op.get('amount')} RUB"
+    who = op.get("name") or op.get("user_id") or ("@" + (op.get("username") or "?"))
+    return f"💸 {who} • {op.get('amount')} RUB"
+
+def _tpl_find(tpl_id: int) -> Optional[Dict[str, Any]]:
+    for t in _load(TEMPLATES_FILE, {"items": []}).get("items", []):
+        if int(t.get("id", 0)) == tpl_id:
+            return t
+    return None
+
+def kb_templates(items: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    for t in items:
+        kb.button(text=f"▶️ {t.get('title')}"[:60], callback_data=f"tpl:run:{t['id']}")
+        kb.button(text="🗑", callback_data=f"tpl:del:{t['id']}")
+    kb.button(text="🏠 Меню", callback_data="go:menu")
+    kb.adjust(*([2] * len(items)), 1)
+    return kb.as_markup()
+
+def render_tpl_confirm(t: Dict[str, Any], pct: Optional[int]) -> str:
+    op = t.get("op") or {}
+    lines = [f"⭐ <b>Шаблон #{t['id']}</b>"]
+    if op.get("kind") == "payout":
+        lines.append(f"🏦 Вывод: <b>{_html.escape(str(op.get('svc_title')))}</b> (code: <code>{op.get('ps_code') or op.get('svc_id')}</code>)")
+        lines.append(f"Кошелёк: <code>{_html.escape(str(op.get('wallet')))}</code>")
+        lines.append(f"Сумма: <b>{op.get('amount')}</b> RUB • Комиссия {'включена' if op.get('include_fee') else 'сверху'}")
+        if op.get("extra"):
+            lines.append("Extra: <code>" + _html.escape(";".join(f"{k}={v}" for k, v in op["extra"].items())) + "</code>")
+    else:
+        uid = op.get("user_id")
+        who = f'<a href="{SITE_FORUM}/members/{uid}">{uid}</a>' if uid else "@" + _html.escape(op.get("username") or "")
+        amount = int(op.get("amount", 0))
+        lines.append(f"💸 Перевод → {who}")
+        if pct is None:
+            lines.append(f"Сумма: <b>{amount}</b> RUB • Комиссия: неизвестна")
+        else:
+            lines.append(f"Сумма: <b>{amount}</b> RUB • Комиссия: <b>{pct}%</b> • К списанию: <b>{amount * (100 + pct) / 100:.0f}</b> RUB")
+        lines.append(f"Комментарий: {_html.escape(op.get('comment') or '—')}")
+        lines.append(f"Холд: <b>{human_hold(op.get('hold_value'), op.get('hold_option'))}</b>")
+    return "\n".join(lines)
+
+@rt.callback_query(F.data == "tpl:save")
+async def tpl_save(cb: CallbackQuery):
+    if not await guard(cb): return
+    op = _last_ops.pop(cb.from_user.id, None)
+    if not op:
+        await cb.answer("Нечего сохранять.", show_alert=True); return
+    with STORE.mutex("templates"):
+        data = _load(TEMPLATES_FILE, {"items": [], "next_id": 1})
+        tpl_id = int(data.get("next_id", 1))
+        data.setdefault("items", []).append({"id": tpl_id, "title": _tpl_title(op), "created_at": int(time.time()), "uses": 0, "op": op})
+        data["next_id"] = tpl_id + 1
+        _save(TEMPLATES_FILE, data)
+    await cb.message.answer(f"💾 Сохранён шаблон #{tpl_id}: {_html.escape(_tpl_title(op))}", reply_markup=kb_main())
+    await cb.answer()
+
+@rt.callback_query(F.data == "act:templates")
+async def act_templates(cb: CallbackQuery, state: FSMContext):
+    if not await guard(cb): return await state.clear()
+    items = _load(TEMPLATES_FILE, {"items": []}).get("items", [])
+    items = sorted(items, key=lambda x: (x.get("uses", 0), x.get("created_at", 0)), reverse=True)[:30]
+    amounts = [int((t.get("op") or {}).get("amount", 0)) for t in items if (t.get("op") or {}).get("kind") == "transfer"]
+    if amounts:
+        LIFECYCLE.track(prefetch_fees(amounts))
+    text = "⭐ <b>Шаблоны</b>\n" + ("Нажми на шаблон, чтобы повторить операцию." if items else "Пока нет шаблонов. Сохрани перевод или вывод после выполнения.")
+    try:
+        await cb.message.edit_text(text, reply_markup=kb_templates(items))
+    except TelegramBadRequest:
+        await cb.message.answer(text, reply_markup=kb_templates(items))
+    await cb.answer()
+
+@rt.callback_query(F.data.startswith("tpl:run:"))
+async def tpl_run(cb: CallbackQuery):
+    if not await guard(cb): return
+    t = _tpl_find(int(cb.data.split(":", 2)[2]))
+    if not t:
+        await cb.answer("Шаблон не найден.", show_alert=True); return
+    op = t.get("op") or {}
+    pct = None
+    if op.get("kind") == "transfer":
+        pct = fee_pct_cached(op.get("amount", 0))
+        if pct is None:
+            pct = await asyncio.to_thread(fee_pct, op.get("amount", 0))
+    kb = InlineKeyboardBuilder()
+    kb.button(text="✅ Выполнить", callback_data=f"tpl:go:{t['id']}")
+    kb.button(text="❌ Отмена", callback_data="act:templates")
+    kb.adjust(2)
+    await cb.message.answer(render_tpl_confirm(t, pct), reply_markup=kb.as_markup(), disable_web_page_preview=True)
+    await cb.answer()
+
+@rt.callback_query(F.data.startswith("tpl:go:"))
+async def tpl_go(cb: CallbackQuery):
+    if not await guard(cb): return
+    tpl_id = int(cb.data.split(":", 2)[2])
+    t = _tpl_find(tpl_id)
+    if not t:
+        await cb.answer("Шаблон не найден.", show_alert=True); return
+    # claimed before the first await below: a double tap must not send the money twice
+    if tpl_id in _TPL_INFLIGHT:
+        await cb.answer("⏳ Уже выполняется…"); return
+    _TPL_INFLIGHT.add(tpl_id)
+    try:
+        await _tpl_run(cb, tpl_id, t.get("op") or {})
+    finally:
+        _TPL_INFLIGHT.discard(tpl_id)
+
+async def _tpl_run(cb: CallbackQuery, tpl_id: int, op: Dict[str, Any]):
+    try:
+        await cb.message.edit_reply_markup(reply_markup=None)
+    except TelegramBadRequest:
+        pass
+    await cb.answer("⏳ Выполняю…")
+    if op.get("kind") == "payout":
+        if op.get("ps_code"):
+            resp = await asyncio.to_thread(lambda: market_create_payout_v2(payment_system=op["ps_code"], wallet=op["wallet"], amount=op["amount"], include_fee=op.get("include_fee", False), extra=op.get("extra") or None))
+        else:
+            reqs = {"WALLET": op["wallet"]}; reqs.update(op.get("extra") or {})
+            resp = await asyncio.to_thread(market_create_payout, int(op["svc_id"]), float(op["amount"]), reqs)
+        title = "Вывод"
+    else:
+        resp = await asyncio.to_thread(lambda: market_transfer(user_id=op.get("user_id"), username=op.get("username"), amount=op["amount"], comment=op.get("comment", ""), hold_value=op.get("hold_value"), hold_option=op.get("hold_option")))
+        title = "Перевод"
+    if resp["ok"]:
+        BALANCE.nudge()
+        with STORE.mutex("templates"):
+            data = _load(TEMPLATES_FILE, {"items": []})
+            for x in data.get("items", []):
+                if int(x.get("id", 0)) == tpl_id:
+                    x["uses"] = int(x.get("uses", 0)) + 1; x["last_used_ts"] = int(time.time())
+            _save(TEMPLATES_FILE, data)
+        if op.get("kind") == "transfer":
+            if op.get("user_id"):
+                RECIPIENTS.remember_paid(int(op["user_id"]))
+            schedule_hold_reminders(op["amount"], int(op.get("hold_seconds", 0) or 0), cb.message.chat.id)
+            record_out_hold(resp, op["amount"], int(op.get("hold_seconds", 0) or 0), op.get("name") or op.get("user_id") or op.get("username"))
+        await cb.message.answer(f"✅ {title} по шаблону #{tpl_id} выполнен.", reply_markup=kb_main())
+    else:
+        await cb.message.answer(fmt_err(title, resp), reply_markup=kb_main())
+
+@rt.callback_query(F.data.startswith("tpl:del:"))
+async def tpl_del(cb: CallbackQuery):
+    if not await guard(cb): return
+    tpl_id = int(cb.data.split(":", 2)[2])
+    with STORE.mutex("templates"):
+        data = _load(TEMPLATES_FILE, {"items": []})
+        data["items"] = [x for x in data.get("items", []) if int(x.get("id", 0)) != tpl_id]
+        _save(TEMPLATES_FILE, data)
+    items = sorted(data["items"], key=lambda x: (x.get("uses", 0), x.get("created_at", 0)), reverse=True)[:30]
+    try:
+        await cb.message.edit_reply_markup(reply_markup=kb_templates(items))
+    except TelegramBadRequest:
+        pass
+    await cb.answer("🗑 Шаблон удалён.")
+
 def parse_thread_id(text: str) -> Optional[int]:
     s = text.strip(); m = re.search(r"/threads/(\d+)", s)
     if m: return int(m.group(1))
@@ -1055,11 +2457,8 @@ def kb_bumps_menu() -> InlineKeyboardMarkup:
 @rt.callback_query(F.data == "act:autobump")
 async def act_autobump(cb: CallbackQuery, state: FSMContext):
     if not await guard(cb): return await state.clear()
-    cfg = _load(BUMPS_FILE, {"threads":[]})
-    lines = []
-    for th in cfg.get("threads", []):
-        tid = th["thread_id"]; iv = th.get("interval_min",10); last = th.get("last_bump_ts",0)
-        lines.append(f"• #{tid} каждые {iv} мин • последний: { _ts(last) if last else '—' }")
+    stats = load_bump_stats()
+    lines = [_bump_line(th, stats) for th in load_bumps()]
     text = "📌 <b>Автоподнятие</b>\n" + ("\n".join(lines) if lines else "Пока нет тем.")
     try:
         await cb.message.edit_text(text, reply_markup=kb_bumps_menu())
@@ -1070,11 +2469,8 @@ async def act_autobump(cb: CallbackQuery, state: FSMContext):
 @rt.callback_query(F.data == "b:list")
 async def b_list(cb: CallbackQuery):
     if not await guard(cb): return
-    cfg = _load(BUMPS_FILE, {"threads":[]})
-    lines = []
-    for th in cfg.get("threads", []):
-        tid = th["thread_id"]; iv = th.get("interval_min",10); last = th.get("last_bump_ts",0)
-        lines.append(f"• #{tid} каждые {iv} мин • последний: { _ts(last) if last else '—' }")
+    stats = load_bump_stats()
+    lines = [_bump_line(th, stats) for th in load_bumps()]
     await cb.message.answer("📜 <b>Список</b>\n" + ("\n".join(lines) if lines else "Пусто"))
     await cb.answer()
 
@@ -1082,7 +2478,8 @@ async def b_list(cb: CallbackQuery):
 async def b_add(cb: CallbackQuery, state: FSMContext):
     if not await guard(cb): return
     await state.set_state(BumpState.add)
-    await cb.message.answer("🔗 Пришли ссылку на тему или ID (пример: <code>9070000 15</code> — каждые 15 мин).", reply_markup=kb_form())
+    await cb.message.answer("🔗 Пришли ссылку на тему или ID (пример: <code>9070000 15</code> — каждые 15 мин, "
+                            "<code>9070000 15 09:00-23:00</code> — только в это время, <code>9070000 15 -</code> — снять окно).", reply_markup=kb_form())
     await cb.answer()
 
 @rt.message(BumpState.add)
@@ -1096,40 +2493,46 @@ async def b_add_msg(m: Message, state: FSMContext):
     interval = 10
     if len(parts) >= 2 and parts[1].isdigit():
         interval = max(5, int(parts[1]))
+    window: Optional[str] = None  # None: keep the stored window on update, "-" clears it
+    if len(parts) >= 3:
+        window = "" if parts[2] == "-" else parse_bump_window("".join(parts[2:])) or None
+        if window is None:
+            await m.reply("⚠️ Окно времени в формате <code>09:00-23:00</code> или <code>-</code>, чтобы снять.", reply_markup=kb_form()); return
 
-    cfg = _load(BUMPS_FILE, {"threads":[]})
-    arr = cfg.get("threads", [])
+    now_ts = int(time.time())
 
-    for th in arr:
-        if int(th["thread_id"]) == int(tid):
-            th["interval_min"] = interval
-            now_ts = int(time.time())
-            th["next_bump_ts"] = now_ts + interval * 60
-            _save(BUMPS_FILE, cfg)
-            await m.answer(f"✅ Обновил тему #{tid}: каждые {interval} мин.", reply_markup=kb_bumps_menu())
-            return
+    def upsert(arr: List[BumpEntry]) -> Tuple[Optional[str], str]:
+        for th in arr:
+            if th.thread_id == int(tid):
+                th.interval_min = interval
+                was_parked = th.parked
+                if th.last_error != "cooldown" or th.next_bump_ts <= now_ts:
+                    th.next_bump_ts = now_ts + interval * 60
+                th.parked = ""; th.fail_count = 0; th.tuned_min = 0
+                if window is not None:
+                    th.window = window
+                plan_bumps(arr, now_ts)
+                return was_parked, th.window
+        arr.append(BumpEntry(int(tid), interval, window=window or ""))
+        plan_bumps(arr, now_ts)
+        return None, window or ""
+
+    was_parked, window = mutate_bumps(upsert)
+    win_note = f", окно {window}" if window else ""
+    if was_parked is not None:
+        await m.answer(f"✅ Обновил тему #{tid}: каждые {interval} мин{win_note}." + (" Снял с паузы." if was_parked else ""), reply_markup=kb_bumps_menu())
+        return
 
-    resp = thread_bump(int(tid))
-    now_ts = int(time.time())
-    if resp["ok"]:
-        last_ts = now_ts
-        next_ts = now_ts + interval * 60
-        msg = "✅ Добавил тему и сразу поднял."
+    if _window_open_at(now_ts, window) > now_ts:
+        msg = "✅ Добавил тему; сейчас вне окна, авто начнётся по расписанию."
     else:
-        last_ts = 0
-        next_ts = now_ts + 60 
-        msg = f"✅ Добавил тему; авто начнётся по расписанию (err {resp.get('status')})."
-
-    arr.append({
-        "thread_id": int(tid),
-        "interval_min": interval,
-        "last_bump_ts": last_ts,
-        "next_bump_ts": next_ts
-    })
-    cfg["threads"] = arr
-    _save(BUMPS_FILE, cfg)
-
-    await m.answer(f"{msg} #{tid}: каждые {interval} мин.", reply_markup=kb_bumps_menu())
+        resp, res = await bump_thread(int(tid), now_ts)
+        if resp and resp["ok"]:
+            msg = "✅ Добавил тему и сразу поднял."
+        else:
+            msg = f"✅ Добавил тему; авто начнётся по расписанию ({res})."
+
+    await m.answer(f"{msg} #{tid}: каждые {interval} мин{win_note}.", reply_markup=kb_bumps_menu())
     await state.set_state(BumpState.menu)
 
 
@@ -1145,19 +2548,24 @@ async def b_del_msg(m: Message, state: FSMContext):
     tid = parse_thread_id(m.text or "")
     if not tid:
         await m.reply("⚠️ Нужен ID темы.", reply_markup=kb_form()); return
-    cfg = _load(BUMPS_FILE, {"threads":[]})
-    before = len(cfg.get("threads", []))
-    cfg["threads"] = [x for x in cfg.get("threads", []) if int(x["thread_id"]) != int(tid)]
-    _save(BUMPS_FILE, cfg)
-    after = len(cfg["threads"])
-    await m.answer("✅ Удалено." if after < before else "⚠️ Не найдено.", reply_markup=kb_bumps_menu())
+    def drop(arr: List[BumpEntry]) -> bool:
+        before = len(arr)
+        arr[:] = [x for x in arr if x.thread_id != int(tid)]
+        plan_bumps(arr, int(time.time()))
+        return len(arr) < before
+
+    removed = mutate_bumps(drop)
+    with STORE.mutex("bump_stats"):
+        stats = load_bump_stats()
+        if stats.pop(str(tid), None) is not None:
+            _save(BUMP_STATS_FILE, stats)
+    await m.answer("✅ Удалено." if removed else "⚠️ Не найдено.", reply_markup=kb_bumps_menu())
     await state.set_state(BumpState.menu)
 
 @rt.callback_query(F.data == "b:bumpnow")
 async def b_bumpnow(cb: CallbackQuery):
     if not await guard(cb): return
-    cfg = _load(BUMPS_FILE, {"threads":[]})
-    threads = cfg.get("threads", [])
+    threads = load_bumps()
     if not threads:
         await cb.message.answer("Пока нет тем."); await cb.answer(); return
 
@@ -1165,18 +2573,13 @@ async def b_bumpnow(cb: CallbackQuery):
     now_ts = int(time.time())
 
     for th in threads:
-        tid = int(th["thread_id"])
-        resp = thread_bump(tid)
-        if resp["ok"]:
-            th["last_bump_ts"] = now_ts
-            iv = max(5, int(th.get("interval_min", 10)))
-            th["next_bump_ts"] = now_ts + iv * 60
-            results.append(f"⏫ #{tid} — ok")
-        else:
-            results.append(f"⏫ #{tid} — err {resp.get('status')}")
-
-    cfg["threads"] = threads
-    _save(BUMPS_FILE, cfg)
+        tid = th.thread_id
+        if th.parked:
+            results.append(f"⏸ #{tid} — на паузе ({BUMP_ERR_HUMAN.get(th.parked, th.parked)})"); continue
+        if th.last_error == "cooldown" and th.next_bump_ts > now_ts:
+            results.append(f"⏳ #{tid} — кулдаун до {_ts(th.next_bump_ts)}"); continue
+        _resp, res = await bump_thread(tid, now_ts)
+        results.append(f"⏫ #{tid} — {res or 'тема удалена'}")
 
     await cb.message.answer("\n".join(results))
     await cb.answer()
@@ -1208,131 +2611,1535 @@ def fmt_err(title: str, resp: Dict[str, Any]) -> str:
     tip = ("\n".join("• " + h for h in hints) + ("\n" if hints else ""))
     return f"⚠️ <b>{title} — ошибка ({status})</b>\n{tip}<b>json</b>\n<pre>{body}</pre>"
 
-async def notif_poller():
-    await asyncio.sleep(2)
-    while True:
+NOTIF_POLL_SEC = 20
+NOTIF_TYPES = ("comment", "mention", "like", "payment_in", "transfer_in", "transfer_in_hold", "hold_released",
+               "profile_post", "profile_comment", "other")
+NOTIF_TYPE_GROUPS = {
+    "all": set(NOTIF_TYPES),
+    "payments": {"payment_in", "transfer_in", "transfer_in_hold", "hold_released"},
+    "forum": {"comment", "mention", "like", "profile_post", "profile_comment"},
+}
+TG_GLOBAL_PER_SEC = float(os.getenv("TG_GLOBAL_PER_SEC", "25") or 25)          # Bot API: ~30 messages/s overall
+TG_CHAT_INTERVAL_SEC = float(os.getenv("TG_CHAT_INTERVAL_SEC", "1") or 0)     # ~1 message/s per private chat
+TG_GROUP_INTERVAL_SEC = float(os.getenv("TG_GROUP_INTERVAL_SEC", "3") or 0)   # ~20 messages/min per group
+TG_CHAT_BURST = 10            # one poll page goes out at once; the limits apply to the sustained rate
+
+def admin_allowed(s: Dict[str, Any]) -> set:
+    allowed = set()
+    if s["notify_comments"]: allowed.add("comment")
+    if s["notify_mentions"]: allowed.add("mention")
+    if s["notify_likes"]: allowed.add("like")
+    if s["notify_payment_in"]: allowed.add("payment_in")
+    if s["notify_hold_released"]: allowed.add("hold_released")
+    if s["notify_profile_post"]: allowed.add("profile_post")
+    if s["notify_profile_comment"]: allowed.add("profile_comment")
+    if s["notify_payment_in"]:
+        allowed.update({"transfer_in", "transfer_in_hold"})
+    return allowed
+
+_SUBS_CACHE: Tuple[Any, List[Dict[str, Any]]] = (None, [])
+
+def load_subscribers() -> List[Dict[str, Any]]:
+    """Extra recipients of notification cards: {id, chat_id, topic, types, title}. Re-read only when the file changes."""
+    global _SUBS_CACHE
+    sig = _file_sig(SUBSCRIBERS_FILE)
+    if sig != _SUBS_CACHE[0]:
+        items = _load(SUBSCRIBERS_FILE, {"items": []}).get("items", [])
+        _SUBS_CACHE = (sig, [dict(x, types=set(x.get("types") or ())) for x in items])
+    return _SUBS_CACHE[1]
+
+def notif_targets(ntype: str, admin: set) -> List[Tuple[int, Optional[int]]]:
+    out = [(ADMIN_USER_ID, None)] if ntype in admin else []
+    out += [(x["chat_id"], x.get("topic")) for x in load_subscribers() if ntype in x["types"]]
+    return list(dict.fromkeys(out))
+
+def parse_sub_types(tokens: List[str]) -> Optional[set]:
+    types = set()
+    for t in tokens:
+        t = t.lower()
+        if t in NOTIF_TYPE_GROUPS:
+            types |= NOTIF_TYPE_GROUPS[t]
+        elif t in NOTIF_TYPES:
+            types.add(t)
+        else:
+            return None
+    return types or None
+
+class TgSender:
+    """One outgoing policy for every card: a token bucket per chat (groups refill slower) plus a global cap.
+    Tokens are reserved synchronously, so concurrent sends queue up in order instead of racing.
+    ``enqueue`` hands a whole delivery to the outbox, which shutdown drains within SHUTDOWN_DRAIN_SEC."""
+
+    def __init__(self):
+        self._buckets: Dict[int, List[float]] = {}; self._gnext = 0.0
+        self.outbox: set = set()
+
+    def enqueue(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.outbox.add(task)
+        task.add_done_callback(self.outbox.discard)
+        return task
+
+    async def drain(self, timeout: float) -> int:
+        """Wait for the outbox; returns how many deliveries were still pending (and get cancelled by shutdown)."""
+        if not self.outbox:
+            return 0
+        _, pending = await asyncio.wait(set(self.outbox), timeout=timeout)
+        for t in pending:
+            t.cancel()
+        if pending:
+            logging.warning("shutdown: %d queued deliveries dropped", len(pending))
+        return len(pending)
+
+    async def _slot(self, chat_id: int):
+        loop = asyncio.get_running_loop(); now = loop.time()
+        every = max(1e-3, TG_GROUP_INTERVAL_SEC if chat_id < 0 else TG_CHAT_INTERVAL_SEC)
+        b = self._buckets.setdefault(chat_id, [float(TG_CHAT_BURST), now])
+        b[0] = min(float(TG_CHAT_BURST), b[0] + (now - b[1]) / every); b[1] = now
+        b[0] -= 1
+        at = max(now + (-b[0] * every if b[0] < 0 else 0.0), self._gnext)
+        self._gnext = at + 1.0 / TG_GLOBAL_PER_SEC
+        if at > now:
+            METRICS.inc("tg_send_wait_seconds_total", at - now)
+            await asyncio.sleep(at - now)
+
+    async def send(self, chat_id: int, text: str, *, topic: Optional[int] = None, kb: Optional[InlineKeyboardMarkup] = None,
+                   where: str = "notif") -> bool:
+        for _ in range(2):
+            await self._slot(chat_id)
+            try:
+                await bot.send_message(chat_id, text, reply_markup=kb, message_thread_id=topic, disable_web_page_preview=True)
+                return True
+            except TelegramRetryAfter as e:
+                METRICS.inc("tg_retry_after_total", where=where)
+                self._buckets[chat_id][0] = -e.retry_after / max(1e-3, TG_GROUP_INTERVAL_SEC if chat_id < 0 else TG_CHAT_INTERVAL_SEC)
+            except Exception:
+                break
+        METRICS.inc("tg_send_failures_total", where=where)
+        return False
+
+SENDER = TgSender()
+LIFECYCLE.drains.append(SENDER.drain)
+
+def render_subs() -> str:
+    subs = load_subscribers()
+    lines = ["📡 <b>Подписчики уведомлений</b>", f"• админ <code>{ADMIN_USER_ID}</code> — по переключателям в меню уведомлений"]
+    for x in subs:
+        where = f"{x['chat_id']}" + (f"/{x['topic']}" if x.get("topic") else "")
+        lines.append(f"• #{x['id']} <code>{where}</code> {_html.escape(x.get('title') or '')} — {', '.join(sorted(x['types']))}")
+    lines += ["", "<code>/sub here payments|forum|all|тип…</code> — этот чат/топик",
+              "<code>/sub add chat_id[/topic] типы…</code>", "<code>/sub del N</code>",
+              "Типы: " + ", ".join(NOTIF_TYPES)]
+    return "\n".join(lines)
+
+@rt.message(Command("sub"))
+async def on_sub(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    args = (m.text or "").split()[1:]
+    op = args[0].lower() if args else "list"
+    if op in ("here", "add"):
+        if op == "here":
+            chat_id, topic, title, rest = m.chat.id, m.message_thread_id if m.is_topic_message else None, m.chat.title or m.chat.full_name, args[1:]
+        else:
+            mt = re.fullmatch(r"(-?\d+)(?:/(\d+))?", args[1]) if len(args) > 1 else None
+            if not mt:
+                await m.reply("⚠️ Формат: <code>/sub add chat_id[/topic] типы…</code>"); return
+            chat_id, topic, title, rest = int(mt.group(1)), int(mt.group(2)) if mt.group(2) else None, "", args[2:]
+        types = parse_sub_types(rest)
+        if not types:
+            await m.reply("⚠️ Укажи типы: payments, forum, all или " + ", ".join(NOTIF_TYPES)); return
+        with STORE.mutex("subscribers"):
+            data = _load(SUBSCRIBERS_FILE, {"items": []})
+            items = [x for x in data.get("items", []) if (x["chat_id"], x.get("topic")) != (chat_id, topic)]
+            sid = max([int(x.get("id", 0)) for x in data.get("items", [])] + [0]) + 1
+            items.append({"id": sid, "chat_id": chat_id, "topic": topic, "types": sorted(types), "title": title})
+            _save(SUBSCRIBERS_FILE, {"items": items})
+        await m.answer(f"✅ Подписка #{sid} сохранена.\n\n" + render_subs())
+    elif op == "del" and len(args) > 1 and args[1].lstrip("#").isdigit():
+        sid = int(args[1].lstrip("#"))
+        with STORE.mutex("subscribers"):
+            data = _load(SUBSCRIBERS_FILE, {"items": []})
+            _save(SUBSCRIBERS_FILE, {"items": [x for x in data.get("items", []) if int(x.get("id", 0)) != sid]})
+        await m.answer(f"🗑 Подписка #{sid} удалена.\n\n" + render_subs())
+    else:
+        await m.answer(render_subs())
+
+
+RULE_ACTIONS = ("alert", "tag", "mute")
+RULE_AMOUNT_RE = re.compile(r"amount(>=|<=|>|<|=)(\d+(?:[.,]\d+)?)")
+RULE_OPS: Dict[str, Callable[[float, float], bool]] = {
+    ">": lambda a, b: a > b, "<": lambda a, b: a < b, ">=": lambda a, b: a >= b, "<=": lambda a, b: a <= b,
+    "=": lambda a, b: abs(a - b) < 0.01}
+
+class AlertRule:
+    __slots__ = ("id", "action", "tag", "types", "actor", "thread_id", "amount", "unknown", "words", "patterns", "src")
+
+    def __init__(self, rid: int, action: str, tag: str, src: str):
+        self.id = rid; self.action = action; self.tag = tag; self.src = src
+        self.types: Optional[set] = None; self.actor = ""; self.thread_id: Optional[int] = None
+        self.amount: List[Tuple[str, float]] = []; self.unknown = False
+        self.words: set = set(); self.patterns: List[re.Pattern] = []
+
+    @classmethod
+    def compile(cls, rid: int, action: str, tag: str, src: str) -> "AlertRule":
+        """``type:mention,comment @actor thread:123 amount>5000 unknown text:слово /regex/ слово`` — all conditions must hold."""
+        r = cls(rid, action, tag, src)
+        for tok in src.split():
+            key, _, val = tok.partition(":")
+            m = RULE_AMOUNT_RE.fullmatch(tok.lower())
+            if m:
+                r.amount.append((m.group(1), float(m.group(2).replace(",", "."))))
+            elif tok.lower() == "unknown":
+                r.unknown = True
+            elif tok.startswith("@") and len(tok) > 1:
+                r.actor = tok[1:].lower()
+            elif val and key.lower() == "type":
+                r.types = set(val.lower().split(","))
+            elif val and key.lower() == "actor":
+                r.actor = val.lstrip("@").lower()
+            elif val and key.lower() == "thread":
+                r.thread_id = parse_thread_id(val)
+            elif len(tok) > 2 and tok[0] == tok[-1] == "/":
+                r.patterns.append(re.compile(tok[1:-1], re.IGNORECASE))
+            else:
+                r.words.add((val if val and key.lower() == "text" else tok).lower())
+        return r
+
+    def check(self, p: ParsedNotif, amount: Optional[float], hay: str, found: set, known: Callable[[str], bool]) -> bool:
+        if self.actor and (p.actor_name or "").lower() != self.actor:
+            return False
+        if self.thread_id is not None and p.thread_id != self.thread_id:
+            return False
+        if self.amount and amount is None:
+            return False
+        for op, v in self.amount:
+            if not RULE_OPS[op](amount, v):
+                return False
+        if not self.words <= found or not all(w.search(hay) for w in self.patterns):
+            return False
+        return not self.unknown or not known(p.actor_name or "")
+
+def _trie_regex(words: set) -> str:
+    """Literal keywords as one prefix-shared alternation; optional tails are greedy, so at every
+    position the longest keyword wins and shorter keywords are its prefixes."""
+    trie: Dict[str, Any] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+    def walk(node: Dict[str, Any]) -> str:
+        alts = [re.escape(ch) + walk(sub) for ch, sub in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return walk(trie)
+
+class RuleSet:
+    """All rules compiled together: bucketed by type, and every literal keyword of every rule in one
+    trie regex, so a notification is scanned once no matter how many rules there are. Only /regex/
+    conditions are checked one by one, and only for rules that survived the cheap filters."""
+
+    def __init__(self, rules: List[AlertRule]):
+        self.rules = rules
+        self.by_type: Dict[str, List[AlertRule]] = {}
+        self.any_type: List[AlertRule] = []
+        for r in rules:
+            if r.types is None:
+                self.any_type.append(r)
+            for t in r.types or ():
+                self.by_type.setdefault(t, []).append(r)
+        self.words = set().union(*(r.words for r in rules))
+        self.scan = re.compile(f"(?=({_trie_regex(self.words)}))") if self.words else None
+
+    def keywords(self, hay: str) -> set:
+        found = set()
+        if self.scan is not None:
+            for m in self.scan.finditer(hay):
+                hit = m.group(1)
+                found.update(hit[:k] for k in range(1, len(hit) + 1) if hit[:k] in self.words)
+        return found
+
+    def wanted_types(self) -> Optional[set]:
+        """Types some alert rule may fire on (None: any) — they must be rendered even if nobody subscribes."""
+        alerts = [r for r in self.rules if r.action == "alert"]
+        if any(r.types is None for r in alerts):
+            return None
+        return set().union(*(r.types for r in alerts))
+
+    def match(self, p: ParsedNotif) -> List[AlertRule]:
+        cand = self.by_type.get(p.type or "other", []) + self.any_type
+        if not cand:
+            return []
+        text_rules = any(r.words or r.patterns for r in cand)
+        hay = f"{p.action}\n{p.thread_title}\n{p.snippet}".lower() if text_rules else ""
+        found = self.keywords(hay) if text_rules else set()
+        # amount conditions only hold for money notifications, with the amount parse_notif extracted
+        amount = p.amount if p.type in MONEY_NOTIF_TYPES else None
+        known_cache: Dict[str, bool] = {}
+        def known(name: str) -> bool:
+            if name not in known_cache:
+                known_cache[name] = RECIPIENTS.known(name)
+            return known_cache[name]
+        return [r for r in cand if r.check(p, amount, hay, found, known)]
+
+_RULES_CACHE: Tuple[Any, RuleSet] = (None, RuleSet([]))
+
+def load_rules() -> RuleSet:
+    global _RULES_CACHE
+    sig = _file_sig(RULES_FILE)
+    if sig != _RULES_CACHE[0]:
+        rules = [AlertRule.compile(int(x["id"]), x["action"], x.get("tag", ""), x["src"])
+                 for x in _load(RULES_FILE, {"items": []}).get("items", [])]
+        _RULES_CACHE = (sig, RuleSet(rules))
+    return _RULES_CACHE[1]
+
+def apply_rules(p: ParsedNotif, text: Optional[str]) -> Tuple[Optional[str], str]:
+    """(text, verdict): verdict is "alert", "mute" or "" — an alert outranks a mute, tags stack.
+    Blocking (keyword scan, /regex/, recipient lookups in state.db): call it from a worker thread."""
+    t0 = time.perf_counter()
+    hits = load_rules().match(p)
+    METRICS.observe("rules_eval_seconds", time.perf_counter() - t0, buckets=LAG_BUCKETS)
+    if not hits or text is None:
+        return text, ""
+    for r in hits:
+        METRICS.inc("rule_hits_total", action=r.action)
+    tags = " ".join(dict.fromkeys(f"#{r.tag}" for r in hits if r.action == "tag" and r.tag))
+    if tags:
+        text = f"{text}\n{tags}"
+    if any(r.action == "alert" for r in hits):
+        return f"🚨 <b>Важно</b> (правило #{next(r.id for r in hits if r.action == 'alert')})\n{text}", "alert"
+    if any(r.action == "mute" for r in hits):
+        return text, "mute"
+    return text, ""
+
+def render_rules() -> str:
+    rs = load_rules()
+    icon = {"alert": "🚨", "tag": "🏷", "mute": "🔇"}
+    lines = ["🧭 <b>Правила уведомлений</b>"]
+    lines += [f"{icon[r.action]} #{r.id} {r.action}{(':' + _html.escape(r.tag)) if r.tag else ''} — <code>{_html.escape(r.src)}</code>" for r in rs.rules]
+    if not rs.rules:
+        lines.append("Пока нет правил.")
+    lines += ["", "<code>/rule add alert type:mention арбитраж</code>",
+              "<code>/rule add alert type:transfer_in,transfer_in_hold amount>5000 unknown</code>",
+              "<code>/rule add tag:спор text:арбитраж</code> • <code>/rule add mute type:like</code>",
+              "Условия: type:, @ник, thread:, amount&gt;N / &lt;N, unknown (не из получателей), слова, /regex/",
+              "<code>/rule del N</code>"]
+    return "\n".join(lines)
+
+@rt.message(Command("rule"))
+async def on_rule(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    args = (m.text or "").split(maxsplit=3)[1:]
+    op = args[0].lower() if args else "list"
+    if op == "add" and len(args) == 3:
+        action, _, tag = args[1].partition(":")
+        src = args[2].strip()
+        if action not in RULE_ACTIONS or (action == "tag" and not tag):
+            await m.reply("⚠️ Действие: alert, tag:имя или mute."); return
         try:
-            s = get_settings()
-            if s.get("push_cards_enabled", True):
-                resp = forum_notifications(limit=10)
-                if resp["ok"]:
-                    arr = resp["data"].get("notifications", [])[:10]
-                    arr = sorted(arr, key=lambda x: x.get("notification_create_date", 0))
-                    last_key = s.get("last_notif_key", "")
-                    new_items = []
-                    if not last_key and arr:
-                        s["last_notif_key"] = _hash_notif(arr[-1]); _save(SETTINGS_FILE, s)
+            AlertRule.compile(0, action, tag, src)
+        except re.error as e:
+            await m.reply(f"⚠️ Ошибка в regex: {_html.escape(str(e))}"); return
+        with STORE.mutex("rules"):
+            data = _load(RULES_FILE, {"items": []})
+            rid = max([int(x.get("id", 0)) for x in data.get("items", [])] + [0]) + 1
+            data.setdefault("items", []).append({"id": rid, "action": action, "tag": tag, "src": src})
+            _save(RULES_FILE, data)
+        await m.answer(f"✅ Правило #{rid} добавлено.\n\n" + render_rules())
+    elif op == "del" and len(args) > 1 and args[1].lstrip("#").isdigit():
+        rid = int(args[1].lstrip("#"))
+        with STORE.mutex("rules"):
+            data = _load(RULES_FILE, {"items": []})
+            _save(RULES_FILE, {"items": [x for x in data.get("items", []) if int(x.get("id", 0)) != rid]})
+        await m.answer(f"🗑 Правило #{rid} удалено.\n\n" + render_rules())
+    else:
+        await m.answer(render_rules())
+
+async def notif_poll_once():
+    s = get_settings()
+    if s.get("push_cards_enabled", True):
+        resp = await asyncio.to_thread(forum_notifications, 10)
+        if resp["ok"]:
+            arr = resp["data"].get("notifications", [])[:10]
+            arr = sorted(arr, key=lambda x: x.get("notification_create_date", 0))
+            last_key = s.get("last_notif_key", "")
+            new_items = []
+            if not last_key and arr:
+                set_setting("last_notif_key", _hash_notif(arr[-1]))
+            else:
+                seen = False
+                for it in arr:
+                    if _hash_notif(it) == last_key:
+                        new_items = []; seen = True
                     else:
-                        seen = False
-                        for it in arr:
-                            if _hash_notif(it) == last_key:
-                                new_items = []; seen = True
-                            else:
-                                new_items.append(it)
-                        if not seen:
-                            new_items = arr
-
-                    allowed = set()
-                    if s["notify_comments"]: allowed.add("comment")
-                    if s["notify_mentions"]: allowed.add("mention")
-                    if s["notify_likes"]: allowed.add("like")
-                    if s["notify_payment_in"]: allowed.add("payment_in")
-                    if s["notify_hold_released"]: allowed.add("hold_released")
-                    if s["notify_profile_post"]: allowed.add("profile_post")
-                    if s["notify_profile_comment"]: allowed.add("profile_comment")
-                    if s["notify_payment_in"]:
-                        allowed.update({"transfer_in", "transfer_in_hold"})
-
-                    for it in new_items:
-                        cid = it.get("notification_id")
-                        content = None
-                        if cid:
-                            c_resp = forum_notification_content(int(cid))
-                            if c_resp.get("ok"):
-                                content = c_resp["data"]
-                        parsed = parse_notif(it.get("notification_html", "") or "", content)
-                        if (parsed.get("type") or "other") not in allowed:
-                            continue
-                        text, kb = render_notif_line(it, content)
-                        if not text.strip():
-                            continue
+                        new_items.append(it)
+                if not seen:
+                    new_items = arr
+
+            if not new_items:
+                return
+            # rendered once for everybody: only types nobody subscribes to are skipped
+            admin = admin_allowed(s)
+            wanted = load_rules().wanted_types()
+            allowed = None if wanted is None else admin.union(wanted, *(x["types"] for x in load_subscribers()))
+            contents = [await _notif_content(it) for it in new_items]
+            rendered = await render_notifs(new_items, contents, allowed)
+            ruled = await asyncio.to_thread(lambda: [(parsed, *apply_rules(parsed, text), kb) for parsed, text, kb in rendered])
+            if any(parsed.type in MONEY_NOTIF_TYPES for parsed, *_ in ruled):
+                BALANCE.nudge()
+            # deliveries go to the sender's outbox and take their slots in order (alerts first), so a throttled
+            # chat delays only its own cards and the poll loop never waits on Telegram pacing
+            futs: Dict[int, asyncio.Task] = {}
+            for i in sorted(range(len(ruled)), key=lambda i: ruled[i][2] != "alert"):
+                parsed, text, verdict, kb = ruled[i]
+                futs[i] = SENDER.enqueue(_deliver_notif(parsed, text, kb, admin, verdict))
+            SENDER.enqueue(_archive_notifs(new_items, [r[0] for r in ruled], [futs[i] for i in range(len(ruled))]))
+            # parsed and rendered is as far as the cursor needs; only the cursor is written so toggles
+            # flipped meanwhile by the handler process survive
+            with STORE.mutex("settings"):
+                set_setting("last_notif_key", _hash_notif(new_items[-1]))
+
+async def _archive_notifs(items: List[dict], parsed: List[ParsedNotif], futs: List[asyncio.Task]):
+    """Archive a cycle's cards once their deliveries settle; on a shutdown cut the finished ones are still kept."""
+    try:
+        if futs:
+            await asyncio.wait(futs)
+    finally:
+        archived = [(it, p, f.result()) for it, p, f in zip(items, parsed, futs)
+                    if f.done() and not f.cancelled() and f.exception() is None]
+        NOTIF_ARCHIVE.append(archived)
+        HOLDS.record_notifs(archived)
+
+async def _notif_content(it: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    cid = it.get("notification_id")
+    if cid:
+        c_resp = await asyncio.to_thread(forum_notification_content, int(cid))
+        if c_resp.get("ok"):
+            return c_resp["data"]
+    return None
+
+async def _deliver_notif(parsed: ParsedNotif, text: Optional[str], kb: Optional[InlineKeyboardMarkup], admin: set,
+                         verdict: str = "") -> bool:
+    ntype = parsed.type or "other"
+    if verdict == "mute":
+        METRICS.inc("lzt_notifications_total", type=ntype, result="muted")
+        return False
+    targets = notif_targets(ntype, admin) if text is not None else []
+    if verdict == "alert" and (ADMIN_USER_ID, None) not in targets:
+        targets.insert(0, (ADMIN_USER_ID, None))
+    if not targets:
+        METRICS.inc("lzt_notifications_total", type=ntype, result="filtered")
+        return False
+    if not text.strip():
+        METRICS.inc("lzt_notifications_total", type=ntype, result="empty")
+        return False
+    sent = await asyncio.gather(*(SENDER.send(chat_id, text, topic=topic, kb=kb) for chat_id, topic in targets))
+    METRICS.inc("notif_fanout_total", sum(sent), result="sent")
+    METRICS.inc("notif_fanout_total", len(sent) - sum(sent), result="dropped")
+    METRICS.inc("lzt_notifications_total", type=ntype, result="sent" if any(sent) else "dropped")
+    return any(sent)
+
+async def notif_poller():
+    try:
+        while True:
+            try:
+                if STORE.lease("notif", NOTIF_POLL_SEC * 3):
+                    await notif_poll_once()
+                    METRICS.inc("worker_cycles_total", worker="notif_poller")
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                METRICS.inc("worker_errors_total", worker="notif_poller")
+                logging.exception("notif_poller cycle failed")
+            if await LIFECYCLE.sleep(NOTIF_POLL_SEC): break
+    finally:
+        STORE.release("notif")
+
+BALANCE_POLL_MIN_SEC = float(os.getenv("BALANCE_POLL_MIN_SEC", "5") or 5)
+BALANCE_POLL_MAX_SEC = float(os.getenv("BALANCE_POLL_MAX_SEC", "60") or 60)
+BALANCE_BACKOFF = 1.5
+MONEY_NOTIF_TYPES = {"transfer_in", "transfer_in_hold", "hold_released", "payment_in"}
+
+def _fmt_delta(x: float) -> str:
+    return f" ({x:+.2f}".rstrip("0").rstrip(".") + ")" if x else ""
+
+class BalanceWatcher:
+    """One /market/me call per tick; the payments page is fetched only when balance or hold moved.
+    The interval drops to BALANCE_POLL_MIN_SEC after a change (or a nudge from a money-related event)
+    and backs off by BALANCE_BACKOFF per quiet tick up to BALANCE_POLL_MAX_SEC."""
+
+    def __init__(self):
+        self.interval = BALANCE_POLL_MIN_SEC
+        self._nudge_seen = 0.0
+
+    def nudge(self):
+        # the watcher may run in another role process, so the nudge goes through state.db
+        self.interval = BALANCE_POLL_MIN_SEC
+        STORE.signal("balance")
+
+    async def wait(self) -> bool:
+        """Sleep ``interval``, cut short by a nudge from any process. True means shutdown."""
+        deadline = time.time() + self.interval
+        while (left := deadline - time.time()) > 0:
+            if await LIFECYCLE.sleep(min(left, BALANCE_POLL_MIN_SEC)):
+                return True
+            ts = STORE.signaled_at("balance")
+            if ts > self._nudge_seen:
+                self._nudge_seen = ts; self.interval = BALANCE_POLL_MIN_SEC
+                break
+        return False
+
+    def poll_once(self) -> Optional[str]:
+        """Blocking; returns the card text when there is something to report."""
+        me = market_me()
+        if not me["ok"]:
+            METRICS.inc("balance_polls_total", result="error")
+            return None
+        _WARM["market_me"] = (time.time(), me)
+        u = (me.get("data") or {}).get("user") or {}
+        cur = [_money(u.get("balance")), _money(u.get("hold"))]
+        s = get_settings()
+        prev = s.get("last_balance")
+        if prev == cur:
+            self.interval = min(BALANCE_POLL_MAX_SEC, self.interval * BALANCE_BACKOFF)
+            METRICS.inc("balance_polls_total", result="same")
+            return None
+        self.interval = BALANCE_POLL_MIN_SEC
+        METRICS.inc("balance_polls_total", result="changed")
+        hist = market_history(limit=10)
+        ops = parse_payments(hist["data"]) if hist["ok"] else []
+        last_op = int(s.get("last_payment_op") or 0)
+        fresh = sorted((p for p in ops if (p.operation_id or 0) > last_op), key=lambda p: p.operation_date)
+        if prev is None or prev[1] != cur[1]:
+            drift = HOLDS.reconcile(cur[1])
+            METRICS.set("holds_drift", drift)
+        with STORE.mutex("settings"):
+            set_setting("last_balance", cur)
+            if ops:
+                set_setting("last_payment_op", max(last_op, *(p.operation_id or 0 for p in ops)))
+        if prev is None or not s.get("notify_balance", True):
+            return None  # first run only sets the baseline
+        cur_name = (u.get("currency") or "rub").upper()
+        lines = [f"💰 <b>Баланс изменился</b>",
+                 f"Доступно: {prev[0]:g} → <b>{cur[0]:g}</b> {cur_name}{_fmt_delta(cur[0] - prev[0])}",
+                 f"Холд: {prev[1]:g} → <b>{cur[1]:g}</b>{_fmt_delta(cur[1] - prev[1])}"]
+        if fresh:
+            lines += [""] + [_payment_line(p) for p in fresh]
+        elif hist["ok"]:
+            lines.append("\n<i>Операция ещё не появилась в истории.</i>")
+        return "\n".join(lines)
+
+BALANCE = BalanceWatcher()
+
+HOLD_DATE_RE = re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4})(?:\D{1,4}(\d{1,2}):(\d{2}))?")
+FORECAST_WINDOWS = ((3600, "1 ч"), (86400, "24 ч"), (7 * 86400, "7 дн"))
+
+def parse_hold_deadline(text: str) -> Optional[int]:
+    """'Холд закончится 21.10.2026 в 12:00' → unix time (local)."""
+    m = HOLD_DATE_RE.search(text or "")
+    if not m:
+        return None
+    d, mo, y, hh, mm = m.groups()
+    try:
+        return int(datetime(int(y), int(mo), int(d), int(hh or 0), int(mm or 0)).timestamp())
+    except ValueError:
+        return None
+
+class HoldLedger:
+    """Incoming (from notifications) and outgoing (our transfers) holds in state.db, indexed by
+    (released, release_ts), so the forecast and the dashboard are range sums over the index."""
+
+    def __init__(self, store: SharedStore):
+        self.store = store; self._ready = False
+
+    def _db(self) -> sqlite3.Connection:
+        c = self.store._conn()
+        if not self._ready:
+            c.execute("CREATE TABLE IF NOT EXISTS holds (id INTEGER PRIMARY KEY, source TEXT UNIQUE, direction TEXT NOT NULL, "
+                      "amount REAL NOT NULL, release_ts INTEGER NOT NULL, created_ts INTEGER NOT NULL, counterparty TEXT NOT NULL, "
+                      "released INTEGER NOT NULL DEFAULT 0)")
+            c.execute("CREATE INDEX IF NOT EXISTS holds_due ON holds(released, direction, release_ts)")
+            self._ready = True
+        return c
+
+    def add(self, source: str, direction: str, amount: float, release_ts: int, counterparty: str = "") -> bool:
+        cur = self._db().execute("INSERT OR IGNORE INTO holds(source, direction, amount, release_ts, created_ts, counterparty) "
+                                 "VALUES(?, ?, ?, ?, ?, ?)", (source, direction, amount, int(release_ts), int(time.time()), counterparty))
+        return cur.rowcount > 0
+
+    def record_notifs(self, rows: List[Tuple[dict, ParsedNotif, bool]]):
+        for it, p, _sent in rows:
+            if p.type == "transfer_in_hold":
+                due, amount = parse_hold_deadline(p.snippet), p.amount
+                if due and amount and self.add(_hash_notif(it), "in", amount, due, p.actor_name):
+                    METRICS.inc("holds_recorded_total", direction="in")
+            elif p.type == "hold_released" and p.amount:
+                self.release_matching(p.amount)
+
+    def release_matching(self, amount: float):
+        """A 'hold released' notification closes the pending incoming hold with that amount that is due first."""
+        c = self._db()
+        row = c.execute("SELECT id FROM holds WHERE released=0 AND direction='in' AND abs(amount-?)<0.01 ORDER BY release_ts LIMIT 1",
+                        (amount,)).fetchone()
+        if row:
+            c.execute("UPDATE holds SET released=1 WHERE id=?", row)
+
+    def pending(self, direction: str = "in", now: Optional[int] = None) -> float:
+        now = int(now or time.time())
+        row = self._db().execute("SELECT coalesce(sum(amount), 0) FROM holds WHERE released=0 AND direction=? AND release_ts>?",
+                                 (direction, now)).fetchone()
+        return round(row[0], 2)
+
+    def forecast(self, now: Optional[int] = None) -> List[Tuple[str, float]]:
+        now = int(now or time.time())
+        c = self._db()
+        return [(label, round(c.execute("SELECT coalesce(sum(amount), 0) FROM holds WHERE released=0 AND direction='in' "
+                                        "AND release_ts>? AND release_ts<=?", (now, now + sec)).fetchone()[0], 2))
+                for sec, label in FORECAST_WINDOWS]
+
+    def upcoming(self, n: int = 5, now: Optional[int] = None) -> List[Tuple[str, float, int, str]]:
+        rows = self._db().execute("SELECT direction, amount, release_ts, counterparty FROM holds WHERE released=0 AND release_ts>? "
+                                  "ORDER BY release_ts LIMIT ?", (int(now or time.time()), n))
+        return rows.fetchall()
+
+    def drift(self, api_hold: float) -> float:
+        """Difference between the API's hold and what the ledger expects. Positive: holds we never saw a notification for."""
+        return round(api_hold - self.pending("in"), 2)
+
+    def reconcile(self, api_hold: float) -> float:
+        """``drift`` after closing every incoming entry if the API reports nothing on hold. Only the balance watcher calls it."""
+        if api_hold < 0.01:
+            self._db().execute("UPDATE holds SET released=1 WHERE released=0 AND direction='in'")
+        return self.drift(api_hold)
+
+HOLDS = HoldLedger(STORE)
+
+def render_holds() -> str:
+    bal = get_settings().get("last_balance")
+    lines = ["🔒 <b>Холды</b>"]
+    if bal:
+        drift = HOLDS.drift(bal[1])
+        lines.append(f"Доступно: <b>{bal[0]:g}</b> • Холд по API: <b>{bal[1]:g}</b> • по учёту: <b>{HOLDS.pending('in'):g}</b>")
+        if abs(drift) >= 0.01:
+            lines.append(f"⚠️ Расхождение: {drift:+g} (холды без уведомления или уже снятые)")
+    fc = HOLDS.forecast()
+    lines.append("🔓 Разморозится: " + " • ".join(f"{label} +{v:g}" for label, v in fc))
+    if bal:
+        lines.append(f"📈 Доступно через {fc[-1][0]}: <b>{bal[0] + fc[-1][1]:g}</b>")
+    out_pending = HOLDS.pending("out")
+    if out_pending:
+        lines.append(f"📤 Наши переводы в холде: {out_pending:g}")
+    up = HOLDS.upcoming(10)
+    if up:
+        lines += ["", "⏳ <b>Ближайшие</b>"]
+        lines += [f"{'🟢' if d == 'in' else '🔴'} {_ts(ts)} — {amt:g} RUB{(' • ' + _html.escape(who)) if who else ''}" for d, amt, ts, who in up]
+    return "\n".join(lines)
+
+@rt.message(Command("holds"))
+async def on_holds(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    await m.answer(render_holds())
+
+async def balance_watcher():
+    try:
+        while True:
+            try:
+                if STORE.lease("balance", BALANCE_POLL_MAX_SEC * 3):
+                    card = await asyncio.to_thread(BALANCE.poll_once)
+                    METRICS.inc("worker_cycles_total", worker="balance_watcher")
+                    if card:
                         try:
-                            await bot.send_message(ADMIN_USER_ID, text, reply_markup=kb, disable_web_page_preview=True)
+                            await bot.send_message(ADMIN_USER_ID, card, disable_web_page_preview=True)
                         except Exception:
-                            pass
-                    if arr:
-                        s["last_notif_key"] = _hash_notif(arr[-1]); _save(SETTINGS_FILE, s)
-            await asyncio.sleep(20)
-        except asyncio.CancelledError:
-            break
-        except Exception:
-            await asyncio.sleep(20)
+                            METRICS.inc("tg_send_failures_total", where="balance")
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                METRICS.inc("worker_errors_total", worker="balance_watcher")
+                logging.exception("balance_watcher cycle failed")
+            if await BALANCE.wait(): break
+    finally:
+        STORE.release("balance")
 
 BUMP_TICK_SEC = 30          
 BUMP_JITTER_SEC = (7, 25)   
+BUMP_LEASE_SEC = BUMP_TICK_SEC * 3  # outlives one bump call (25 s timeout + rate-limit wait) by a wide margin
+BUMP_RETRY_MARGIN_SEC = 15
+BUMP_PARK_AFTER = 2
+BUMP_PERMANENT = {"closed", "forbidden", "not_found"}
+BUMP_ERR_HUMAN = {
+    "cooldown": "кулдаун", "rate_limited": "лимит запросов", "closed": "тема закрыта",
+    "forbidden": "нет прав", "not_found": "тема не найдена", "auth": "токен не подошёл", "transient": "ошибка сети/сервера",
+}
+WAIT_UNIT_RE = re.compile(r"(\d+)\s*(дн|ден|д\b|day|час|ч\b|hour|h\b|мин|min|m\b|сек|sec|s\b)", re.IGNORECASE)
+WAIT_UNIT_SEC = {"дн": 86400, "ден": 86400, "д": 86400, "day": 86400, "час": 3600, "ч": 3600, "hour": 3600, "h": 3600,
+                 "мин": 60, "min": 60, "m": 60, "сек": 1, "sec": 1, "s": 1}
+
+def _resp_error_text(resp: Dict[str, Any]) -> str:
+    out: List[str] = []
+    def walk(x):
+        if isinstance(x, str): out.append(x)
+        elif isinstance(x, dict):
+            for v in x.values(): walk(v)
+        elif isinstance(x, list):
+            for v in x: walk(v)
+    walk(resp.get("error"))
+    return " ".join(out).lower()
+
+def _wait_seconds(resp: Dict[str, Any], text: str, now: int) -> Optional[int]:
+    err = resp.get("error") if isinstance(resp.get("error"), dict) else {}
+    for v in (resp.get("retry_after"), err.get("retry_after"), err.get("time_left"), err.get("wait"), err.get("cooldown")):
+        if str(v or "").isdigit():
+            return int(v)
+    for k in ("next_bump_date", "bump_available_date", "available_at"):
+        if str(err.get(k) or "").isdigit() and int(err[k]) > now:
+            return int(err[k]) - now
+    cut = max(text.rfind(w) for w in ("через", "подождите", "осталось", "wait", "after"))
+    total = 0
+    for num, unit in WAIT_UNIT_RE.findall(text[cut:] if cut > 0 else text):
+        total += int(num) * WAIT_UNIT_SEC.get(unit.lower(), 0)
+    return total or None
+
+def classify_bump_error(resp: Dict[str, Any], now: int) -> Tuple[str, Optional[int]]:
+    status = int(resp.get("status", 0) or 0)
+    text = _resp_error_text(resp)
+    if status == 429:
+        return "rate_limited", _wait_seconds(resp, text, now)
+    if any(w in text for w in ("через", "подождите", "можно будет", "уже поднимал", "cooldown", "wait", "once every", "too soon")):
+        return "cooldown", _wait_seconds(resp, text, now)
+    if status == 401:
+        return "auth", None
+    if status == 404:
+        return "not_found", None
+    if "закрыт" in text or "closed" in text:
+        return "closed", None
+    if status == 403:
+        return "forbidden", None
+    return "transient", None
+
+BUMP_BUDGET_PER_MIN = int(os.getenv("BUMP_BUDGET_PER_MIN", "6") or 6)
+BUMP_WINDOW_RE = re.compile(r"([01]?\d|2[0-3]):([0-5]\d)\s*-\s*([01]?\d|2[0-3]):([0-5]\d)")
+
+def _next_slot(after: int, period: int, phase: int) -> int:
+    return after + (phase - after) % period
+
+def parse_bump_window(text: str) -> Optional[str]:
+    m = BUMP_WINDOW_RE.fullmatch((text or "").strip())
+    if not m: return None
+    return f"{int(m.group(1)):02d}:{m.group(2)}-{int(m.group(3)):02d}:{m.group(4)}"
+
+def _window_open_at(now: int, window: str) -> int:
+    """``now`` if inside the daily HH:MM-HH:MM window (may wrap midnight), else the next opening."""
+    m = BUMP_WINDOW_RE.fullmatch(window or "")
+    if not m: return now
+    start = int(m.group(1)) * 60 + int(m.group(2)); end = int(m.group(3)) * 60 + int(m.group(4))
+    dt = datetime.fromtimestamp(now)
+    cur = dt.hour * 60 + dt.minute
+    inside = start <= cur < end if start < end else (cur >= start or cur < end)
+    if inside or start == end:
+        return now
+    midnight = int(dt.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    open_ts = midnight + start * 60
+    return open_ts if open_ts > now else open_ts + 86400
+
+def plan_bumps(threads: List[BumpEntry], now: int) -> bool:
+    """Spread threads sharing an interval evenly over it; reschedule those whose phase moved."""
+    groups: Dict[int, List[BumpEntry]] = {}
+    for th in threads:
+        if not th.parked:
+            groups.setdefault(th.effective_min, []).append(th)
+    changed = False
+    for iv_min, group in groups.items():
+        group.sort(key=lambda t: t.thread_id)
+        step = iv_min * 60 / len(group)
+        for i, th in enumerate(group):
+            phase = int(i * step)
+            if th.phase_sec == phase:
+                continue
+            th.phase_sec = phase; changed = True
+            if th.last_error == "cooldown" and th.next_bump_ts > now:
+                continue
+            earliest = th.last_bump_ts + int(iv_min * 60 * 0.9) if th.last_bump_ts else now
+            th.next_bump_ts = _next_slot(max(now, earliest), iv_min * 60, phase)
+    return changed
+
+def _bump_log_db() -> sqlite3.Connection:
+    # in state.db, not process memory: the worker and a manual "bump now" in the handler process share one budget
+    c = STORE._conn()
+    c.execute("CREATE TABLE IF NOT EXISTS bump_log (ts REAL NOT NULL)")
+    return c
+
+def _bump_budget_left(now: float) -> int:
+    c = _bump_log_db()
+    c.execute("DELETE FROM bump_log WHERE ts<=?", (now - 60,))
+    return BUMP_BUDGET_PER_MIN - c.execute("SELECT count(*) FROM bump_log").fetchone()[0]
+
+def apply_bump_result(th: BumpEntry, resp: Dict[str, Any], now: int) -> str:
+    iv_sec = th.effective_min * 60
+    _bump_log_db().execute("INSERT INTO bump_log VALUES(?)", (time.time(),))
+    if resp.get("ok"):
+        th.last_bump_ts = now
+        th.next_bump_ts = _next_slot(now + int(iv_sec * 0.9), iv_sec, th.phase_sec)
+        th.fail_count = 0; th.last_error = ""
+        METRICS.inc("lzt_bumps_total", result="ok", category="ok")
+        return "ok"
+    cat, wait = classify_bump_error(resp, now)
+    METRICS.inc("lzt_bumps_total", result="err", category=cat)
+    th.last_error = cat
+    if cat == "cooldown":
+        th.fail_count = 0
+        th.next_bump_ts = now + (wait if wait else iv_sec) + BUMP_RETRY_MARGIN_SEC
+        return f"кулдаун до {_ts(th.next_bump_ts)}"
+    if cat == "rate_limited":
+        th.next_bump_ts = now + (wait or 60) + random.randint(*BUMP_JITTER_SEC)
+        return f"err {resp.get('status')} ({BUMP_ERR_HUMAN[cat]})"
+    th.fail_count += 1
+    if cat in BUMP_PERMANENT and th.fail_count >= BUMP_PARK_AFTER:
+        th.parked = cat
+        return f"⏸ на паузе — {BUMP_ERR_HUMAN[cat]}"
+    if cat == "auth":
+        th.next_bump_ts = now + 600
+    else:
+        th.next_bump_ts = now + min(iv_sec, 60 * 2 ** min(th.fail_count - 1, 5))
+    return f"err {resp.get('status')} ({BUMP_ERR_HUMAN[cat]})"
+
+BUMP_STATS_ENABLED = os.getenv("BUMP_STATS", "1") not in ("0", "false", "no", "")
+BUMP_STATS_KEEP = 48        # samples per thread
+BUMP_GAIN_LOW = 2.0         # views/hour after a bump below which the interval backs off
+BUMP_GAIN_HIGH = 10.0       # views/hour (or any new reply) that pulls it back towards the base
+BUMP_TUNE_MAX_MIN = 240
+
+def load_bump_stats() -> Dict[str, List[List[int]]]:
+    data = _load(BUMP_STATS_FILE, {})
+    return data if isinstance(data, dict) else {}
+
+def thread_stats(resp: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    t = (resp.get("data") or {}).get("thread") if resp.get("ok") else None
+    if not isinstance(t, dict):
+        return None
+    try:
+        return int(t.get("thread_view_count") or 0), int(t.get("thread_post_count") or 0)
+    except (TypeError, ValueError):
+        return None
+
+def bump_gain(series: List[List[int]]) -> Optional[Tuple[float, int]]:
+    """Views/hour and new replies between the last two post-bump samples."""
+    if len(series) < 2:
+        return None
+    (t0, v0, r0), (t1, v1, r1) = series[-2], series[-1]
+    hours = max(t1 - t0, 60) / 3600
+    return max(0, v1 - v0) / hours, max(0, r1 - r0)
+
+def tune_interval(th: BumpEntry, series: List[List[int]]) -> bool:
+    """Double the interval of a thread that gains nothing from bumps, halve it back once bumps pay off."""
+    gain = bump_gain(series)
+    if gain is None:
+        return False
+    per_h, replies = gain
+    cur = th.effective_min
+    if replies == 0 and per_h < BUMP_GAIN_LOW:
+        new = min(cur * 2, max(BUMP_TUNE_MAX_MIN, th.interval_min))
+    elif replies > 0 or per_h >= BUMP_GAIN_HIGH:
+        new = max(th.interval_min, cur // 2)
+    else:
+        return False
+    if new == cur:
+        return False
+    th.tuned_min = new if new > th.interval_min else 0
+    METRICS.inc("lzt_bump_retunes_total", direction="up" if new > cur else "down")
+    return True
+
+async def record_bump_stats(bumped: List[int], now: int) -> Dict[int, List[List[int]]]:
+    """Sample views/replies of freshly bumped threads and extend their series; returns the updated series."""
+    if not BUMP_STATS_ENABLED or not bumped:
+        return {}
+    samples = {tid: thread_stats(await asyncio.to_thread(thread_get, tid)) for tid in bumped}
+    out: Dict[int, List[List[int]]] = {}
+    with STORE.mutex("bump_stats"):
+        stats = load_bump_stats()
+        for tid, cur in samples.items():
+            if cur is None:
+                continue
+            series = stats.setdefault(str(tid), [])
+            series.append([now, cur[0], cur[1]])
+            del series[:-BUMP_STATS_KEEP]
+            out[tid] = series
+        _save(BUMP_STATS_FILE, stats)
+    return out
+
+def retune_bumps(series: Dict[int, List[List[int]]], now: int):
+    def fn(arr: List[BumpEntry]):
+        if any([tune_interval(th, series[th.thread_id]) for th in arr if th.thread_id in series]):
+            plan_bumps(arr, now)
+    if series:
+        mutate_bumps(fn)
+
+def record_bump(tid: int, resp: Dict[str, Any], now: int) -> Optional[str]:
+    """Apply a bump response to the stored entry of ``tid``; None if the thread was removed meanwhile."""
+    def fn(arr: List[BumpEntry]) -> Optional[str]:
+        th = next((t for t in arr if t.thread_id == tid), None)
+        return apply_bump_result(th, resp, now) if th else None
+    return mutate_bumps(fn)
+
+async def bump_thread(tid: int, now: int) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """The single bump path for the worker and the handlers: the shared per-minute budget, a per-thread
+    lease so two processes never bump the same thread, the API call off the loop and the result
+    recorded through the planner. (response, result line); the response is None when skipped."""
+    if _bump_budget_left(time.time()) <= 0:
+        METRICS.inc("lzt_bumps_deferred_total")
+        return None, "отложено — лимит поднятий в минуту"
+    lease = f"bump:{tid}"
+    if not STORE.lease(lease, BUMP_LEASE_SEC):
+        return None, "уже поднимается другим процессом"
+    try:
+        th = next((b for b in load_bumps() if b.thread_id == tid), None)
+        if th is not None and th.last_bump_ts >= now:
+            return None, "уже поднята"
+        resp = await asyncio.to_thread(thread_bump, tid)
+        return resp, record_bump(tid, resp, now)
+    finally:
+        STORE.release(lease)
+
+def _bump_line(th: BumpEntry, stats: Optional[Dict[str, List[List[int]]]] = None) -> str:
+    last = th.last_bump_ts
+    line = f"• #{th.thread_id} каждые {th.interval_min} мин • последний: { _ts(last) if last else '—' }"
+    if th.tuned_min:
+        line += f" • 🐢 авто {th.tuned_min} мин"
+    series = (stats or {}).get(str(th.thread_id)) or []
+    gain = bump_gain(series)
+    if gain is not None:
+        line += f" • 📈 +{gain[0]:.0f} просм/ч" + (f", +{gain[1]} отв." if gain[1] else "")
+    elif series:
+        line += f" • 👁 {series[-1][1]}"
+    if th.parked:
+        line += f" • ⏸ {BUMP_ERR_HUMAN.get(th.parked, th.parked)}"
+    elif th.last_error == "cooldown":
+        line += f" • кулдаун до {_ts(th.next_bump_ts)}"
+    if th.window:
+        line += f" • 🕘 {th.window}"
+    return line
+
+def _due_bumps(threads: List[BumpEntry], now: int) -> List[Tuple[int, int]]:
+    plan_bumps(threads, now)
+    due: List[Tuple[int, int]] = []
+    for th in threads:
+        if th.parked:
+            continue
+        next_ts = th.next_bump_ts
+
+        if next_ts <= 0:
+            next_ts = th.last_bump_ts + th.effective_min * 60 if th.last_bump_ts else now
+
+        if now < next_ts:
+            continue
+
+        open_ts = _window_open_at(now, th.window)
+        if open_ts > now:
+            th.next_bump_ts = open_ts + th.phase_sec % 600
+            continue
+        due.append((next_ts, th.thread_id))
+    due.sort()
+    return due
+
+async def autobump_once():
+    now = int(time.time())
+    results = []
+    due = mutate_bumps(lambda threads: _due_bumps(threads, now))
+
+    bumped: List[int] = []
+    for i, (next_ts, tid) in enumerate(due):
+        if _bump_budget_left(time.time()) <= 0:
+            METRICS.inc("lzt_bumps_deferred_total", len(due) - i)
+            break
+        # renewed before every bump: a long cycle must not outlive the lease, or a standby that took it
+        # over would bump the same due threads; once the lease is lost the rest is left to the new holder
+        if not STORE.lease("autobump", BUMP_LEASE_SEC):
+            METRICS.inc("lzt_bumps_lease_lost_total")
+            logging.warning("autobump lease lost mid-cycle, %d due threads left to the new holder", len(due) - i)
+            break
+        METRICS.observe("lzt_bump_lateness_seconds", max(0, now - next_ts), buckets=LATENESS_BUCKETS)
+        # persisted per bump so a cancelled or killed cycle never re-bumps on restart
+        resp, res = await bump_thread(tid, now)
+        if resp is None or res is None:
+            continue
+        results.append(f"#{tid}: {res}")
+        if resp.get("ok"):
+            bumped.append(tid)
+
+    retune_bumps(await record_bump_stats(bumped, now), now)
+
+    if results:
+        try:
+            await bot.send_message(ADMIN_USER_ID, "⏫ Автоподнятие:\n" + "\n".join(results))
+        except Exception:
+            METRICS.inc("tg_send_failures_total", where="autobump")
 
 async def autobump_worker():
-    await asyncio.sleep(2)
+    # after a crash a bump may have gone out without being saved: give its cooldown a tick to show up
+    if await LIFECYCLE.sleep(0 if LIFECYCLE.clean_start else BUMP_TICK_SEC): return
+    try:
+        while True:
+            try:
+                # only the lease holder bumps; a standby process takes over once the lease expires
+                if STORE.lease("autobump", BUMP_LEASE_SEC):
+                    await autobump_once()
+                    METRICS.inc("worker_cycles_total", worker="autobump_worker")
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                METRICS.inc("worker_errors_total", worker="autobump_worker")
+                logging.exception("autobump_worker cycle failed")
+            if await LIFECYCLE.sleep(BUMP_TICK_SEC): break
+    finally:
+        STORE.release("autobump")
+
+
+LOOP_LAG_INTERVAL_SEC = 1.0
+
+async def loop_lag_monitor():
+    loop = asyncio.get_running_loop()
     while True:
+        t0 = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SEC)
+        lag = max(0.0, loop.time() - t0 - LOOP_LAG_INTERVAL_SEC)
+        METRICS.set("event_loop_lag_last_seconds", lag)
+        METRICS.observe("event_loop_lag_seconds", lag, buckets=LAG_BUCKETS)
+
+MARKET_TICK_SEC = 15
+MARKET_MIN_INTERVAL_SEC = 60
+MARKET_DEFAULT_INTERVAL_SEC = 300
+MARKET_MAX_CARDS = 10          # per search per poll; the rest is summarised
+MARKET_SEEN_BITS = 1 << 20     # per generation: 128 KB
+MARKET_SEEN_HASHES = 7
+MARKET_SEEN_CAPACITY = 50000   # items per generation (~1% false positives at this fill)
+MARKET_URL_RE = re.compile(r"(?:https?://)?(?:www\.)?lzt\.market/([A-Za-z0-9_-]*)/?(?:\?(\S*))?")
+
+class RotatingBloom:
+    """Seen-set with bounded memory: two Bloom generations, lookups check both, inserts go to the
+    current one, and a full generation retires the oldest. Kept in state.db so restarts remember."""
+
+    def __init__(self, store: SharedStore, bits: int = MARKET_SEEN_BITS, hashes: int = MARKET_SEEN_HASHES,
+                 capacity: int = MARKET_SEEN_CAPACITY):
+        self.store = store; self.bits = bits; self.hashes = hashes; self.capacity = capacity
+        self.gens: Optional[List[bytearray]] = None; self.n = 0; self.dirty = False
+
+    def _db(self) -> sqlite3.Connection:
+        c = self.store._conn()
+        c.execute("CREATE TABLE IF NOT EXISTS market_seen (gen INTEGER PRIMARY KEY, n INTEGER NOT NULL, bits BLOB NOT NULL)")
+        return c
+
+    def load(self):
+        rows = {g: (n, b) for g, n, b in self._db().execute("SELECT gen, n, bits FROM market_seen")}
+        size = self.bits // 8
+        self.gens = [bytearray(rows[g][1]) if g in rows and len(rows[g][1]) == size else bytearray(size) for g in (0, 1)]
+        self.n = rows.get(0, (0, b""))[0]
+
+    def save(self):
+        if self.dirty and self.gens is not None:
+            with self.store.mutex("market_seen"):
+                self._db().executemany("INSERT OR REPLACE INTO market_seen VALUES(?, ?, ?)",
+                                       [(0, self.n, bytes(self.gens[0])), (1, 0, bytes(self.gens[1]))])
+            self.dirty = False
+
+    def _idx(self, key: str) -> List[int]:
+        h = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        a, b = int.from_bytes(h[:8], "little"), int.from_bytes(h[8:], "little") | 1
+        return [(a + i * b) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, key: str) -> bool:
+        if self.gens is None:
+            self.load()
+        idx = self._idx(key)
+        return any(all(g[i >> 3] >> (i & 7) & 1 for i in idx) for g in self.gens)
+
+    def add(self, key: str) -> bool:
+        """True if ``key`` was not seen before (and is now)."""
+        if self.gens is None:
+            self.load()
+        idx = self._idx(key)
+        if all(self.gens[0][i >> 3] >> (i & 7) & 1 for i in idx):
+            return False
+        # a hit in the old generation is copied forward, so a listing that stays up outlives rotations
+        fresh = not all(self.gens[1][i >> 3] >> (i & 7) & 1 for i in idx)
+        if self.n >= self.capacity:
+            self.gens = [bytearray(self.bits // 8), self.gens[0]]; self.n = 0
+            METRICS.inc("market_seen_rotations_total")
+        cur = self.gens[0]
+        for i in idx:
+            cur[i >> 3] |= 1 << (i & 7)
+        self.n += 1; self.dirty = True
+        return fresh
+
+MARKET_SEEN = RotatingBloom(STORE)
+
+def load_searches() -> List[Dict[str, Any]]:
+    return _load(MARKET_SEARCHES_FILE, {"items": []}).get("items", [])
+
+def parse_market_search(text: str) -> Optional[Tuple[str, List[Tuple[str, str]], int]]:
+    """``https://lzt.market/steam/?pmax=100&title=cs every:10m`` or ``steam pmax=100 title=cs`` → (category, params, interval)."""
+    interval, params, category = MARKET_DEFAULT_INTERVAL_SEC, [], None
+    for tok in text.split():
+        m = MARKET_URL_RE.fullmatch(tok)
+        if tok.startswith("every:"):
+            me = re.fullmatch(r"(\d+)(m|h)", tok[6:].lower())
+            if not me: return None
+            interval = max(MARKET_MIN_INTERVAL_SEC, int(me.group(1)) * (60 if me.group(2) == "m" else 3600))
+        elif m:
+            category = m.group(1) or ""
+            params += parse_qsl(m.group(2) or "")
+        elif "=" in tok:
+            k, _, v = tok.partition("=")
+            params.append((k, v))
+        elif category is None and re.fullmatch(r"[A-Za-z0-9_-]+", tok):
+            category = tok
+        else:
+            return None
+    return (category or "", params, interval) if category is not None or params else None
+
+def _search_title(x: Dict[str, Any]) -> str:
+    q = "&".join(f"{k}={v}" for k, v in x["params"])
+    return f"{x['category'] or 'все'}{('?' + q) if q else ''}"
+
+def _claim_due_searches(now: int) -> List[Dict[str, Any]]:
+    with STORE.mutex("market"):
+        items, due = load_searches(), []
+        for x in items:
+            if x.get("next_ts", 0) <= now:
+                due.append(dict(x))
+                # advance by whole intervals so each search keeps its own phase and they stay spread out
+                x["next_ts"] = now + x["interval"] - (now - x.get("next_ts", 0)) % x["interval"]
+        if due:
+            _save(MARKET_SEARCHES_FILE, {"items": items})
+    return due
+
+def _mark_primed(sid: int):
+    with STORE.mutex("market"):
+        items = load_searches()
+        for x in items:
+            if x["id"] == sid: x["primed"] = True
+        _save(MARKET_SEARCHES_FILE, {"items": items})
+
+def _market_card(x: Dict[str, Any], it: Dict[str, Any]) -> str:
+    iid = it.get("item_id")
+    title = _clean_text(str(it.get("title") or it.get("title_en") or f"#{iid}"))[:120]
+    return (f"🛒 <a href=\"https://lzt.market/{iid}/\">{_html.escape(title)}</a>\n"
+            f"💰 <b>{it.get('price')}</b> {(it.get('price_currency') or 'rub').upper()} • 🔎 #{x['id']} {_html.escape(_search_title(x))}")
+
+async def market_tick_once(now: Optional[int] = None) -> int:
+    now = int(now or time.time())
+    due = await asyncio.to_thread(_claim_due_searches, now)
+    pushed = 0
+    for x in due:
+        resp = await asyncio.to_thread(market_search, x["category"], [tuple(p) for p in x["params"]])
+        if not resp["ok"]:
+            METRICS.inc("market_polls_total", result="error")
+            continue
+        items = [it for it in (resp.get("data") or {}).get("items") or [] if it.get("item_id")]
+        fresh = []
+        for it in items:
+            key = f"{x['id']}:{it['item_id']}"
+            if key in MARKET_SEEN:
+                MARKET_SEEN.add(key)  # still listed: refresh it into the current generation
+            else:
+                fresh.append(it)
+        METRICS.inc("market_polls_total", result="ok")
+        if not x.get("primed"):
+            # first poll only fills the seen-set
+            for it in fresh:
+                MARKET_SEEN.add(f"{x['id']}:{it['item_id']}")
+            await asyncio.to_thread(_mark_primed, x["id"])
+            continue
+        # seen only once delivered: a failed send is retried next poll, and the overflow is pushed by the next polls
+        for it in fresh[:MARKET_MAX_CARDS]:
+            if await SENDER.send(ADMIN_USER_ID, _market_card(x, it), where="market"):
+                MARKET_SEEN.add(f"{x['id']}:{it['item_id']}"); pushed += 1
+        if len(fresh) > MARKET_MAX_CARDS:
+            METRICS.inc("market_items_backlog_total", len(fresh) - MARKET_MAX_CARDS)
+            await SENDER.send(ADMIN_USER_ID, f"🛒 …и ещё {len(fresh) - MARKET_MAX_CARDS} новых по #{x['id']} — придут со следующими опросами",
+                              where="market")
+    METRICS.inc("market_items_pushed_total", pushed)
+    await asyncio.to_thread(MARKET_SEEN.save)
+    return pushed
+
+async def market_watcher():
+    try:
+        while True:
+            try:
+                if STORE.lease("market", MARKET_TICK_SEC * 3):
+                    await market_tick_once()
+                    METRICS.inc("worker_cycles_total", worker="market_watcher")
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                METRICS.inc("worker_errors_total", worker="market_watcher")
+                logging.exception("market_watcher cycle failed")
+            if await LIFECYCLE.sleep(MARKET_TICK_SEC): break
+    finally:
+        STORE.release("market")
+
+def render_searches() -> str:
+    items = load_searches()
+    lines = ["🛒 <b>Слежение за маркетом</b>"]
+    lines += [f"• #{x['id']} <code>{_html.escape(_search_title(x))}</code> — раз в {_dur(x['interval'])}, след. {_ts(x.get('next_ts', 0))}"
+              for x in items]
+    if not items:
+        lines.append("Пока нет сохранённых поисков.")
+    lines += ["", "<code>/watch add https://lzt.market/steam/?pmax=100 every:10m</code>",
+              "<code>/watch add steam pmax=100 title=cs</code> • <code>/watch del N</code>",
+              f"Первый опрос только запоминает текущие лоты; дальше приходят только новые (до {MARKET_MAX_CARDS} карточек за опрос, остальные — следующими опросами)."]
+    return "\n".join(lines)
+
+@rt.message(Command("watch"))
+async def on_watch(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    args = (m.text or "").split(maxsplit=2)[1:]
+    op = args[0].lower() if args else "list"
+    if op == "add" and len(args) == 2:
+        parsed = parse_market_search(args[1])
+        if not parsed:
+            await m.reply("⚠️ Пришли ссылку на поиск маркета или «категория ключ=значение …»."); return
+        category, params, interval = parsed
+        with STORE.mutex("market"):
+            items = load_searches()
+            sid = max([int(x["id"]) for x in items] + [0]) + 1
+            # golden-ratio phase: searches sharing an interval land in different ticks instead of bursting together
+            phase = int((sid * 0.618034 % 1) * interval)
+            items.append({"id": sid, "category": category, "params": [list(p) for p in params], "interval": interval,
+                          "next_ts": int(time.time()) + phase, "primed": False})
+            _save(MARKET_SEARCHES_FILE, {"items": items})
+        await m.answer(f"✅ Поиск #{sid} сохранён.\n\n" + render_searches())
+    elif op == "del" and len(args) == 2 and args[1].lstrip("#").isdigit():
+        sid = int(args[1].lstrip("#"))
+        with STORE.mutex("market"):
+            _save(MARKET_SEARCHES_FILE, {"items": [x for x in load_searches() if int(x["id"]) != sid]})
+        await m.answer(f"🗑 Поиск #{sid} удалён.\n\n" + render_searches())
+    else:
+        await m.answer(render_searches())
+
+EXPORT_SPOOL_BYTES = 1 << 20          # rows stay in RAM up to this, then spill to a temp file
+EXPORT_MAX_BYTES = 49 * 1024 * 1024   # Telegram bot upload limit is 50 MB
+EXPORT_MAX_PAGES = 1000
+EXPORT_KINDS = {"payments": "операции", "notes": "заметки", "archive": "архив уведомлений", "bumps": "статистика поднятий"}
+
+def export_payments(since: int = 0):
+    """Walks the payment history backwards page by page (operation_id_lt cursor); one page in memory at a time."""
+    cursor = None
+    for _ in range(EXPORT_MAX_PAGES):
+        resp = market_history(limit=100, operation_id_lt=cursor)
+        if not resp["ok"]:
+            raise RuntimeError(f"/user/payments: {resp.get('status')}")
+        page = sorted(parse_payments(resp["data"]), key=lambda p: p.operation_id or 0, reverse=True)
+        if not page:
+            return
+        for p in page:
+            if p.operation_date < since:
+                return
+            yield p.to_dict()
+        if page[-1].operation_id is None or page[-1].operation_id == cursor:
+            return
+        cursor = page[-1].operation_id
+
+def export_notes(since: int = 0):
+    NOTES_INDEX.sync()
+    for (doc,) in NOTES_INDEX._db().execute("SELECT doc FROM notes_fts ORDER BY rowid"):
+        row = json.loads(doc)
+        if int(row.get("created_at") or 0) >= since:
+            yield row
+
+def export_archive(since: int = 0):
+    # runs in a worker thread, so this is that thread's own connection; WAL lets the poller keep appending
+    rows = NOTIF_ARCHIVE._db().execute("SELECT nkey, ts, delivered, body FROM notif_archive WHERE ts>=? ORDER BY ts", (since,))
+    for nkey, ts, delivered, body in rows:
+        yield {"key": nkey, "ts": ts, "delivered": bool(delivered), **_unpack(body)}
+
+def export_bumps(since: int = 0):
+    for tid, series in sorted(load_bump_stats().items()):
+        for ts, views, replies in series:
+            if ts >= since:
+                yield {"thread_id": int(tid), "ts": ts, "views": views, "replies": replies}
+
+EXPORT_SOURCES = {"payments": export_payments, "notes": export_notes, "archive": export_archive, "bumps": export_bumps}
+
+def write_export(rows, fmt: str, gz: bool) -> Tuple[Any, int]:
+    """Stream ``rows`` into a spooled temp file as CSV (columns from the first row) or JSONL. Returns (file, rows)."""
+    import csv, gzip, io, tempfile  # deferred: only /export needs them
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    raw = gzip.GzipFile(fileobj=spool, mode="wb", mtime=0) if gz else spool
+    out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    n, writer = 0, None
+    try:
         try:
-            cfg = _load(BUMPS_FILE, {"threads": []})
-            threads = cfg.get("threads", [])
-            if not isinstance(threads, list):
-                threads = []
-
-            now = int(time.time())
-            changed = False
-            results = []
-
-            for th in threads:
-                try:
-                    tid = int(th.get("thread_id"))
-                except Exception:
-                    continue
-                iv_min = max(5, int(th.get("interval_min", 10))) 
-                last_ts = int(th.get("last_bump_ts", 0))
-                next_ts = int(th.get("next_bump_ts", 0))
-
-                if next_ts <= 0:
-                    next_ts = last_ts + iv_min * 60 if last_ts else now
-
-                if now < next_ts:
-                    continue
-
-                resp = thread_bump(tid)
-                if resp.get("ok"):
-                    th["last_bump_ts"] = now
-                    jitter = random.randint(*BUMP_JITTER_SEC)
-                    th["next_bump_ts"] = now + iv_min * 60 + jitter
-                    results.append(f"#{tid}: ok")
+            for row in rows:
+                if fmt == "csv":
+                    if writer is None:
+                        writer = csv.DictWriter(out, fieldnames=list(row), extrasaction="ignore")
+                        writer.writeheader()
+                    writer.writerow({k: (json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v) for k, v in row.items()})
                 else:
-                    status = int(resp.get("status", 0) or 0)
-                    backoff = min(iv_min * 60, 300) if status in (403, 429) else 60
-                    th["next_bump_ts"] = now + backoff
-                    results.append(f"#{tid}: err {status}")
-                changed = True
+                    out.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+                n += 1
+                if n % 1000 == 0 and spool.tell() > EXPORT_MAX_BYTES:
+                    raise ValueError("больше 50 МБ — сузь период (since:) или добавь gz")
+            out.flush()
+        finally:
+            out.detach()
+            if gz:
+                raw.close()
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, n
+
+class SpooledInputFile(InputFile):
+    def __init__(self, f, filename: str):
+        super().__init__(filename=filename); self.f = f
+
+    async def read(self, bot: Bot):
+        self.f.seek(0)
+        while chunk := self.f.read(self.chunk_size):
+            yield chunk
+
+def parse_export_args(text: str) -> Tuple[Optional[str], str, bool, int]:
+    kind, fmt, gz, since = None, "csv", False, 0
+    for tok in text.lower().split():
+        if tok in EXPORT_SOURCES:
+            kind = tok
+        elif tok in ("csv", "jsonl"):
+            fmt = tok
+        elif tok in ("gz", "gzip"):
+            gz = True
+        elif tok.startswith("since:"):
+            since = parse_find_query(tok).get("since") or 0
+    return kind, fmt, gz, since
+
+EXPORT_HELP = ("📦 <b>Экспорт</b>\n<code>/export payments|notes|archive|bumps [csv|jsonl] [gz] [since:30d]</code>\n"
+               + "\n".join(f"• <code>{k}</code> — {v}" for k, v in EXPORT_KINDS.items()))
+
+@rt.message(Command("export"))
+async def on_export(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    kind, fmt, gz, since = parse_export_args(((m.text or "").split(maxsplit=1)[1:] or [""])[0])
+    if not kind:
+        await m.answer(EXPORT_HELP); return
+    note = await m.answer(f"⏳ Готовлю экспорт: {EXPORT_KINDS[kind]}…")
+    t0 = time.perf_counter()
+    try:
+        f, n = await asyncio.to_thread(write_export, EXPORT_SOURCES[kind](since), fmt, gz)
+    except Exception as e:
+        METRICS.inc("exports_total", kind=kind, result="error")
+        await note.edit_text(f"⚠️ Экспорт не удался: {_html.escape(str(e))}"); return
+    METRICS.observe("export_seconds", time.perf_counter() - t0, buckets=LATENCY_BUCKETS)
+    try:
+        if not n:
+            await note.edit_text("🤷 Нечего экспортировать."); return
+        name = f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}" + (".gz" if gz else "")
+        await bot.send_document(m.chat.id, SpooledInputFile(f, name), caption=f"📦 {EXPORT_KINDS[kind]}: {n} строк")
+        METRICS.inc("exports_total", kind=kind, result="ok")
+        await note.delete()
+    finally:
+        f.close()
+
+DASHBOARD_REFRESH_SEC = float(os.getenv("DASHBOARD_REFRESH_SEC", "30") or 30)
+DASH_WORKERS = (("notif", "🔔 уведомления"), ("balance", "💰 баланс"), ("autobump", "⏫ автоподнятие"), ("market", "🛒 маркет"))
+
+def render_dashboard() -> str:
+    """Built only from local state (settings, hold ledger, bumps, leases) — no API calls."""
+    s = get_settings()
+    bal = s.get("last_balance")
+    lines = ["📊 <b>Панель</b>",
+             f"💼 Доступно: <b>{bal[0]:g}</b> • Холд: <b>{bal[1]:g}</b>" if bal else "💼 Баланс: ещё не получен"]
+    holds = HOLDS.upcoming(3)
+    if holds:
+        lines += ["", "⏳ <b>Снятие холдов</b>"] + [f"{'🟢' if d == 'in' else '🔴'} {_ts(ts)} — {amt:g} RUB" for d, amt, ts, _who in holds]
+        fc = HOLDS.forecast()
+        if fc[-1][1]:
+            lines.append("🔓 " + " • ".join(f"{label} +{v:g}" for label, v in fc))
+    active = sorted((b for b in load_bumps() if not b.parked), key=lambda b: b.next_bump_ts)
+    if active:
+        lines += ["", f"⏫ <b>Ближайшие поднятия</b> ({len(active)} тем)"]
+        lines += [f"• {_ts(b.next_bump_ts)} — <a href=\"{SITE_FORUM}/threads/{b.thread_id}/\">{b.thread_id}</a>" for b in active[:3]]
+    try:
+        leaders = STORE.leaders()
+    except sqlite3.Error:
+        leaders = {}
+    lines += ["", "🩺 " + " • ".join(f"{label} {'✅' if name in leaders else '⛔️'}" for name, label in DASH_WORKERS)]
+    return "\n".join(lines)
 
-            if changed:
-                cfg["threads"] = threads
-                _save(BUMPS_FILE, cfg)
+def kb_dashboard() -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔄 Обновить", callback_data="dash:refresh")
+    kb.button(text="🏠 Меню", callback_data="go:menu")
+    kb.adjust(2)
+    return kb.as_markup()
 
-            if results:
-                try:
-                    await bot.send_message(ADMIN_USER_ID, "⏫ Автоподнятие:\n" + "\n".join(results))
-                except Exception:
-                    pass
+async def refresh_dashboard(force: bool = False) -> bool:
+    """Edit the pinned message only when the rendered body changed; the footer time is not part of the hash."""
+    d = get_settings().get("dashboard")
+    if not d:
+        return False
+    body = render_dashboard()
+    digest = hashlib.md5(body.encode("utf-8")).hexdigest()
+    if digest == d.get("hash") and not force:
+        METRICS.inc("dashboard_refresh_total", result="same")
+        return False
+    text = f"{body}\n\n<i>обновлено {datetime.now().strftime('%H:%M:%S')}</i>"
+    try:
+        await bot.edit_message_text(text, chat_id=d["chat_id"], message_id=d["message_id"],
+                                    reply_markup=kb_dashboard(), disable_web_page_preview=True)
+    except TelegramRetryAfter:
+        METRICS.inc("dashboard_refresh_total", result="throttled")
+        return False
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            # deleted or too old to edit: forget it, /dash makes a new one
+            set_setting("dashboard", None)
+            METRICS.inc("dashboard_refresh_total", result="lost")
+            return False
+    set_setting("dashboard", {**d, "hash": digest})
+    METRICS.inc("dashboard_refresh_total", result="edited")
+    return True
 
-            await asyncio.sleep(BUMP_TICK_SEC)
+async def dashboard_updater():
+    while True:
+        try:
+            await refresh_dashboard()
         except asyncio.CancelledError:
             break
         except Exception:
-            await asyncio.sleep(BUMP_TICK_SEC)
+            METRICS.inc("worker_errors_total", worker="dashboard")
+            logging.exception("dashboard refresh failed")
+        if await LIFECYCLE.sleep(DASHBOARD_REFRESH_SEC): break
 
+async def open_dashboard(chat_id: int):
+    old = get_settings().get("dashboard")
+    if old:
+        try:
+            await bot.delete_message(old["chat_id"], old["message_id"])
+        except TelegramBadRequest:
+            pass
+    body = render_dashboard()
+    msg = await bot.send_message(chat_id, f"{body}\n\n<i>обновлено {datetime.now().strftime('%H:%M:%S')}</i>",
+                                 reply_markup=kb_dashboard(), disable_web_page_preview=True)
+    set_setting("dashboard", {"chat_id": msg.chat.id, "message_id": msg.message_id,
+                              "hash": hashlib.md5(body.encode("utf-8")).hexdigest()})
+    try:
+        await bot.pin_chat_message(msg.chat.id, msg.message_id, disable_notification=True)
+    except TelegramBadRequest:
+        pass
+
+@rt.message(Command("dash"))
+async def on_dash(m: Message, state: FSMContext):
+    if not await guard(m): return await state.clear()
+    await open_dashboard(m.chat.id)
+
+@rt.callback_query(F.data == "act:dash")
+async def act_dash(cb: CallbackQuery):
+    if not await guard(cb): return
+    await open_dashboard(cb.message.chat.id)
+    await cb.answer()
+
+@rt.callback_query(F.data == "dash:refresh")
+async def dash_refresh(cb: CallbackQuery):
+    if not await guard(cb): return
+    BALANCE.nudge()
+    await refresh_dashboard(force=True)
+    await cb.answer("Обновлено")
+
+
+async def metrics_server():
+    from aiohttp import web
+    async def handle(_request: web.Request) -> web.Response:
+        for phase, sec in STARTUP.items():
+            METRICS.set("startup_seconds", sec, phase=phase)
+        return web.Response(body=METRICS.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info("metrics: http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+async def serve_metrics():
+    try:
+        runner = await metrics_server()
+    except OSError as e:
+        logging.warning("metrics server disabled: %s", e)
+        return
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+ROLES_ALL = ("handlers", "notif", "bump")
+ROLES = set(ROLES_ALL)
+
+def start_background():
+    LIFECYCLE.track(loop_lag_monitor())
+    LIFECYCLE.track(WATCHDOG.heartbeat())
+    if METRICS_PORT:
+        LIFECYCLE.track(serve_metrics())
+    if "handlers" in ROLES:
+        restore_reminders()
+        LIFECYCLE.track(warm_up())
+        LIFECYCLE.worker("dashboard", dashboard_updater())
+    if "notif" in ROLES:
+        LIFECYCLE.hooks.append(OFFLOAD.shutdown)
+        LIFECYCLE.track(OFFLOAD.warm())
+        LIFECYCLE.worker("notif_poller", notif_poller())
+        LIFECYCLE.worker("balance_watcher", balance_watcher())
+        LIFECYCLE.worker("market_watcher", market_watcher())
+    if "bump" in ROLES:
+        LIFECYCLE.worker("autobump_worker", autobump_worker())
+
+async def on_polling_started():
+    # everything not needed to receive the first update starts here, concurrently with polling
+    mark_startup("polling")
+    start_background()
+
+def setup_bot(handlers: bool = True) -> Tuple[Bot, Optional[Dispatcher]]:
+    """Build the Bot, and the Dispatcher with its FSM storage when this process polls; idempotent."""
+    global bot, dp
+    if bot is None:
+        bot = Bot(TG_BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+    if handlers and dp is None:
+        dp = Dispatcher(storage=SQLiteStorage(STORE) if FSM_STORAGE == "sqlite" else MemoryStorage())
+        dp.include_router(rt)
+        dp.startup.register(on_polling_started)
+    mark_startup("bot")
+    return bot, dp
+
+async def main(roles: Tuple[str, ...] = ROLES_ALL, split: bool = False):
+    mark_startup("main")
+    ROLES.clear(); ROLES.update(roles)
+    if split:
+        # this process keeps the handlers, every other role gets its own supervised child
+        for i, role in enumerate(r for r in ROLES_ALL if r in ROLES and r != "handlers"):
+            env = {"METRICS_PORT": str(METRICS_PORT + 1 + i) if METRICS_PORT else "0"}
+            LIFECYCLE.spawn(role, [sys.executable, os.path.abspath(__file__), "--roles", role], env)
+        ROLES.intersection_update({"handlers"})
+    tag = "" if ROLES == set(ROLES_ALL) else "." + "-".join(r for r in ROLES_ALL if r in ROLES)
+    LIFECYCLE.mark_running(f"lifecycle{tag}.json")
+    setup_bot("handlers" in ROLES)
+    if "handlers" in ROLES:
+        await LIFECYCLE.run(dp, bot)
+    else:
+        start_background()
+        await LIFECYCLE.run(None, bot)
 
-async def main():
-    asyncio.create_task(notif_poller())
-    asyncio.create_task(autobump_worker())  
-    await dp.start_polling(bot)
+mark_startup("init")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    import argparse
+    ap = argparse.ArgumentParser(description="LZT Telegram bot")
+    ap.add_argument("--roles", default=os.getenv("BOT_ROLES", ",".join(ROLES_ALL)),
+                    help="comma-separated subset of: " + ", ".join(ROLES_ALL))
+    ap.add_argument("--split", action="store_true", help="run every role except handlers in its own child process")
+    args = ap.parse_args()
+    roles = tuple(r for r in ROLES_ALL if r in {x.strip() for x in args.roles.split(",")})
+    if not roles:
+        ap.error(f"--roles: expected some of {', '.join(ROLES_ALL)}")
+    asyncio.run(main(roles, args.split))
@@ -0,0 +1,409 @@
+"""Notification markup parsing and card rendering for lztbot.
+
+Pure functions only: no env, no I/O, no aiogram. The offload process pool
+imports this module, not the bot, so a worker starts without loading
+aiogram, reading .env or opening state.db.
+"""
+import os, re, hashlib, html as _html
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Tuple
+
+SITE_FORUM = "https://lolz.live"
+
+def _ts(sec: int) -> str:
+    try:
+        return datetime.fromtimestamp(sec).strftime("%d.%m %H:%M")
+    except Exception:
+        return str(sec)
+
+def _money(v: Any) -> float:
+    try:
+        return round(float(v or 0), 2)
+    except (TypeError, ValueError):
+        return 0.0
+
+def normalize_url(u: str) -> str:
+    u = (u or "").strip()
+    return u.replace("prod-api.lolz.live", "lolz.live")
+
+BLOCK_TAGS = frozenset({"br", "p", "li", "ul", "ol", "div"})
+MESSAGE_CLASSES = ("message-body", "message-content", "message-cell", "bbWrapper", "bbCodeBlock-content")
+TAG_NAME_RE = re.compile(r"/?\s*([A-Za-z][A-Za-z0-9]*)")
+ATTR_RE = re.compile(r"""([A-Za-z_:][-\w:.]*)\s*(?:=\s*("[^"]*"|'[^']*'|[^\s"'>]+))?""")
+SNIPPET_CLASS_RE = re.compile(r"\bcontentRow-snippet\b")
+VERB_RE = re.compile(
+    r"(упомянул\(а\)|упомянул|прокомментировал\(а\)|прокомментировал|"
+    r"нравится\s+ваше\s+сообщение|нравится\s+ваш\s+комментарий|написал\(а\)\s+сообщение\s+в\s+вашем\s+профиле)"
+)
+HOLD_DEADLINE_RE = re.compile(r'(Холд\s+(?:закончится|до)\s+[^\n]+)', re.IGNORECASE)
+WS_RUN_RE = re.compile(r"[ \t]{2,}")
+
+def _iter_html(s: str):
+    """One pass over markup: yields ("text", chunk) and ("tag", name, is_end, body).
+
+    A tag is ``<`` up to the next ``>`` (what ``<[^>]+>`` used to strip); the
+    position of the next ``>`` is cached, so floods of ``<`` stay linear.
+    """
+    i, n, gt = 0, len(s), -2
+    while i < n:
+        lt = s.find("<", i)
+        if lt < 0:
+            yield ("text", s[i:]); return
+        if gt != -1 and gt <= lt:
+            gt = s.find(">", lt + 1)
+        if gt == -1:
+            yield ("text", s[i:]); return
+        if gt == lt + 1:
+            yield ("text", s[i:gt + 1]); i = gt + 1; continue
+        if lt > i:
+            yield ("text", s[i:lt])
+        body = s[lt + 1:gt]
+        m = TAG_NAME_RE.match(body)
+        name = m.group(1).lower() if m else ""
+        yield ("tag", name, body.startswith("/"), body)
+        i = gt + 1
+
+def _tag_attrs(body: str) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    m = TAG_NAME_RE.match(body)
+    for a in ATTR_RE.finditer(body, m.end() if m else 0):
+        k = a.group(1).lower()
+        if k in out: continue
+        v = a.group(2) or ""
+        if v[:1] in {'"', "'"}: v = v[1:-1]
+        out[k] = v
+    return out
+
+def _norm_ws(s: str) -> str:
+    s = s.replace("prod-api.lolz.live", "lolz.live")
+    lines, blank = [], 0
+    for line in s.split("\n"):
+        line = line.rstrip(" \t")
+        if not line:
+            blank += 1
+            if blank > 1: continue
+        else:
+            blank = 0
+        lines.append(line)
+    return WS_RUN_RE.sub(" ", "\n".join(lines)).strip()
+
+def _clean_text(s: str) -> str:
+    parts: List[str] = []
+    for tok in _iter_html(s):
+        if tok[0] == "text":
+            parts.append(_html.unescape(tok[1]))
+        elif tok[1] in BLOCK_TAGS:
+            parts.append("\n")
+    return _norm_ws("".join(parts))
+
+class HtmlScan:
+    """Everything parse_notif needs from notification markup, built in one pass.
+
+    ``anchors`` are ``(pos, href, text)`` with ``pos`` an offset into ``plain``
+    (tag-free, unescaped text); an ``<a href>`` without its ``</a>`` is dropped
+    at the next ``<a>`` or the end, like the old regex never matched it.
+    ``text`` is ``plain`` after _clean_text's whitespace rules;
+    ``snippet``/``message``/``quote`` are the cleaned contents of the first
+    contentRow-snippet div, message-body-like block and blockquote — empty
+    when that block is never closed, for the same reason.
+    """
+    __slots__ = ("anchors", "plain", "text", "snippet", "message", "quote")
+
+def scan_html(s: str) -> HtmlScan:
+    parts: List[str] = []; size = 0
+    anchors: List[Tuple[int, str, str]] = []
+    a_open: Optional[Tuple[int, str, int]] = None        # (pos, href, parts index)
+    caps: Dict[str, List[Any]] = {}                      # kind -> [tag, depth, parts index, end index]
+
+    def close_anchor(end: int):
+        pos, href, start = a_open
+        anchors.append((pos, href, _norm_ws("".join(parts[start:end]))))
+
+    for tok in _iter_html(s):
+        if tok[0] == "text":
+            chunk = _html.unescape(tok[1])
+            parts.append(chunk); size += len(chunk)
+            continue
+        _, name, is_end, body = tok
+        if name == "a":
+            if a_open is not None and is_end:
+                close_anchor(len(parts))
+            a_open = None
+            if not is_end:
+                href = _tag_attrs(body).get("href")
+                if href is not None:
+                    a_open = (size, href, len(parts))
+        for cap in caps.values():
+            if cap[3] is None and cap[0] == name:
+                cap[1] += -1 if is_end else 1
+                if cap[1] == 0:
+                    cap[3] = len(parts)
+        if not is_end and name in {"div", "article", "blockquote"}:
+            kind = None
+            if name == "blockquote":
+                kind = "quote"
+            else:
+                cls = _tag_attrs(body).get("class", "")
+                if name == "div" and SNIPPET_CLASS_RE.search(cls):
+                    kind = "snippet"
+                elif any(k in cls for k in MESSAGE_CLASSES):
+                    kind = "message"
+            if kind and kind not in caps:
+                caps[kind] = [name, 1, len(parts) + (1 if name in BLOCK_TAGS else 0), None]
+        if name in BLOCK_TAGS:
+            parts.append("\n"); size += 1
+
+    sc = HtmlScan()
+    sc.anchors = anchors
+    sc.plain = "".join(parts)
+    sc.text = _norm_ws(sc.plain)
+    for kind in ("snippet", "message", "quote"):
+        cap = caps.get(kind)
+        setattr(sc, kind, _norm_ws("".join(parts[cap[2]:cap[3]])) if cap and cap[3] is not None else "")
+    return sc
+
+def _find_quotes(text: str, limit: int = 300) -> List[str]:
+    out: List[str] = []
+    i, close = 0, -2
+    while True:
+        a = text.find("«", i)
+        if a < 0: break
+        if close != -1 and close <= a:
+            close = text.find("»", a + 1)
+        if close == -1: break
+        if 1 <= close - a - 1 <= limit:
+            out.append(text[a + 1:close]); i = close + 1
+        else:
+            i = a + 1
+    return out
+
+def _hash_notif(item: dict) -> str:
+    nid = str(item.get("notification_id") or "")
+    if nid: return "id:" + nid
+    raw = f"{item.get('notification_create_date','')}-{item.get('notification_html','')}"
+    return "h:" + hashlib.md5(raw.encode("utf-8", errors="ignore")).hexdigest()
+
+def _extract_amount(text: str) -> Optional[str]:
+    """'1 000,50 ₽' → '1000,50'. Finds each ₽ and walks back over the digit run before it: runs never
+    overlap, so this is linear where the old regex backtracked over every digit/space run without a ₽."""
+    s = text.replace('\xa0', ' ')
+    j = s.find('₽')
+    while j != -1:
+        k = j
+        while k > 0 and (s[k - 1].isdecimal() or s[k - 1].isspace() or s[k - 1] in ".,"):
+            k -= 1
+        while k < j and not s[k].isdecimal():
+            k += 1
+        if k < j:
+            return s[k:j].replace(' ', '')
+        j = s.find('₽', j + 1)
+    return None
+
+def _grab_hold_deadline(text: str) -> Optional[str]:
+    m = HOLD_DEADLINE_RE.search(_clean_text(text))
+    return m.group(1) if m else None
+
+class ParsedNotif:
+    __slots__ = ("actor_name", "actor_url", "action", "type", "thread_title", "thread_url",
+                 "thread_id", "post_id", "post_url", "snippet", "amount")
+
+    def __init__(self):
+        self.actor_name = ""; self.actor_url = ""; self.action = ""; self.type = "other"
+        self.thread_title = ""; self.thread_url = ""; self.thread_id: Optional[int] = None
+        self.post_id: Optional[int] = None; self.post_url = ""; self.snippet = ""
+        self.amount = 0.0  # RUB, parsed once for money types; the card text may not carry it any more
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+def parse_notif(html: str, content: Optional[Dict[str, Any]] = None) -> "ParsedNotif":
+    out = ParsedNotif()
+
+    c = content or {}
+    actor_obj = (c.get("actor") or c.get("user") or c.get("from_user")
+                 or c.get("author") or c.get("sender") or {})
+    if isinstance(actor_obj, dict):
+        out.actor_name = actor_obj.get("username") or actor_obj.get("name") or out.actor_name
+        uid = actor_obj.get("user_id") or actor_obj.get("id")
+        if uid:
+            out.actor_url = f"{SITE_FORUM}/members/{uid}"
+
+    thread = c.get("thread") or {}
+    post   = c.get("post") or c.get("comment") or {}
+    if isinstance(thread, dict):
+        out.thread_title = thread.get("title") or out.thread_title
+        tid = thread.get("thread_id") or thread.get("id")
+        if tid:
+            out.thread_id = int(tid)
+            out.thread_url = f"{SITE_FORUM}/threads/{tid}/"
+    if isinstance(post, dict):
+        pid = post.get("post_id") or post.get("comment_id") or post.get("id")
+        if pid:
+            out.post_id = int(pid)
+            out.post_url = post.get("permalink") or f"{SITE_FORUM}/posts/{pid}/"
+        body = post.get("body") or post.get("message") or post.get("text") or ""
+        body = _clean_text(body)
+        if body:
+            out.snippet = (body[:300]).strip()
+
+    raw_html = html or ""
+    if raw_html:
+        norm = raw_html.replace("\u2009", " ").replace("\xa0", " ")
+        sc = scan_html(norm)
+        anchors = [(pos, normalize_url(href), text) for pos, href, text in sc.anchors]
+
+        if not out.actor_url or not out.actor_name:
+            member_links = [x for x in anchors if re.search(r"/members/\d+", x[1])]
+            mv = VERB_RE.search(sc.plain.lower())
+            verb_idx = mv.start() if mv else None
+
+            chosen = None
+            if member_links:
+                if verb_idx is not None:
+                    before = [x for x in member_links if x[0] < verb_idx]
+                    if before:
+                        chosen = before[-1]          
+                if not chosen:
+                    chosen = member_links[0]        
+
+            if chosen:
+                _, href, text = chosen
+                out.actor_url = href
+                out.actor_name = text or out.actor_name
+
+            if (not out.actor_url or not out.actor_name) and anchors:
+                out.actor_url = anchors[0][1]
+                out.actor_name = anchors[0][2] or out.actor_name or "Пользователь"
+
+        if not out.thread_url and anchors:
+            for _, href, text in anchors:
+                mm = re.search(r"/threads/(\d+)", href)
+                if mm:
+                    out.thread_url = href
+                    if text:
+                        out.thread_title = out.thread_title or text
+                    out.thread_id = int(mm.group(1))
+                    break
+
+        if not out.post_url and anchors:
+            for _, href, _ in anchors:
+                if (re.search(r"/posts/(comments/)?\d+/?$", href) or
+                    re.search(r"#post-\d+$", href) or
+                    re.search(r"/profile-posts(/comments)?/\d+/?$", href)):
+                    out.post_url = href
+                    break
+
+        mm = re.search(r"/threads/(\d+)/#post-(\d+)", norm)
+        if mm and not out.post_url:
+            out.thread_id = out.thread_id or int(mm.group(1))
+            out.post_id = int(mm.group(2))
+            out.thread_url = out.thread_url or f"{SITE_FORUM}/threads/{out.thread_id}/"
+            out.post_url   = f"{SITE_FORUM}/posts/{out.post_id}/"
+
+        raw = sc.text.lower()
+        def has(parts: List[str]) -> bool:
+            return any(p in raw for p in parts)
+
+        if not out.action or out.type in {"other", ""}:
+            if has(["холд на платеж", "холд закончился", "холд по платежу снят", "холд завершился"]):
+                out.type, out.action = "hold_released", "холд закончился"
+            elif "нравится ваше сообщение" in raw or "нравится ваш комментарий" in raw:
+                out.type, out.action = "like", "поставил(а) ❤️ либо 👍 вашему сообщению"
+            elif has(["упомянул(а) вас", "упомянул вас", "упомянул(а) в сообщении"]):
+                out.type, out.action = "mention", "упомянул(а) вас"
+            elif has(["прокомментировал(а) ваше сообщение", "прокомментировал ваше сообщение"]):
+                out.type, out.action = "comment", "прокомментировал(а) ваше сообщение"
+            elif has(["прокомментировал(а) запись в вашем профиле", "прокомментировал вашу запись на стене", "вашей записи на стене", "запись в вашем профиле"]):
+                out.type, out.action = "profile_comment", "прокомментировал(а) запись в вашем профиле"
+            elif has(["написал(а) на вашей стене", "оставил(а) сообщение в вашем профиле", "сообщение на вашей стене"]):
+                out.type, out.action = "profile_post", "написал(а) сообщение в вашем профиле"
+            elif has(["зачислены на ваш баланс", "пополнение баланса", "получен платеж"]):
+                out.type, out.action = "payment_in", "зачисление на баланс"
+            elif has(["отправил(а) вам", "перевёл вам", "перевел вам"]):
+                if "холд закончится" in raw or "установлен холд" in raw or "холд до" in raw:
+                    out.type, out.action = "transfer_in_hold", "перевёл(а) вам"
+                else:
+                    out.type, out.action = "transfer_in", "перевёл(а) вам"
+            else:
+                out.type, out.action = "other", sc.text
+
+        if not out.snippet:
+            out.snippet = (sc.snippet or sc.message or sc.quote)[:300].strip()
+        if not out.snippet:
+            q_candidates = [q.strip() for q in _find_quotes(sc.text)
+                            if q.strip() and q.strip() != (out.thread_title or "").strip()]
+            if q_candidates:
+                out.snippet = max(q_candidates, key=len)
+
+        if out.type in {"transfer_in", "transfer_in_hold", "hold_released", "payment_in"}:
+            amt = _extract_amount(sc.text)
+            if amt:
+                out.amount = _money(re.sub(r"\s", "", amt).replace(",", "."))
+                if out.type in {"transfer_in", "transfer_in_hold"}:
+                    out.action = f"перевёл(а) вам +{amt} ₽" + (" (холд)" if out.type == "transfer_in_hold" else "")
+                elif out.type == "hold_released":
+                    out.snippet = out.snippet or f"Сумма: {amt} ₽"
+                elif out.type == "payment_in":
+                    out.snippet = out.snippet or f"Сумма: +{amt} ₽"
+            if out.type == "transfer_in_hold":
+                mh = HOLD_DEADLINE_RE.search(sc.text)
+                if mh:
+                    out.snippet = mh.group(1)
+
+        if out.snippet and out.snippet.strip() == (out.thread_title or "").strip():
+            out.snippet = ""
+
+    out.actor_name = out.actor_name or "Пользователь"
+    return out
+
+
+
+def _a(name: str, url: str) -> str:
+    if url and name:
+        return f'<a href="{url}">{_html.escape(name)}</a>'
+    return _html.escape(name or "Пользователь")
+
+def _action_prefix(t: str) -> str:
+    return {
+        "like": "❤️",
+        "comment": "💬",
+        "mention": "🏷️",
+        "payment_in": "✅",
+        "transfer_in": "💵",
+        "transfer_in_hold": "💵",
+        "hold_released": "🟢",
+        "profile_post": "🧱",
+        "profile_comment": "🧩"
+    }.get(t, "🔔")
+
+def render_notif_text(item: dict, m: ParsedNotif) -> str:
+    dt = _ts(int(item.get("notification_create_date", 0)))
+    actor = _a(m.actor_name or "", m.actor_url or "")
+    icon  = _action_prefix(m.type or "other")
+    lines: List[str] = [f"🕒 {dt}", f"{icon} {actor} {m.action or ''}".strip()]
+    if (m.thread_title or "").strip():
+        lines.append(f"🧵 <a href=\"{m.thread_url}\">{_html.escape(m.thread_title)}</a>")
+    if m.snippet:
+        lines.append(f"«{_html.escape(m.snippet)}»")
+    return "\n".join([s for s in lines if s.strip()])
+
+def notif_buttons(m: ParsedNotif) -> List[Tuple[str, str]]:
+    """(text, url) for the card's link buttons; the bot turns them into an inline keyboard."""
+    out: List[Tuple[str, str]] = []
+    if m.post_url:
+        out.append(("К записи" if (m.type in {"profile_post","profile_comment"}) else "К сообщению", m.post_url))
+    if m.thread_url:
+        out.append(("К теме", m.thread_url))
+    return out
+
+def _render_job(item: dict, content: Optional[Dict[str, Any]], allowed: Optional[set] = None) -> Tuple[ParsedNotif, Optional[str], List[Tuple[str, str]]]:
+    parsed = parse_notif(item.get("notification_html", "") or "", content)
+    if allowed is not None and (parsed.type or "other") not in allowed:
+        return parsed, None, []
+    return parsed, render_notif_text(item, parsed), notif_buttons(parsed)
+
+def _render_chunk(jobs: List[Tuple[dict, Optional[Dict[str, Any]], Optional[set]]]) -> list:
+    return [_render_job(*j) for j in jobs]
+
+def _pool_ready() -> int:
+    return os.getpid()